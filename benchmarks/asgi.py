@@ -0,0 +1,52 @@
+"""Calling an ASGI app in-process, with no HTTP client, server or sockets."""
+
+import asyncio
+import json
+from typing import Any
+
+from fastapi import FastAPI
+from starlette.types import Message
+
+
+async def call(
+    app: FastAPI, method: str, path: str, body: Any = None
+) -> tuple[int, bytes]:
+    """Send one request to the app and return the response status and body."""
+    content = b"" if body is None else json.dumps(body).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(content)).encode()),
+        ],
+        "server": ("bench", 80),
+        "client": ("bench", 1),
+    }
+    received = False
+    status = 0
+    chunks: list[bytes] = []
+
+    async def receive() -> Message:
+        nonlocal received
+        if received:  # the app only asks again to wait for a disconnect
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": content, "more_body": False}
+
+    async def send(message: Message) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
@@ -0,0 +1,88 @@
+"""Event-loop blocking of the sync vs async database paths.
+
+Run with ``python -m benchmarks.async_allocate``. Each scenario fires
+``concurrency`` allocations at once from coroutines, against a file SQLite
+database (aiosqlite for the async path), and reports wall time and the worst
+delay seen by a heartbeat task sharing the loop. The sync path holds the loop
+for every query; the async path yields to it on every round-trip.
+"""
+
+import asyncio
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocations.adapters import orm, repository
+from allocations.service_layer import services
+
+CONCURRENCY = (1, 10, 50)
+BATCHES = 100
+
+
+async def heartbeat(stop: asyncio.Event) -> float:
+    worst_lag = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst_lag = max(worst_lag, time.perf_counter() - started - 0.001)
+    return worst_lag
+
+
+async def measure(
+    allocate: Callable[[str], Awaitable[str]], concurrency: int
+) -> tuple[float, float]:
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(stop))
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(allocate(f"order-{concurrency}-{i}") for i in range(concurrency))
+    )
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, await beat
+
+
+def main() -> None:
+    orm.start_mappers()
+    path = Path(tempfile.mkdtemp()) / "bench.db"
+    engine = create_engine(f"sqlite:///{path}")
+    orm.metadata.create_all(engine)
+    get_session = sessionmaker(bind=engine)
+    get_async_session = async_sessionmaker(
+        bind=create_async_engine(f"sqlite+aiosqlite:///{path}")
+    )
+    with get_session() as session:
+        repo = repository.SqlAlchemyRepository(session)
+        for i in range(BATCHES):
+            services.add_batch(
+                f"batch-{i}", "chair", 1_000_000, None, repo=repo, session=session
+            )
+
+    async def allocate_sync(orderid: str) -> str:
+        with get_session() as session:
+            repo = repository.SqlAlchemyRepository(session)
+            return services.allocate(orderid, "chair", 1, repo=repo, session=session)
+
+    async def allocate_async(orderid: str) -> str:
+        async with get_async_session() as session:
+            return await services.run_async(
+                session, services.allocate, orderid, "chair", 1
+            )
+
+    print(f"{'path':>6} {'concurrency':>12} {'wall':>10} {'worst loop lag':>16}")
+    for name, allocate in (("sync", allocate_sync), ("async", allocate_async)):
+        for concurrency in CONCURRENCY:
+            elapsed, lag = asyncio.run(measure(allocate, concurrency))
+            print(
+                f"{name:>6} {concurrency:>12} {elapsed * 1e3:>7.1f} ms"
+                f" {lag * 1e3:>13.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Postgres vs SQLite, with and without adapters.sqlite's tuning.
+
+Run with ``python -m benchmarks.backends``. Each backend goes through the
+repository and service layer the API uses (services.run_async on an async
+engine) for the operations the repository tests cover: adding batches,
+allocating one at a time, and ``CONCURRENCY`` allocations at once spread
+over ``WORKERS`` engines, as from that many API worker processes. It reports
+ops/sec and how many operations failed, by error. Postgres is skipped when
+config.get_async_postgres_uri is not reachable; its runs use fresh
+references, so they leave rows behind in that database.
+"""
+
+import asyncio
+import tempfile
+import time
+import uuid
+from collections import Counter
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from allocations import config
+from allocations.adapters import orm, sqlite
+from allocations.service_layer import services
+
+SKUS = 10
+BATCHES = 100
+ALLOCATIONS = 300
+CONCURRENCY = 50
+WORKERS = (1, 4)
+
+
+def temporary_sqlite_uri() -> str:
+    return f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'bench.db'}"
+
+
+def engine_for(database_uri: str, tuned: bool) -> AsyncEngine:
+    if not tuned:
+        return create_async_engine(database_uri)
+    engine = create_async_engine(database_uri, **sqlite.POOL)
+    sqlite.tune(engine.sync_engine, config.get_sqlite_settings())
+    return engine
+
+
+# name: (database URI, tuned)
+BACKENDS: dict[str, tuple[Callable[[], str], bool]] = {
+    "sqlite (defaults)": (temporary_sqlite_uri, False),
+    "sqlite (tuned)": (temporary_sqlite_uri, True),
+    "postgres": (config.get_async_postgres_uri, False),
+}
+
+
+async def measure(
+    database_uri: str, tuned: bool, workers: int
+) -> dict[str, tuple[float, Counter[str]]]:
+    engines = [engine_for(database_uri, tuned) for _ in range(workers)]
+    async with engines[0].begin() as connection:
+        await connection.run_sync(orm.metadata.create_all)
+    get_sessions = [async_sessionmaker(bind=e) for e in engines]
+    run = uuid.uuid4().hex[:8]
+    skus = [f"{run}-sku-{n}" for n in range(SKUS)]
+    results = {}
+
+    async def call(n: int, service: Callable[..., object], *args: Any) -> None:
+        async with get_sessions[n % workers]() as session:
+            await services.run_async(session, service, *args)
+
+    async def timed(name: str, calls: Sequence[tuple[Any, ...]], at_once: int) -> None:
+        errors: Counter[str] = Counter()
+
+        async def one(n: int, args: tuple[Any, ...]) -> None:
+            try:
+                await call(n, *args)
+            except Exception as e:
+                errors[f"{type(e).__name__}: {str(e).splitlines()[0][:40]}"] += 1
+
+        started = time.perf_counter()
+        for start in range(0, len(calls), at_once):
+            await asyncio.gather(
+                *(
+                    one(n, args)
+                    for n, args in enumerate(calls[start : start + at_once], start)
+                )
+            )
+        results[name] = (len(calls) / (time.perf_counter() - started), errors)
+
+    await timed(
+        "add_batch",
+        [
+            (services.add_batch, f"{run}-b{n}", skus[n % SKUS], 10**6, None)
+            for n in range(BATCHES)
+        ],
+        1,
+    )
+    allocations = [
+        (services.allocate, f"{run}-o{n}", skus[n % SKUS], 1)
+        for n in range(ALLOCATIONS)
+    ]
+    await timed("allocate", allocations[: ALLOCATIONS // 2], 1)
+    await timed(
+        f"allocate x{CONCURRENCY}", allocations[ALLOCATIONS // 2 :], CONCURRENCY
+    )
+    for e in engines:
+        await e.dispose()
+    return results
+
+
+def main() -> None:
+    orm.start_mappers()
+    print(f"{'backend':<18} {'workers':>7} {'operation':<13} {'ops/s':>8}  errors")
+    for name, (database_uri, tuned) in BACKENDS.items():
+        for workers in WORKERS:
+            try:
+                results = asyncio.run(measure(database_uri(), tuned, workers))
+            except OSError as e:
+                print(f"{name:<18} skipped: {e}")
+                break
+            for operation, (rate, errors) in results.items():
+                failed = ", ".join(f"{n} {error}" for error, n in errors.items())
+                print(
+                    f"{name:<18} {workers:>7} {operation:<13} {rate:>8.0f}"
+                    f"  {failed or '-'}"
+                )
+
+
+if __name__ == "__main__":
+    main()
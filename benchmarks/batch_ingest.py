@@ -0,0 +1,57 @@
+"""Rows per second for per-batch add_batch commits vs chunked add_batches.
+
+Run with ``python -m benchmarks.batch_ingest``; both paths write to a fresh
+file SQLite database. On Postgres add_batches switches to COPY.
+"""
+
+import tempfile
+import time
+from collections.abc import Callable, Iterator
+from datetime import date
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, clear_mappers, sessionmaker
+
+from allocations.adapters import orm, repository
+from allocations.service_layer import services
+
+ROWS = 20_000
+SKUS = 500
+
+
+def rows() -> Iterator[tuple[str, str, int, date | None]]:
+    for i in range(ROWS):
+        yield f"batch-{i}", f"sku-{i % SKUS}", 100, None
+
+
+def one_by_one(session: Session) -> None:
+    repo = repository.SqlAlchemyRepository(session)
+    for ref, sku, qty, eta in rows():
+        services.add_batch(ref, sku, qty, eta, repo=repo, session=session)
+
+
+def chunked(session: Session) -> None:
+    repo = repository.SqlAlchemyRepository(session)
+    services.add_batches(rows(), repo=repo, session=session)
+
+
+def measure(ingest: Callable[[Session], None]) -> float:
+    orm.start_mappers()
+    engine = create_engine(f"sqlite:///{Path(tempfile.mkdtemp()) / 'bench.db'}")
+    orm.metadata.create_all(engine)
+    started = time.perf_counter()
+    with sessionmaker(bind=engine)() as session:
+        ingest(session)
+    elapsed = time.perf_counter() - started
+    clear_mappers()
+    return ROWS / elapsed
+
+
+def main() -> None:
+    for name, ingest in (("add_batch", one_by_one), ("add_batches", chunked)):
+        print(f"{name:>12} {measure(ingest):>10.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
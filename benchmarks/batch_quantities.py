@@ -0,0 +1,43 @@
+"""Cost of Batch quantity checks as allocations per batch grow.
+
+Run with ``python -m benchmarks.batch_quantities``; the per-call time should
+stay flat across the columns because the allocated total is kept up to date
+by Batch.allocate/deallocate rather than re-summed.
+"""
+
+import timeit
+
+from allocations.domain import model
+
+ALLOCATIONS_PER_BATCH = (10, 100, 1_000, 5_000)
+CALLS = 10_000
+
+
+def make_batch(allocations: int) -> model.Batch:
+    batch = model.Batch("batch", "chair", qty=allocations * 2)
+    for i in range(allocations):
+        batch.allocate(model.OrderLine(f"order-{i}", "chair", 1))
+    return batch
+
+
+def main() -> None:
+    line = model.OrderLine("new-order", "chair", 1)
+    print(f"{'allocations':>12} {'available_quantity':>20} {'can_allocate':>14}")
+    for allocations in ALLOCATIONS_PER_BATCH:
+        batch = make_batch(allocations)
+        available = timeit.timeit(
+            "batch.available_quantity", globals={"batch": batch}, number=CALLS
+        )
+        can_allocate = timeit.timeit(
+            "batch.can_allocate(line)",
+            globals={"batch": batch, "line": line},
+            number=CALLS,
+        )
+        print(
+            f"{allocations:>12} {available / CALLS * 1e9:>17.0f} ns"
+            f" {can_allocate / CALLS * 1e9:>11.0f} ns"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Allocation traffic replayed against the API, in-process.
+
+Run with ``python -m benchmarks.load``, e.g. ``--concurrency 50 --zipf 1.2``.
+``CONCURRENCY`` clients each send their next request as soon as the last
+one is answered, straight to ``allocations.endpoints.app.app`` over ASGI (no
+sockets), until ``REQUESTS`` have been sent. Each request is a new
+allocation or, for ``--add-batch`` of them, a new batch restocking a sku.
+Skus are picked with Zipf's law: the sku of rank k is picked in proportion
+to 1 / k ** zipf, so a few hot skus take most of the traffic and run out of
+stock (``--zipf 0`` picks them uniformly). ``--unknown`` of the allocations
+are for a sku that has no batches.
+
+The app runs on SQLite (``--database``, in memory by default, but a file
+for PARTITIONED=1), set up as DB_BACKEND=sqlite would; the rest of its
+settings come from the environment as usual, e.g. FAST_JSON=1. Reports
+throughput, p50/p95/p99 latency per endpoint, and how many responses of
+each kind came back: 201, 400 by error (OutOfStock, InvalidSku), and
+anything else by status.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Any
+
+from allocations.adapters import orm
+from allocations.endpoints.app import app
+from benchmarks.asgi import call
+
+# the start of each 400 message, and what to report it as
+ERRORS = {"Out of stock": "OutOfStock", "Invalid sku": "InvalidSku"}
+
+Request = tuple[str, dict[str, Any]]
+
+
+def outcome(status: int, body: bytes) -> str:
+    if status != 400:
+        return str(status)
+    message = json.loads(body).get("message", "")
+    for prefix, error in ERRORS.items():
+        if message.startswith(prefix):
+            return f"400 {error}"
+    return "400 other"
+
+
+def traffic(args: argparse.Namespace) -> list[Request]:
+    rng = random.Random(args.seed)
+    skus = [f"sku-{rank}" for rank in range(args.skus)]
+    weights = [1 / (rank + 1) ** args.zipf for rank in range(args.skus)]
+    picks = rng.choices(skus, weights, k=args.requests)
+    requests: list[Request] = []
+    for n, sku in enumerate(picks):
+        if rng.random() < args.add_batch:
+            batch = {"ref": f"restock-{n}", "sku": sku, "qty": args.qty, "eta": None}
+            requests.append(("/add_batch", batch))
+        else:
+            if rng.random() < args.unknown:
+                sku = f"unknown-{n}"
+            qty = rng.randint(1, args.max_line_qty)
+            requests.append(("/allocate", {"orderid": f"o{n}", "sku": sku, "qty": qty}))
+    return requests
+
+
+async def replay(args: argparse.Namespace) -> None:
+    requests = traffic(args)
+    latencies: defaultdict[str, list[float]] = defaultdict(list)
+    outcomes: Counter[str] = Counter()
+    async with app.router.lifespan_context(app):
+        async with app.state.resources.engine.begin() as connection:
+            await connection.run_sync(orm.metadata.create_all)
+        for rank in range(args.skus):
+            batch = {"ref": f"batch-{rank}", "sku": f"sku-{rank}", "qty": args.qty}
+            await call(app, "POST", "/add_batch", {**batch, "eta": None})
+
+        pending = iter(requests)
+
+        async def client() -> None:
+            # the iterator is shared: each request is sent by one client
+            for path, body in pending:
+                started = time.perf_counter()
+                try:
+                    result = outcome(*await call(app, "POST", path, body))
+                except Exception as e:
+                    result = f"raised {type(e).__name__}"
+                latencies[path].append(time.perf_counter() - started)
+                outcomes[f"{path} {result}"] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    print(
+        f"{len(requests)} requests in {elapsed:.2f}s: "
+        f"{len(requests) / elapsed:.0f} req/s"
+        f" (concurrency {args.concurrency}, {args.skus} skus, zipf {args.zipf})"
+    )
+    print(f"{'endpoint':<12} {'requests':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for path, timings in sorted(latencies.items()):
+        timings.sort()
+        p50, p95, p99 = (
+            timings[min(len(timings) - 1, len(timings) * p // 100)] * 1e3
+            for p in (50, 95, 99)
+        )
+        print(f"{path:<12} {len(timings):>9} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}")
+    print(f"{'response':<32} {'count':>7} {'rate':>7}")
+    for path, group in itertools.groupby(sorted(outcomes), lambda o: o.split()[0]):
+        sent = len(latencies[path])
+        for name in group:
+            print(f"{name:<32} {outcomes[name]:>7} {outcomes[name] / sent:>7.1%}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--skus", type=int, default=100)
+    parser.add_argument("--zipf", type=float, default=1.1, help="sku skew, 0 is none")
+    parser.add_argument(
+        "--add-batch", type=float, default=0.05, help="share of /add_batch requests"
+    )
+    parser.add_argument(
+        "--unknown",
+        type=float,
+        default=0.01,
+        help="share of allocations for unknown skus",
+    )
+    parser.add_argument("--qty", type=int, default=100, help="units per batch")
+    parser.add_argument("--max-line-qty", type=int, default=5)
+    parser.add_argument(
+        "--database", default=":memory:", help="SQLite file, or :memory:"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # read by the app when it starts
+    os.environ.update(DB_BACKEND="sqlite", SQLITE_PATH=args.database)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    asyncio.run(replay(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Allocation throughput of the SKU-partitioned engine by worker count.
+
+Run with ``python -m benchmarks.partitioned``. Each row sends the same bulk
+allocations, spread over ``SKUS`` skus, to a PartitionedAllocator with that
+many worker processes, against a file SQLite database. The first request to
+each worker (process start-up and loading its skus) is not timed. Expect the
+ops/sec to grow with the partitions up to the number of cores; SQLite's
+single writer caps it sooner than Postgres would.
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from allocations.adapters import orm
+from allocations.service_layer.partitioned import PartitionedAllocator
+
+PARTITIONS = (1, 2, 4)
+SKUS = 64
+LINES_PER_REQUEST = 50
+REQUESTS = 40
+
+
+async def measure(allocator: PartitionedAllocator, run: int) -> float:
+    skus = [f"sku-{s}" for s in range(SKUS)]
+    await allocator.add_batches(
+        [(f"batch-{sku}", sku, 1_000_000, None) for sku in skus]
+    )
+    await allocator.allocate_many([(f"warm-{sku}", sku, 1) for sku in skus])
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            allocator.allocate_many(
+                [
+                    (f"order-{run}-{r}-{i}", skus[(r + i) % SKUS], 1)
+                    for i in range(LINES_PER_REQUEST)
+                ]
+            )
+            for r in range(REQUESTS)
+        )
+    )
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'partitions':>10} {'seconds':>9} {'ops/s':>9}")
+    for run, partitions in enumerate(PARTITIONS):
+        path = Path(tempfile.mkdtemp()) / "bench.db"
+        orm.metadata.create_all(create_engine(f"sqlite:///{path}"))
+        allocator = PartitionedAllocator(f"sqlite:///{path}", partitions)
+        allocator.start()
+        try:
+            seconds = asyncio.run(measure(allocator, run))
+        finally:
+            allocator.close()
+        ops = REQUESTS * LINES_PER_REQUEST
+        print(f"{partitions:>10} {seconds:>9.2f} {ops / seconds:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Requests/sec of the hot endpoints with the pydantic models vs fast JSON.
+
+Run with ``python -m benchmarks.serialization`` (needs the fast-json extra).
+Each endpoint is called straight through the ASGI interface, one request at
+a time and without an HTTP client or server, so the numbers are the app's
+own per-request cost. The requests are replayed allocations and
+availability reads, which do little database work; a new allocation waits
+for its commit, which dwarfs parsing and encoding. The modes take turns
+for ``ROUNDS`` rounds and each keeps its best, to even out noise.
+"""
+
+import asyncio
+import logging
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy import create_engine
+
+from allocations import config
+from allocations.adapters import orm
+from allocations.endpoints.app import create_app
+from benchmarks.asgi import call
+
+ROUNDS = 5
+REQUESTS = 500
+BULK_LINES = 20
+
+
+# the first call of each allocates, the timed ones replay
+SCENARIOS: dict[str, tuple[str, str, Any]] = {
+    "allocate": ("POST", "/allocate", {"orderid": "o1", "sku": "sku-0", "qty": 1}),
+    f"allocate/bulk ({BULK_LINES} lines)": (
+        "POST",
+        "/allocate/bulk",
+        {
+            "lines": [
+                {"orderid": "o2", "sku": f"sku-{n}", "qty": 1}
+                for n in range(BULK_LINES)
+            ]
+        },
+    ),
+    "skus/{sku}/availability": ("GET", "/skus/sku-0/availability", None),
+    "batches/{reference}": ("GET", "/batches/batch-0", None),
+}
+
+
+async def measure(fast: bool) -> dict[str, float]:
+    path = Path(tempfile.mkdtemp()) / "bench.db"
+    orm.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    settings = config.Settings(
+        database_uri=f"sqlite+aiosqlite:///{path}",
+        serialization={"fast": fast},
+        log_level=logging.WARNING,
+    )
+    app = create_app(settings)
+    rates = {}
+    async with app.router.lifespan_context(app):
+        for n in range(BULK_LINES):
+            batch = {"ref": f"batch-{n}", "sku": f"sku-{n}", "qty": 100, "eta": None}
+            await call(app, "POST", "/add_batch", batch)
+        for name, request in SCENARIOS.items():
+            await call(app, *request)
+            started = time.perf_counter()
+            for _ in range(REQUESTS):
+                await call(app, *request)
+            rates[name] = REQUESTS / (time.perf_counter() - started)
+    return rates
+
+
+def main() -> None:
+    best: dict[bool, dict[str, float]] = {False: {}, True: {}}
+    for _ in range(ROUNDS):
+        for mode, rates in best.items():
+            for name, rate in asyncio.run(measure(mode)).items():
+                rates[name] = max(rate, rates.get(name, 0.0))
+    models, fast = best[False], best[True]
+    print(f"{'endpoint':<28} {'models req/s':>12} {'fast req/s':>12} {'speedup':>8}")
+    for name in SCENARIOS:
+        print(
+            f"{name:<28} {models[name]:>12.0f} {fast[name]:>12.0f}"
+            f" {fast[name] / models[name]:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Hot-path benchmarks for the domain model, service layer and repository.
+
+Run with ``python -m benchmarks.suite``. Every benchmark is run for each
+scenario in the grid (SKU count x batches per SKU x allocations per batch)
+against in-memory SQLite, and reports ops/sec with p50/p95/p99 latency.
+
+``--save FILE`` writes the results as a JSON baseline; ``--compare FILE``
+reports each result against that baseline and exits non-zero when any
+benchmark's ops/sec dropped by more than ``--threshold`` (default 20%).
+"""
+
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocations.adapters import orm, repository
+from allocations.domain import model
+from allocations.service_layer import services
+
+
+@dataclass(frozen=True)
+class Scenario:
+    skus: int
+    batches_per_sku: int
+    allocations_per_batch: int
+
+    def __str__(self) -> str:
+        return (
+            f"skus={self.skus},batches={self.batches_per_sku},"
+            f"allocations={self.allocations_per_batch}"
+        )
+
+    def batches(self, spare: int) -> Iterator[model.Batch]:
+        """Batches with their allocation history and ``spare`` free units."""
+        today = date.today()
+        for s, b in itertools.product(range(self.skus), range(self.batches_per_sku)):
+            batch = model.Batch(
+                f"batch-{s}-{b}",
+                f"sku-{s}",
+                self.allocations_per_batch + spare,
+                eta=today + timedelta(days=b) if b else None,
+            )
+            for a in range(self.allocations_per_batch):
+                batch.allocate(model.OrderLine(f"old-{s}-{b}-{a}", batch.sku, 1))
+            yield batch
+
+
+@dataclass(frozen=True)
+class Result:
+    ops_per_second: float
+    p50_us: float
+    p95_us: float
+    p99_us: float
+
+    @classmethod
+    def from_timings(cls, timings: list[float]) -> "Result":
+        percentiles = statistics.quantiles(timings, n=100, method="inclusive")
+        return cls(
+            len(timings) / sum(timings),
+            percentiles[49] * 1e6,
+            percentiles[94] * 1e6,
+            percentiles[98] * 1e6,
+        )
+
+
+Benchmark = Callable[[Scenario, int], list[float]]
+
+
+def timed(ops: int, op: Callable[[int], object]) -> list[float]:
+    timings = []
+    for i in range(ops):
+        started = time.perf_counter()
+        op(i)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def seeded_engine(scenario: Scenario, spare: int) -> Engine:
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    orm.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as session:
+        repo = repository.SqlAlchemyRepository(session)
+        for batch in scenario.batches(spare):
+            repo.add(batch)
+        session.commit()
+    return engine
+
+
+def bench_model_allocate(scenario: Scenario, ops: int) -> list[float]:
+    index = model.BatchIndex(scenario.batches(spare=ops))
+
+    def op(i: int) -> None:
+        model.allocate(
+            model.OrderLine(f"order-{i}", f"sku-{i % scenario.skus}", 1), index
+        )
+
+    return timed(ops, op)
+
+
+def bench_available_quantity(scenario: Scenario, ops: int) -> list[float]:
+    batches = list(scenario.batches(spare=1))
+    return timed(ops, lambda i: batches[i % len(batches)].available_quantity)
+
+
+def bench_services_allocate(scenario: Scenario, ops: int) -> list[float]:
+    engine = seeded_engine(scenario, spare=ops)
+    with sessionmaker(bind=engine)() as session:
+        repo = repository.SqlAlchemyRepository(session)
+
+        def op(i: int) -> None:
+            sku = f"sku-{i % scenario.skus}"
+            services.allocate(f"order-{i}", sku, 1, repo=repo, session=session)
+
+        return timed(ops, op)
+
+
+def bench_repository_list_by_sku(scenario: Scenario, ops: int) -> list[float]:
+    engine = seeded_engine(scenario, spare=1)
+    get_session = sessionmaker(bind=engine)
+
+    def op(i: int) -> int:
+        with get_session() as session:  # fresh identity map: full hydration
+            batches = repository.SqlAlchemyRepository(session).list_by_sku(
+                f"sku-{i % scenario.skus}"
+            )
+            return sum(batch.available_quantity for batch in batches)
+
+    return timed(ops, op)
+
+
+BENCHMARKS: dict[str, Benchmark] = {
+    "model.allocate": bench_model_allocate,
+    "Batch.available_quantity": bench_available_quantity,
+    "services.allocate": bench_services_allocate,
+    "SqlAlchemyRepository.list_by_sku": bench_repository_list_by_sku,
+}
+
+
+def run(scenarios: list[Scenario], ops: int, only: str) -> dict[str, Result]:
+    results = {}
+    orm.start_mappers()
+    try:
+        for scenario, (name, bench) in itertools.product(scenarios, BENCHMARKS.items()):
+            if only in name:
+                results[f"{name}[{scenario}]"] = Result.from_timings(
+                    bench(scenario, ops)
+                )
+    finally:
+        clear_mappers()
+    return results
+
+
+def report(
+    results: dict[str, Result], baseline: dict[str, Result], threshold: float
+) -> list[str]:
+    """Print the results table and return the names that regressed."""
+    regressed = []
+    print(
+        f"{'benchmark':<72} {'ops/s':>10} {'p50 us':>9} {'p95 us':>9}"
+        f" {'p99 us':>9} {'vs base':>8}"
+    )
+    for name, result in results.items():
+        line = (
+            f"{name:<72} {result.ops_per_second:>10.0f} {result.p50_us:>9.1f}"
+            f" {result.p95_us:>9.1f} {result.p99_us:>9.1f}"
+        )
+        if name in baseline:
+            change = result.ops_per_second / baseline[name].ops_per_second - 1
+            line += f" {change:>+8.0%}"
+            if change < -threshold:
+                regressed.append(name)
+                line += "  REGRESSION"
+        print(line)
+    return regressed
+
+
+def load(path: Path) -> dict[str, Result]:
+    return {
+        name: Result(**fields) for name, fields in json.loads(path.read_text()).items()
+    }
+
+
+def save(path: Path, results: dict[str, Result]) -> None:
+    path.write_text(
+        json.dumps({name: vars(result) for name, result in results.items()}, indent=2)
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite")
+    parser.add_argument("--skus", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--allocations", type=int, nargs="+", default=[0, 100])
+    parser.add_argument("--ops", type=int, default=200, help="timed calls per case")
+    parser.add_argument("--only", default="", help="run benchmarks matching this")
+    parser.add_argument("--save", type=Path, help="write results as a baseline")
+    parser.add_argument("--compare", type=Path, help="baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    scenarios = [
+        Scenario(*params)
+        for params in itertools.product(args.skus, args.batches, args.allocations)
+    ]
+    results = run(scenarios, args.ops, args.only)
+    baseline = load(args.compare) if args.compare else {}
+    regressed = report(results, baseline, args.threshold)
+    if args.save:
+        save(args.save, results)
+    if regressed:
+        print(
+            f"{len(regressed)} benchmark(s) regressed by more than {args.threshold:.0%}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
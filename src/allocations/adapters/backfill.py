@@ -0,0 +1,94 @@
+"""Rows for batches added before the tables that track them existed.
+
+lock_skus serialises writes to a sku by bumping its skus row, and refuses a
+sku that has batches but no row; the availability read model
+(orm.batch_availability and orm.sku_availability) has no rows for those
+batches either. Run ``python -m allocations.adapters.backfill`` once against
+a database with batches from before those tables; running it again adds
+nothing.
+"""
+
+import argparse
+import sys
+
+from sqlalchemy import create_engine, delete, func, insert, literal, select
+from sqlalchemy.engine import Connection
+
+from allocations import config
+from allocations.adapters import orm
+
+
+def backfill(connection: Connection) -> dict[str, int]:
+    """Add the missing rows and return how many went into each table."""
+    skus = connection.execute(
+        insert(orm.skus).from_select(
+            ["sku", "version_number"],
+            select(orm.batches.c.sku, literal(0))
+            .where(orm.batches.c.sku.not_in(select(orm.skus.c.sku)))
+            .distinct(),
+        )
+    )
+    missing = orm.batches.c.reference.not_in(select(orm.batch_availability.c.reference))
+    # the totals of a sku with missing batches are recounted below, along
+    # with those of skus that have none
+    connection.execute(
+        delete(orm.sku_availability).where(
+            orm.sku_availability.c.sku.in_(select(orm.batches.c.sku).where(missing))
+        )
+    )
+    allocated = (
+        select(
+            orm.allocations.c.batch_id,
+            func.sum(orm.order_lines.c.qty).label("quantity"),
+        )
+        .join(orm.order_lines, orm.order_lines.c.id == orm.allocations.c.orderline_id)
+        .group_by(orm.allocations.c.batch_id)
+        .subquery()
+    )
+    batches = connection.execute(
+        insert(orm.batch_availability).from_select(
+            ["reference", "sku", "eta", "purchased_quantity", "allocated_quantity"],
+            select(
+                orm.batches.c.reference,
+                orm.batches.c.sku,
+                orm.batches.c.eta,
+                orm.batches.c._purchased_quantity,
+                func.coalesce(allocated.c.quantity, 0),
+            )
+            .outerjoin(allocated, allocated.c.batch_id == orm.batches.c.id)
+            .where(missing),
+        )
+    )
+    available = orm.batch_availability.c
+    totals = connection.execute(
+        insert(orm.sku_availability).from_select(
+            ["sku", "batches", "purchased_quantity", "allocated_quantity"],
+            select(
+                available.sku,
+                func.count(),
+                func.sum(available.purchased_quantity),
+                func.sum(available.allocated_quantity),
+            )
+            .where(available.sku.not_in(select(orm.sku_availability.c.sku)))
+            .group_by(available.sku),
+        )
+    )
+    return {
+        "skus": skus.rowcount,
+        "batch_availability": batches.rowcount,
+        "sku_availability": totals.rowcount,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m allocations.adapters.backfill")
+    parser.parse_args(argv)
+    with create_engine(config.get_database_uri()).begin() as connection:
+        added = backfill(connection)
+    for table, rows in added.items():
+        print(f"Added {rows} rows to {table}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from allocations.domain import model
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class BatchCache:
+    """Bounded LRU cache of each sku's version and batches, with a TTL per entry.
+
+    Entries are detached ORM objects with their allocations loaded; they are
+    never mutated in place, callers work on copies merged into their session.
+    """
+
+    def __init__(
+        self, maxsize: int = 1024, ttl: float = 30.0, enabled: bool = True
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, tuple[float, int, list[model.Batch]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, sku: str) -> tuple[int, list[model.Batch]] | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(sku)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(sku, None)
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(sku)
+            self.stats.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, sku: str, batches: list[model.Batch], version: int = 0) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[sku] = (time.monotonic() + self.ttl, version, batches)
+            self._entries.move_to_end(sku)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            self._entries.pop(sku, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class AllocationCache:
+    """Bounded LRU cache of recent (orderid, sku) -> batchref results.
+
+    Lets a retried allocation be answered without reading its order line.
+    Each entry carries the version its sku had when the result was committed
+    or read, as BatchCache entries do, so that a hit can be checked against
+    the sku's current version: a deallocation anywhere moves it on.
+    """
+
+    def __init__(
+        self, maxsize: int = 10_000, ttl: float = 30.0, enabled: bool = True
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.stats = CacheStats()
+        self._entries: OrderedDict[tuple[str, str], tuple[float, int, str]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, orderid: str, sku: str, version: int) -> str | None:
+        """The cached batchref, if it was cached at the sku's ``version``."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get((orderid, sku))
+            if entry is None or entry[0] < time.monotonic() or entry[1] != version:
+                self._entries.pop((orderid, sku), None)
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end((orderid, sku))
+            self.stats.hits += 1
+            return entry[2]
+
+    def put(self, orderid: str, sku: str, batchref: str, version: int = 0) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[orderid, sku] = (
+                time.monotonic() + self.ttl,
+                version,
+                batchref,
+            )
+            self._entries.move_to_end((orderid, sku))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def invalidate(self, orderid: str, sku: str) -> None:
+        with self._lock:
+            self._entries.pop((orderid, sku), None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
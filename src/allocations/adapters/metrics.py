@@ -0,0 +1,145 @@
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Iterator, Mapping
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import Result
+from sqlalchemy.orm import ORMExecuteState, Session
+
+Labels = tuple[tuple[str, str], ...]
+
+# seconds; the last, implicit bucket is +Inf
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)  # fmt: skip
+_NOT_TIMED = nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters and latency histograms, rendered in the Prometheus text format.
+
+    While disabled every call returns straight away, so instrumented code only
+    pays for a method call and an attribute check.
+    """
+
+    def __init__(
+        self, enabled: bool = True, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        self.enabled = enabled
+        self.buckets = buckets
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._histograms: dict[str, dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = tuple(labels.items())
+        with self._lock:
+            samples = self._counters.setdefault(name, {})
+            samples[key] = samples.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = tuple(labels.items())
+        with self._lock:
+            samples = self._histograms.setdefault(name, {})
+            if key not in samples:
+                samples[key] = Histogram(self.buckets)
+            samples[key].observe(seconds)
+
+    def stage(self, name: str) -> AbstractContextManager[None]:
+        """Time the enclosed block into the ``stage_seconds`` histogram."""
+        if not self.enabled:
+            return _NOT_TIMED
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(
+        self, prefix: str = "allocations_", gauges: Mapping[str, float] | None = None
+    ) -> str:
+        lines = []
+        with self._lock:
+            for name, counters in sorted(self._counters.items()):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                for labels, value in counters.items():
+                    lines.append(f"{prefix}{name}{_labels(labels)} {value:g}")
+            for name, histograms in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for labels, histogram in histograms.items():
+                    lines.extend(_histogram_lines(prefix + name, labels, histogram))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _histogram_lines(name: str, labels: Labels, histogram: Histogram) -> list[str]:
+    lines = []
+    cumulative = 0
+    bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+    for bound, count in zip(bounds, histogram.counts, strict=True):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels((*labels, ('le', bound)))} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:g}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+registry = Metrics()
+
+
+def _time_relationship_load(state: ORMExecuteState) -> Result[Any] | None:
+    if not state.is_relationship_load or not registry.enabled:
+        return None
+    with registry.stage("hydrate"):
+        frozen = state.invoke_statement().freeze()
+    registry.inc("rows_loaded_total", len(frozen.data), entity="relationship")
+    return frozen()
+
+
+def instrument_orm() -> None:
+    """Time lazy and eager relationship loads (``Batch._allocations``) as the
+    ``hydrate`` stage, for every session."""
+    if not event.contains(Session, "do_orm_execute", _time_relationship_load):
+        event.listen(Session, "do_orm_execute", _time_relationship_load)
+
+
+def uninstrument_orm() -> None:
+    if event.contains(Session, "do_orm_execute", _time_relationship_load):
+        event.remove(Session, "do_orm_execute", _time_relationship_load)
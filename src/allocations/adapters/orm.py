@@ -1,4 +1,16 @@
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table
+from typing import Any
+
+from sqlalchemy import (
+    Column,
+    Date,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    event,
+)
 from sqlalchemy.orm import registry, relationship
 
 from allocations.domain import model
@@ -13,6 +25,8 @@ order_lines = Table(
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
+    # one line per order and sku, which is what makes allocation idempotent
+    Index("ix_order_lines_orderid_sku", "orderid", "sku", unique=True),
 )
 
 batches = Table(
@@ -20,19 +34,48 @@ batches = Table(
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("reference", String(255)),
-    Column("sku", String(255)),
+    Column("sku", String(255), index=True),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
 )
 
+skus = Table(
+    "skus",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version_number", Integer, nullable=False),
+)
+
 allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), index=True),
     Column("batch_id", ForeignKey("batches.id")),
 )
 
+# the read model: availability per batch and per sku, denormalized so a stock
+# level is one primary-key lookup. The repository keeps both up to date in
+# the transaction that adds a batch or moves its allocated quantity.
+batch_availability = Table(
+    "batch_availability",
+    metadata,
+    Column("reference", String(255), primary_key=True),
+    Column("sku", String(255), nullable=False),
+    Column("eta", Date, nullable=True),
+    Column("purchased_quantity", Integer, nullable=False),
+    Column("allocated_quantity", Integer, nullable=False),
+)
+
+sku_availability = Table(
+    "sku_availability",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("batches", Integer, nullable=False),
+    Column("purchased_quantity", Integer, nullable=False),
+    Column("allocated_quantity", Integer, nullable=False),
+)
+
 
 def start_mappers() -> None:
     lines_mapper = mapper_reg.map_imperatively(model.OrderLine, order_lines)
@@ -44,6 +87,19 @@ def start_mappers() -> None:
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                # a deallocated line is deleted, so the order can be allocated
+                # again without tripping the unique (orderid, sku) index
+                cascade="all, delete-orphan",
+                single_parent=True,
             )
         },
     )
+    event.listen(model.Batch, "load", _reset_allocated_quantity)
+    event.listen(model.Batch, "refresh", _reset_allocated_quantity)
+    event.listen(model.Batch, "expire", _reset_allocated_quantity)
+
+
+def _reset_allocated_quantity(batch: model.Batch, *_: Any) -> None:
+    # the ORM bypasses Batch.__init__, so make the running total recount
+    # from _allocations the first time it is needed
+    batch._allocated_quantity = None
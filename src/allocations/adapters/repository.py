@@ -1,40 +1,585 @@
 import abc
-from typing import Protocol
+import csv
+import io
+from collections import Counter
+from collections.abc import Collection, Iterable, Sequence
+from datetime import date
+from typing import Any, NamedTuple, Protocol
 
-from sqlalchemy.orm import Session
+from sqlalchemy import (
+    bindparam,
+    event,
+    func,
+    insert,
+    literal,
+    select,
+    tuple_,
+    update,
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (
+    Session,
+    joinedload,
+    lazyload,
+    make_transient_to_detached,
+    selectinload,
+)
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm.instrumentation import manager_of_class
+from sqlalchemy.util import await_only
 
+from allocations.adapters import metrics, orm
+from allocations.adapters.cache import AllocationCache, BatchCache
 from allocations.domain import model
 
+BATCH_COLUMNS = ("reference", "sku", "_purchased_quantity", "eta")
+# how list_by_sku(s) loads Batch._allocations; get() and list() stay lazy
+ALLOCATION_LOADERS = {"selectin": selectinload, "joined": joinedload, "lazy": lazyload}
+
+
+class ConcurrentUpdate(Exception):
+    pass
+
+
+class DuplicateBatch(Exception):
+    pass
+
+
+class UnversionedSku(Exception):
+    pass
+
+
+class SavedLine(NamedTuple):
+    id: int
+    orderid: str
+    sku: str
+    qty: int
+
+
+class SavedBatch(NamedTuple):
+    """A batch and its allocated lines as stored, ids included (see restore)."""
+
+    id: int
+    reference: str
+    sku: str
+    purchased_quantity: int
+    eta: date | None
+    lines: list[SavedLine]
+
 
 class AbstractSession(Protocol):
     def commit(self) -> None:
         raise NotImplementedError  # pragma: no cover
 
+    def rollback(self) -> None:
+        raise NotImplementedError  # pragma: no cover
+
 
 class AbstractRepository(abc.ABC):
     @abc.abstractmethod
     def add(self, batch: model.Batch) -> None:
         raise NotImplementedError  # pragma: no cover
 
+    @abc.abstractmethod
+    def add_many(self, batches: Sequence[model.Batch]) -> None:
+        """Insert new batches without tracking them in the session."""
+        raise NotImplementedError  # pragma: no cover
+
     @abc.abstractmethod
     def get(self, reference: str) -> model.Batch:
         raise NotImplementedError  # pragma: no cover
 
+    @abc.abstractmethod
+    def list_by_sku(self, sku: str) -> list[model.Batch]:
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def list_by_skus(self, skus: Collection[str]) -> list[model.Batch]:
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def list_availability(self, sku: str) -> list[model.BatchRecord]:
+        """The sku's batches with their allocated totals, in allocation order."""
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def add_allocation(self, reference: str, line: model.OrderLine) -> None:
+        """Record line as allocated to the batch without loading the batch."""
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def update_availability(self, allocated: Iterable[tuple[str, str, int]]) -> None:
+        """Move the availability read model on by (reference, sku, qty) allocated
+        to loaded batches; a negative qty was deallocated. Batches added and
+        lines added with add_allocation are accounted for already."""
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def get_allocations(
+        self, keys: Collection[tuple[str, str]]
+    ) -> dict[tuple[str, str], str]:
+        """The batchref each already allocated (orderid, sku) went to."""
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def get_by_orderline(self, orderid: str, sku: str) -> model.Batch | None:
+        """The batch the order's line for sku is allocated to, if any."""
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def get_versions(self, skus: Collection[str] | None = None) -> dict[str, int]:
+        """The version of each of ``skus`` that exists, or of every sku, which
+        lock_skus moves on with each write."""
+        raise NotImplementedError  # pragma: no cover
+
+    @abc.abstractmethod
+    def lock_skus(self, skus: Collection[str]) -> None:
+        """Hold the skus for the rest of the transaction, so concurrent writers to
+        the same sku queue up while other skus proceed in parallel."""
+        raise NotImplementedError  # pragma: no cover
+
     @abc.abstractmethod
     def list(self) -> list[model.Batch]:
         raise NotImplementedError  # pragma: no cover
 
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session: Session) -> None:
+    def __init__(self, session: Session, allocations_loading: str = "selectin") -> None:
         super().__init__()
         self.session = session
+        self.load_allocations = ALLOCATION_LOADERS[allocations_loading](
+            model.Batch._allocations  # type: ignore [arg-type]
+        )
+        # version_number of each sku this transaction holds via lock_skus
+        self.versions: dict[str, int] = {}
 
     def add(self, batch: model.Batch) -> None:
+        self._ensure_skus({batch.sku})
+        self._add_availability([batch])
         self.session.add(batch)
 
+    def add_many(self, batches: Sequence[model.Batch]) -> None:
+        self._ensure_skus({batch.sku for batch in batches})
+        self._add_availability(batches)
+        rows = [
+            (batch.reference, batch.sku, batch._purchased_quantity, batch.eta)
+            for batch in batches
+        ]
+        connection = self.session.connection()
+        if connection.dialect.name == "postgresql":
+            self._copy_batches(connection, rows)
+        else:
+            self.session.execute(
+                insert(orm.batches),
+                [dict(zip(BATCH_COLUMNS, row, strict=True)) for row in rows],
+            )
+
+    def _copy_batches(
+        self, connection: Connection, rows: list[tuple[Any, ...]]
+    ) -> None:
+        driver_connection = connection.connection.driver_connection
+        if connection.dialect.driver == "asyncpg":
+            # we are inside run_sync's greenlet, so the coroutine can be awaited
+            await_only(
+                driver_connection.copy_records_to_table(  # type: ignore [union-attr]
+                    "batches", records=rows, columns=BATCH_COLUMNS
+                )
+            )
+            return
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with driver_connection.cursor() as cursor:  # type: ignore [union-attr]
+            cursor.copy_expert(
+                f"COPY batches ({', '.join(BATCH_COLUMNS)}) FROM STDIN WITH CSV",
+                buffer,
+            )
+
+    def _add_availability(self, batches: Sequence[model.Batch]) -> None:
+        try:
+            self.session.execute(
+                insert(orm.batch_availability),
+                [
+                    {
+                        "reference": batch.reference,
+                        "sku": batch.sku,
+                        "eta": batch.eta,
+                        "purchased_quantity": batch._purchased_quantity,
+                        "allocated_quantity": batch.allocated_quantity,
+                    }
+                    for batch in batches
+                ],
+            )
+        except IntegrityError:
+            raise DuplicateBatch(
+                f"Batch {batches[0].reference} already exists"
+                if len(batches) == 1
+                else "Some of the batches already exist"
+            ) from None
+        totals: dict[str, Counter[str]] = {}
+        for batch in batches:
+            total = totals.setdefault(batch.sku, Counter())
+            total["added"] += 1
+            total["purchased"] += batch._purchased_quantity
+            total["allocated"] += batch.allocated_quantity
+        sku_availability = orm.sku_availability.c
+        self.session.execute(
+            update(orm.sku_availability)
+            .where(sku_availability.sku == bindparam("key"))
+            .values(
+                batches=sku_availability.batches + bindparam("added"),
+                purchased_quantity=sku_availability.purchased_quantity
+                + bindparam("purchased"),
+                allocated_quantity=sku_availability.allocated_quantity
+                + bindparam("allocated"),
+            ),
+            [{"key": sku, **total} for sku, total in totals.items()],
+        )
+
     def get(self, reference: str) -> model.Batch:
         return self.session.query(model.Batch).filter_by(reference=reference).one()
 
+    def list_by_sku(self, sku: str) -> list[model.Batch]:
+        batches = (
+            self.session.query(model.Batch)
+            .options(self.load_allocations)
+            .filter_by(sku=sku)
+            .all()
+        )
+        metrics.registry.inc("rows_loaded_total", len(batches), entity="batch")
+        return batches
+
+    def list_by_skus(self, skus: Collection[str]) -> list[model.Batch]:
+        batches = (
+            self.session.query(model.Batch)
+            .options(self.load_allocations)
+            .filter(model.Batch.sku.in_(skus))  # type: ignore [attr-defined]
+            .all()
+        )
+        metrics.registry.inc("rows_loaded_total", len(batches), entity="batch")
+        return batches
+
+    def list_availability(self, sku: str) -> list[model.BatchRecord]:
+        allocated = func.coalesce(func.sum(orm.order_lines.c.qty), 0)
+        rows = self.session.execute(
+            select(
+                orm.batches.c.reference,
+                orm.batches.c.sku,
+                orm.batches.c.eta,
+                orm.batches.c._purchased_quantity,
+                allocated,
+            )
+            .select_from(
+                orm.batches.outerjoin(
+                    orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id
+                ).outerjoin(
+                    orm.order_lines,
+                    orm.order_lines.c.id == orm.allocations.c.orderline_id,
+                )
+            )
+            .where(orm.batches.c.sku == sku)
+            .group_by(orm.batches.c.id)
+            # same order as model.allocate: in stock first, then earliest eta
+            .order_by(orm.batches.c.eta.asc().nulls_first(), orm.batches.c.id)
+        )
+        records = [model.BatchRecord(*row) for row in rows]
+        metrics.registry.inc("rows_loaded_total", len(records), entity="availability")
+        return records
+
+    def add_allocation(self, reference: str, line: model.OrderLine) -> None:
+        try:
+            orderline_id = self.session.execute(
+                insert(orm.order_lines)
+                .values(orderid=line.orderid, sku=line.sku, qty=line.qty)
+                .returning(orm.order_lines.c.id)
+            ).scalar_one()
+        except IntegrityError:
+            raise ConcurrentUpdate(
+                f"Order {line.orderid} was allocated {line.sku} concurrently"
+            ) from None
+        self.session.execute(
+            insert(orm.allocations).from_select(
+                ["orderline_id", "batch_id"],
+                select(literal(orderline_id), orm.batches.c.id).where(
+                    orm.batches.c.reference == reference
+                ),
+            )
+        )
+        self.update_availability([(reference, line.sku, line.qty)])
+
+    def update_availability(self, allocated: Iterable[tuple[str, str, int]]) -> None:
+        by_batch, by_sku = Counter[str](), Counter[str]()
+        for reference, sku, qty in allocated:
+            by_batch[reference] += qty
+            by_sku[sku] += qty
+        # one executemany per table however many lines moved
+        for table, key, moved in (
+            (orm.batch_availability, "reference", by_batch),
+            (orm.sku_availability, "sku", by_sku),
+        ):
+            if not moved:
+                continue
+            self.session.execute(
+                update(table)
+                .where(table.c[key] == bindparam("key"))
+                .values(
+                    allocated_quantity=table.c.allocated_quantity + bindparam("qty")
+                ),
+                [{"key": value, "qty": qty} for value, qty in moved.items()],
+            )
+
+    def get_allocations(
+        self, keys: Collection[tuple[str, str]]
+    ) -> dict[tuple[str, str], str]:
+        if not keys:
+            return {}
+        rows = self.session.execute(
+            select(
+                orm.order_lines.c.orderid,
+                orm.order_lines.c.sku,
+                orm.batches.c.reference,
+            )
+            .join(
+                orm.allocations, orm.allocations.c.orderline_id == orm.order_lines.c.id
+            )
+            .join(orm.batches, orm.batches.c.id == orm.allocations.c.batch_id)
+            .where(tuple_(orm.order_lines.c.orderid, orm.order_lines.c.sku).in_(keys))
+        )
+        return {(orderid, sku): reference for orderid, sku, reference in rows}
+
+    def get_by_orderline(self, orderid: str, sku: str) -> model.Batch | None:
+        # walks the order_lines (orderid, sku) index and the allocations join
+        # table instead of loading every batch of the sku
+        return (
+            self.session.query(model.Batch)
+            .join(orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id)
+            .join(
+                orm.order_lines, orm.order_lines.c.id == orm.allocations.c.orderline_id
+            )
+            .filter(orm.order_lines.c.orderid == orderid, orm.order_lines.c.sku == sku)
+            .first()
+        )
+
+    def restore(self, saved: Iterable[SavedBatch]) -> list[model.Batch]:
+        """Put batches saved outside the database into the session as if just
+        loaded from it: no SELECT, no INSERT and no attribute events, which
+        is how the ORM's own loaders build instances."""
+        new_batch = manager_of_class(model.Batch).new_instance
+        new_line = manager_of_class(model.OrderLine).new_instance
+        restored = []
+        for row in saved:
+            lines = set()
+            for line_row in row.lines:
+                line = new_line()
+                line.__dict__.update(line_row._asdict())
+                make_transient_to_detached(line)
+                lines.add(line)
+            batch = new_batch()
+            batch.__dict__.update(
+                id=row.id,
+                reference=row.reference,
+                sku=row.sku,
+                _purchased_quantity=row.purchased_quantity,
+                eta=row.eta,
+                _allocated_quantity=sum(line.qty for line in row.lines),
+            )
+            set_committed_value(batch, "_allocations", lines)  # type: ignore [no-untyped-call]
+            make_transient_to_detached(batch)
+            restored.append(batch)
+        self.session.add_all(restored)
+        return restored
+
+    def get_versions(self, skus: Collection[str] | None = None) -> dict[str, int]:
+        query = select(orm.skus.c.sku, orm.skus.c.version_number)
+        if skus is not None:
+            query = query.where(orm.skus.c.sku.in_(skus))
+        return dict(self.session.execute(query).tuples().all())
+
+    def lock_skus(self, skus: Collection[str]) -> None:
+        # bumping the version row takes its write lock until commit; going in
+        # sorted order keeps two multi-sku transactions from deadlocking
+        for sku in sorted(skus):
+            version = self.session.execute(
+                update(orm.skus)
+                .where(orm.skus.c.sku == sku)
+                .values(version_number=orm.skus.c.version_number + 1)
+                .returning(orm.skus.c.version_number)
+            ).scalar()
+            if version is not None:
+                self.versions[sku] = version
+            elif self.session.execute(
+                select(literal(True)).where(orm.batches.c.sku == sku).limit(1)
+            ).scalar():
+                # a sku without batches has nothing to lock, but one whose
+                # batches predate the skus table would go unserialised
+                raise UnversionedSku(
+                    f"Sku {sku} has no skus row;"
+                    " run python -m allocations.adapters.backfill"
+                )
+
+    def _ensure_skus(self, skus: set[str]) -> None:
+        existing = self.session.execute(
+            select(orm.skus.c.sku).where(orm.skus.c.sku.in_(skus))
+        ).scalars()
+        missing = skus.difference(existing)
+        if not missing:
+            return
+        try:
+            self.session.execute(
+                insert(orm.skus),
+                [{"sku": sku, "version_number": 0} for sku in sorted(missing)],
+            )
+            self.session.execute(
+                insert(orm.sku_availability),
+                [
+                    {
+                        "sku": sku,
+                        "batches": 0,
+                        "purchased_quantity": 0,
+                        "allocated_quantity": 0,
+                    }
+                    for sku in sorted(missing)
+                ],
+            )
+        except IntegrityError:
+            raise ConcurrentUpdate(
+                f"Skus {', '.join(sorted(missing))} were created concurrently"
+            ) from None
+
     def list(self) -> list[model.Batch]:
         return self.session.query(model.Batch).all()
+
+
+class CachingRepository(SqlAlchemyRepository):
+    """Serves each sku's batches from a process-wide BatchCache when it can.
+
+    Cached batches are merged into the session without a SELECT. Once the
+    session commits, the batches it used replace the cache entries, and skus
+    that gained a batch or were changed outside list_by_skus are invalidated.
+    A rollback changes nothing, because only the merged copies were touched.
+    Entries carry the sku's version, so a locked sku whose version moved on in
+    another process is read fresh.
+
+    With ``recent``, the batchrefs of allocations committed or looked up
+    here are kept too, stamped with their sku's version. A lookup reads the
+    versions of the skus asked about and only trusts entries stamped with
+    the current one, so a deallocation anywhere is never missed.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        cache: BatchCache,
+        allocations_loading: str = "selectin",
+        recent: AllocationCache | None = None,
+    ) -> None:
+        if session.expire_on_commit:
+            raise ValueError("CachingRepository needs expire_on_commit=False")
+        super().__init__(session, allocations_loading)
+        self.cache = cache
+        self.recent = AllocationCache(enabled=False) if recent is None else recent
+        self._seen: dict[str, list[model.Batch]] = {}
+        self._stale: set[str] = set()
+        self._allocated: list[tuple[str, str, str]] = []
+        event.listen(session, "after_flush", self._after_flush)
+        event.listen(session, "after_commit", self._after_commit)
+        event.listen(session, "after_rollback", self._after_rollback)
+
+    def add(self, batch: model.Batch) -> None:
+        super().add(batch)
+        self._stale.add(batch.sku)
+
+    def add_many(self, batches: Sequence[model.Batch]) -> None:
+        super().add_many(batches)
+        self._stale.update(batch.sku for batch in batches)
+
+    def add_allocation(self, reference: str, line: model.OrderLine) -> None:
+        super().add_allocation(reference, line)
+        self._stale.add(line.sku)
+        self._allocated.append((line.orderid, line.sku, reference))
+
+    def get_allocations(
+        self, keys: Collection[tuple[str, str]]
+    ) -> dict[tuple[str, str], str]:
+        if not self.recent.enabled or not keys:
+            return super().get_allocations(keys)
+        # versions first: what is read after them can only be as new as
+        # them or newer, so no entry is stamped with a version older than
+        # its batchref's
+        versions = self.get_versions({sku for _, sku in keys})
+        found, missing = {}, []
+        for orderid, sku in keys:
+            batchref = None
+            if sku in versions:
+                batchref = self.recent.get(orderid, sku, versions[sku])
+            if batchref is None:
+                missing.append((orderid, sku))
+            else:
+                found[orderid, sku] = batchref
+        loaded = super().get_allocations(missing)
+        for (orderid, sku), batchref in loaded.items():
+            self.recent.put(orderid, sku, batchref, versions[sku])
+        return found | loaded
+
+    def get_by_orderline(self, orderid: str, sku: str) -> model.Batch | None:
+        self.recent.invalidate(orderid, sku)
+        batch = super().get_by_orderline(orderid, sku)
+        if batch is not None:
+            # loaded around the cache, so drop the cached copy once committed
+            self._stale.add(batch.sku)
+        return batch
+
+    def list_by_sku(self, sku: str) -> list[model.Batch]:
+        return self.list_by_skus([sku])
+
+    def list_by_skus(self, skus: Collection[str]) -> list[model.Batch]:
+        found, missing = [], []
+        for sku in skus:
+            cached = self.cache.get(sku)
+            if cached is None:
+                missing.append(sku)
+                continue
+            version, cached_batches = cached
+            if sku in self.versions and version != self.versions[sku] - 1:
+                # written by another process since it was cached
+                missing.append(sku)
+                continue
+            batches = [self.session.merge(b, load=False) for b in cached_batches]
+            self._seen[sku] = batches
+            found.extend(batches)
+        if missing:
+            loaded = (
+                self.session.query(model.Batch)
+                .options(self.load_allocations)
+                .filter(model.Batch.sku.in_(missing))  # type: ignore [attr-defined]
+                .all()
+            )
+            metrics.registry.inc("rows_loaded_total", len(loaded), entity="batch")
+            for sku in missing:
+                self._seen[sku] = [b for b in loaded if b.sku == sku]
+            found.extend(loaded)
+        return found
+
+    def _after_flush(self, session: Session, *_: Any) -> None:
+        # lines allocated through the ORM, seen while their history is kept
+        for batch in (*session.new, *session.dirty):
+            if isinstance(batch, model.Batch):
+                for line in get_history(batch, "_allocations").added:
+                    self._allocated.append((line.orderid, line.sku, batch.reference))
+
+    def _after_commit(self, *_: Any) -> None:
+        for sku, batches in self._seen.items():
+            if sku in self.versions and sku not in self._stale:
+                self.cache.put(sku, batches, self.versions[sku])
+        for sku in self._stale:
+            self.cache.invalidate(sku)
+        for orderid, sku, batchref in self._allocated:
+            if sku in self.versions:
+                self.recent.put(orderid, sku, batchref, self.versions[sku])
+        self._seen.clear()
+        self._stale.clear()
+        self._allocated.clear()
+
+    def _after_rollback(self, *_: Any) -> None:
+        self._allocated.clear()
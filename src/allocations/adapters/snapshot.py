@@ -0,0 +1,252 @@
+"""Compact binary snapshots of batches and their allocations.
+
+A snapshot is written from the database every so often and memory-mapped
+when a process starts, so warming up costs a file read instead of loading
+every batch and allocated line from Postgres. Little-endian layout::
+
+    header   magic, format version and the number of strings, skus,
+             batches and lines
+    strings  one u32 end offset per string, then the UTF-8 bytes of all of
+             them back to back; every other record refers to strings by
+             their index
+    skus     (name, version)
+    batches  (id, reference, sku, purchased quantity, eta as a proleptic
+             ordinal or 0 for none)
+    lines    (id, orderid, sku, qty, index of the batch they are allocated to)
+
+Each sku keeps the version it had when the snapshot was taken. Versions are
+read before the batches, so a sku written to while the snapshot was being
+taken is recorded with an older version than it has, never a newer one, and
+comparing versions on restore tells which skus need catching up from the
+database.
+
+Write one with ``python -m allocations.adapters.snapshot PATH``, e.g. from
+cron; workers started with SNAPSHOT_PATH=PATH warm up from it.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Collection, Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocations import config
+from allocations.adapters import orm, repository, sqlite
+from allocations.domain import model
+
+MAGIC = b"ALSN"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<4sHxxIIII")
+STRING_END = struct.Struct("<I")
+SKU = struct.Struct("<Iq")
+BATCH = struct.Struct("<qIIqi")
+LINE = struct.Struct("<qIIqI")
+
+DUMP_CHUNK_SIZE = 1_000  # skus per query when reading batches to snapshot
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+class _Strings:
+    def __init__(self) -> None:
+        self.index: dict[str, int] = {}
+
+    def __call__(self, value: str) -> int:
+        return self.index.setdefault(value, len(self.index))
+
+
+def write(
+    path: Path, batches: Iterable[model.Batch], versions: Mapping[str, int]
+) -> None:
+    """Write a snapshot of loaded batches (with their ids) and sku versions.
+
+    The file is written next to ``path`` and renamed over it, so a reader
+    never sees half a snapshot.
+    """
+    strings = _Strings()
+    skus = [SKU.pack(strings(sku), version) for sku, version in versions.items()]
+    batch_records, line_records = [], []
+    for i, batch in enumerate(batches):
+        batch_records.append(
+            BATCH.pack(
+                batch.id,  # type: ignore [attr-defined]
+                strings(batch.reference),
+                strings(batch.sku),
+                batch._purchased_quantity,
+                batch.eta.toordinal() if batch.eta else 0,
+            )
+        )
+        for line in batch.allocations:
+            line_records.append(
+                LINE.pack(
+                    line.id,  # type: ignore [attr-defined]
+                    strings(line.orderid),
+                    strings(line.sku),
+                    line.qty,
+                    i,
+                )
+            )
+    encoded = [value.encode() for value in strings.index]
+    ends, end = [], 0
+    for value in encoded:
+        end += len(value)
+        ends.append(STRING_END.pack(end))
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        len(encoded),
+        len(skus),
+        len(batch_records),
+        len(line_records),
+    )
+    partial = path.with_name(path.name + ".partial")
+    with partial.open("wb") as f:
+        for chunk in (header, *ends, *encoded, *skus, *batch_records, *line_records):
+            f.write(chunk)
+        # on disk before it replaces the old snapshot, or a crash could
+        # leave an empty or partial file under the final name
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+def dump(repo: repository.AbstractRepository, path: Path) -> int:
+    """Snapshot every batch in the repository; returns the number written."""
+    versions = repo.get_versions()  # before the batches, see the module doc
+    skus = sorted(versions)
+    batches = []
+    for start in range(0, len(skus), DUMP_CHUNK_SIZE):
+        batches.extend(repo.list_by_skus(skus[start : start + DUMP_CHUNK_SIZE]))
+    write(path, batches, versions)
+    return len(batches)
+
+
+class Snapshot:
+    """A snapshot file mapped into memory; see ``open_snapshot``."""
+
+    def __init__(self, buffer: mmap.mmap) -> None:
+        if len(buffer) < HEADER.size:
+            raise InvalidSnapshot("Snapshot is truncated")
+        magic, version, *counts = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise InvalidSnapshot(f"Not a version {FORMAT_VERSION} snapshot")
+        self._buffer = buffer
+        n_strings, n_skus, n_batches, n_lines = counts
+        ends_at = HEADER.size + n_strings * STRING_END.size
+        if len(buffer) < ends_at:
+            raise InvalidSnapshot("Snapshot is truncated")
+        ends = struct.unpack_from(f"<{n_strings}I", buffer, HEADER.size)
+        self._skus_at = ends_at + (ends[-1] if ends else 0)
+        self._batches_at = self._skus_at + n_skus * SKU.size
+        self._lines_at = self._batches_at + n_batches * BATCH.size
+        if len(buffer) != self._lines_at + n_lines * LINE.size:
+            raise InvalidSnapshot("Snapshot is truncated")
+        self._n_skus, self._n_batches, self._n_lines = n_skus, n_batches, n_lines
+        starts = (0, *ends)[:-1]
+        try:
+            self.strings = [
+                str(buffer[ends_at + start : ends_at + end], "utf-8")
+                for start, end in zip(starts, ends, strict=True)
+            ]
+        except UnicodeDecodeError as e:
+            raise InvalidSnapshot(f"Snapshot is damaged: {e}") from e
+
+    def _records(
+        self, record: struct.Struct, at: int, count: int
+    ) -> list[tuple[Any, ...]]:
+        with memoryview(self._buffer) as view:
+            return list(record.iter_unpack(view[at : at + count * record.size]))
+
+    @property
+    def versions(self) -> dict[str, int]:
+        try:
+            return {
+                self.strings[sku]: version
+                for sku, version in self._records(SKU, self._skus_at, self._n_skus)
+            }
+        except IndexError as e:
+            raise InvalidSnapshot(f"Snapshot is damaged: {e}") from e
+
+    def batches(
+        self, skus: Collection[str] | None = None
+    ) -> list[repository.SavedBatch]:
+        """The saved batches (all, or those for ``skus``) with their allocated
+        lines, ready for SqlAlchemyRepository.restore."""
+        # a damaged record refers to a string or batch the snapshot does not
+        # have, or to a date that does not exist
+        try:
+            return self._batches(skus)
+        except (IndexError, ValueError) as e:
+            raise InvalidSnapshot(f"Snapshot is damaged: {e}") from e
+
+    def _batches(self, skus: Collection[str] | None) -> list[repository.SavedBatch]:
+        strings = self.strings
+        wanted = None
+        if skus is not None:
+            ids = {value: i for i, value in enumerate(strings)}
+            wanted = {ids[sku] for sku in skus if sku in ids}
+        batches: list[repository.SavedBatch | None] = []
+        for id_, reference, sku, qty, eta in self._records(
+            BATCH, self._batches_at, self._n_batches
+        ):
+            if wanted is not None and sku not in wanted:
+                batches.append(None)
+                continue
+            batches.append(
+                repository.SavedBatch(
+                    id_,
+                    strings[reference],
+                    strings[sku],
+                    qty,
+                    date.fromordinal(eta) if eta else None,
+                    [],
+                )
+            )
+        for id_, orderid, sku, qty, batch_index in self._records(
+            LINE, self._lines_at, self._n_lines
+        ):
+            owner = batches[batch_index]
+            if owner is not None:
+                owner.lines.append(
+                    repository.SavedLine(id_, strings[orderid], strings[sku], qty)
+                )
+        return [batch for batch in batches if batch is not None]
+
+
+@contextmanager
+def open_snapshot(path: Path) -> Iterator[Snapshot]:
+    with path.open("rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise InvalidSnapshot("Snapshot is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield Snapshot(buffer)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m allocations.adapters.snapshot")
+    parser.add_argument("path", type=Path)
+    args = parser.parse_args(argv)
+    orm.start_mappers()
+    database_uri = config.get_database_uri()
+    engine = create_engine(database_uri)
+    if sqlite.is_sqlite(database_uri):
+        sqlite.tune(engine, config.get_sqlite_settings())
+    with sessionmaker(bind=engine)() as session:
+        written = dump(repository.SqlAlchemyRepository(session), args.path)
+    print(f"Wrote {written} batches to {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""SQLite as the database, for single-node deployments.
+
+Every connection is put in WAL mode and gets the pragmas from
+config.get_sqlite_settings. In WAL mode a reader sees the last commit
+before it began and neither waits for the writer nor holds it up, but only
+on a connection of its own: the API reads from a second engine (READ_ONLY),
+whose transactions begin deferred and never take the write lock. An
+in-memory database lives and dies with its one connection, so there reads
+share the writer's connection and queue with the writes (is_memory).
+
+SQLite takes one writer at a time. Transactions here start with BEGIN
+IMMEDIATE, taking the write lock up front: a transaction that read first
+and took the lock only on its first write could find another connection
+had written in between, and fail with "database is locked" instead of
+waiting for it. The API keeps a single connection (POOL), so its own
+requests queue for it in the pool and hand it over as soon as one commits;
+other processes writing the same file wait in SQLite's busy handler, up to
+busy_timeout.
+"""
+
+from collections.abc import Mapping
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine, make_url
+
+# one connection per engine: the pool is where writers wait their turn
+POOL = {"pool_size": 1, "max_overflow": 0}
+# pragmas for the engine the API reads from, on top of the configured ones
+READ_ONLY = {"query_only": "ON"}
+
+
+def tune(engine: Engine, pragmas: Mapping[str, Any], immediate: bool = True) -> None:
+    """Apply ``pragmas`` to each new connection and begin every transaction
+    with BEGIN IMMEDIATE, or a deferred BEGIN when not ``immediate`` (for
+    async engines, pass ``engine.sync_engine``)."""
+    statement = "BEGIN IMMEDIATE" if immediate else "BEGIN"
+
+    def connect(dbapi_connection: Any, _: Any) -> None:
+        # stop the driver from issuing its own, deferred BEGIN
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    def begin(connection: Connection) -> None:
+        connection.exec_driver_sql(statement)
+
+    event.listen(engine, "connect", connect)
+    event.listen(engine, "begin", begin)
+
+
+def is_sqlite(database_uri: str) -> bool:
+    return make_url(database_uri).get_backend_name() == "sqlite"
+
+
+def is_memory(database_uri: str) -> bool:
+    return make_url(database_uri).database in (None, "", ":memory:")
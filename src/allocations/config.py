@@ -1,15 +1,148 @@
+import logging
 import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
 
 
-def get_postgres_uri() -> str:
+def get_postgres_uri(driver: str = "") -> str:
     host = os.environ.get("DB_HOST", "localhost")
     port = 54321 if host == "localhost" else 5432
     password = os.environ.get("DB_PASSWORD", "abc123")
     user, db_name = "allocation", "allocation"
-    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+    scheme = f"postgresql+{driver}" if driver else "postgresql"
+    return f"{scheme}://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_async_postgres_uri() -> str:
+    return get_postgres_uri(driver="asyncpg")
+
+
+def get_database_backend() -> str:
+    # postgres, or sqlite for a single node (see adapters.sqlite)
+    return os.environ.get("DB_BACKEND", "postgres")
+
+
+def get_sqlite_uri(driver: str = "") -> str:
+    scheme = f"sqlite+{driver}" if driver else "sqlite"
+    return f"{scheme}:///{os.environ.get('SQLITE_PATH', 'allocations.db')}"
+
+
+def get_database_uri() -> str:
+    if get_database_backend() == "sqlite":
+        return get_sqlite_uri()
+    return get_postgres_uri()
+
+
+def get_async_database_uri() -> str:
+    if get_database_backend() == "sqlite":
+        return get_sqlite_uri(driver="aiosqlite")
+    return get_async_postgres_uri()
+
+
+def get_sqlite_settings() -> dict[str, Any]:
+    # PRAGMAs run on every new SQLite connection; NORMAL synchronous is safe
+    # in WAL mode, a crash can only lose the last commits, not corrupt
+    return {
+        "journal_mode": "WAL",
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+        "cache_size": -1024 * int(os.environ.get("SQLITE_CACHE_MB", 64)),
+        "mmap_size": 2**20 * int(os.environ.get("SQLITE_MMAP_MB", 256)),
+        "temp_store": "MEMORY",
+    }
+
+
+def get_pool_settings() -> dict[str, int]:
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", -1)),
+    }
+
+
+def get_batch_cache_settings() -> dict[str, Any]:
+    return {
+        "enabled": os.environ.get("BATCH_CACHE_ENABLED", "1") == "1",
+        "maxsize": int(os.environ.get("BATCH_CACHE_MAXSIZE", 1024)),
+        "ttl": float(os.environ.get("BATCH_CACHE_TTL", 30)),
+    }
+
+
+def get_allocation_cache_settings() -> dict[str, Any]:
+    return {
+        "enabled": os.environ.get("ALLOCATION_CACHE_ENABLED", "1") == "1",
+        "maxsize": int(os.environ.get("ALLOCATION_CACHE_MAXSIZE", 10_000)),
+        "ttl": float(os.environ.get("ALLOCATION_CACHE_TTL", 30)),
+    }
+
+
+def get_repository_settings() -> dict[str, Any]:
+    # selectin, joined or lazy; see repository.ALLOCATION_LOADERS
+    return {"allocations_loading": os.environ.get("ALLOCATIONS_LOADING", "selectin")}
+
+
+def get_allocation_settings() -> dict[str, Any]:
+    # sum availability in the database instead of loading allocated lines
+    return {"in_sql": os.environ.get("ALLOCATE_IN_SQL", "0") == "1"}
+
+
+def get_group_commit_settings() -> dict[str, Any]:
+    # queue /allocate requests and commit them in groups (allocate_many)
+    return {
+        "enabled": os.environ.get("GROUP_COMMIT", "0") == "1",
+        "max_delay": float(os.environ.get("GROUP_COMMIT_MAX_DELAY_MS", 2)) / 1000,
+        "max_size": int(os.environ.get("GROUP_COMMIT_MAX_SIZE", 100)),
+    }
+
+
+def get_partition_settings() -> dict[str, Any]:
+    # route writes to per-sku worker processes; 0 partitions means one per core
+    return {
+        "enabled": os.environ.get("PARTITIONED", "0") == "1",
+        "partitions": int(os.environ.get("PARTITIONS", 0)) or None,
+        # adapters.snapshot file the workers warm up from, if it exists
+        "snapshot": Path(path) if (path := os.environ.get("SNAPSHOT_PATH")) else None,
+    }
+
+
+def get_serialization_settings() -> dict[str, Any]:
+    # parse the hot endpoints' bodies straight from bytes and encode their
+    # responses with orjson (the fast-json extra)
+    return {"fast": os.environ.get("FAST_JSON", "0") == "1"}
+
+
+def get_metrics_settings() -> dict[str, Any]:
+    return {"enabled": os.environ.get("METRICS_ENABLED", "1") == "1"}
 
 
 def get_api_url() -> str:
     host = os.environ.get("API_HOST", "localhost")
     port = 5002 if host == "localhost" else 80
     return f"http://{host}:{port}"
+
+
+def get_log_level() -> int:
+    return logging.getLevelNamesMapping()[os.environ.get("LOG_LEVEL", "INFO")]
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Everything the API needs to start, read from the environment when the
+    settings are created. Override fields to run against another database."""
+
+    database_uri: str = field(default_factory=get_async_database_uri)
+    pool: dict[str, int] = field(default_factory=get_pool_settings)
+    sqlite: dict[str, Any] = field(default_factory=get_sqlite_settings)
+    batch_cache: dict[str, Any] = field(default_factory=get_batch_cache_settings)
+    allocation_cache: dict[str, Any] = field(
+        default_factory=get_allocation_cache_settings
+    )
+    repository: dict[str, Any] = field(default_factory=get_repository_settings)
+    allocation: dict[str, Any] = field(default_factory=get_allocation_settings)
+    group_commit: dict[str, Any] = field(default_factory=get_group_commit_settings)
+    partitioned: dict[str, Any] = field(default_factory=get_partition_settings)
+    serialization: dict[str, Any] = field(default_factory=get_serialization_settings)
+    metrics: dict[str, Any] = field(default_factory=get_metrics_settings)
+    log_level: int = field(default_factory=get_log_level)
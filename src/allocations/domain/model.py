@@ -1,4 +1,6 @@
 # from pydantic.dataclasses import dataclass
+from bisect import insort
+from collections.abc import Iterable, Set
 from dataclasses import dataclass
 from datetime import date
 
@@ -21,26 +23,46 @@ class Batch:  # example of entity object
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations: set[OrderLine] = set()
+        # running total of _allocations; None means "recount on next read",
+        # which is how the ORM marks batches it has just loaded
+        self._allocated_quantity: int | None = 0
 
     def allocate(self, line: OrderLine) -> None:
+        if line in self._allocations:
+            return
+        allocated = self.allocated_quantity
         self._allocations.add(line)
+        self._allocated_quantity = allocated + line.qty
 
     @property
-    def allocated_quantity(self) -> PositiveInt:
-        return PositiveInt(sum(line.qty for line in self._allocations))
+    def allocated_quantity(self) -> int:
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
-    def available_quantity(self) -> PositiveInt:
-        return PositiveInt(self._purchased_quantity - self.allocated_quantity)
+    def available_quantity(self) -> int:
+        return self._purchased_quantity - self.allocated_quantity
 
     def can_allocate(self, line: OrderLine) -> bool:
-        if line in self._allocations:
+        if self.sku == line.sku and self.available_quantity >= line.qty:
             return True
-        return self.sku == line.sku and self.available_quantity >= line.qty
+        return line in self._allocations
+
+    @property
+    def allocations(self) -> Set[OrderLine]:
+        return self._allocations
+
+    def allocation_for(self, orderid: str) -> OrderLine | None:
+        return next(
+            (line for line in self._allocations if line.orderid == orderid), None
+        )
 
     def deallocate(self, line: OrderLine) -> None:
         if line in self._allocations:
+            allocated = self.allocated_quantity
             self._allocations.remove(line)
+            self._allocated_quantity = allocated - line.qty
 
     def __eq__(
         self, other: object
@@ -62,13 +84,128 @@ class Batch:  # example of entity object
         return self.eta > other.eta
 
 
+# The mapped classes above can't use __slots__: SQLAlchemy keeps each instance's
+# state in its __dict__. The records below are their unmapped, slotted
+# counterparts for holding large numbers of batches and lines read-only, as in
+# reports and cache warm-up.
+
+
+@dataclass(frozen=True, slots=True)
+class OrderLineRecord:  # same value semantics as OrderLine
+    orderid: str
+    sku: str
+    qty: int
+
+    @classmethod
+    def from_line(cls, line: OrderLine) -> "OrderLineRecord":
+        return cls(line.orderid, line.sku, line.qty)
+
+
+@dataclass(slots=True, eq=False)
+class BatchRecord:  # same entity semantics as Batch, minus the allocated lines
+    reference: str
+    sku: str
+    eta: date | None
+    purchased_quantity: int
+    allocated_quantity: int = 0
+
+    @classmethod
+    def from_batch(cls, batch: Batch) -> "BatchRecord":
+        return cls(
+            batch.reference,
+            batch.sku,
+            batch.eta,
+            batch._purchased_quantity,
+            batch.allocated_quantity,
+        )
+
+    @property
+    def available_quantity(self) -> int:
+        return self.purchased_quantity - self.allocated_quantity
+
+    def can_allocate(self, line: OrderLine) -> bool:
+        return self.sku == line.sku and self.available_quantity >= line.qty
+
+    def __eq__(self, other: object) -> bool:
+        # like OrderLineRecord and OrderLine, a record never equals a Batch:
+        # Batch.__eq__ knows nothing of records, and equality must be
+        # symmetric
+        if not isinstance(other, BatchRecord):
+            return False
+        return self.reference == other.reference
+
+    def __hash__(self) -> int:
+        return hash(self.reference)
+
+
+def _priority(batch: Batch) -> tuple[bool, date]:
+    # same order as sorted(batches): in-stock (no eta) first, then earliest eta
+    return batch.eta is not None, batch.eta or date.min
+
+
+class BatchIndex:
+    """Batches with stock left, grouped per sku in allocation priority order.
+
+    Used-up batches are left out, so allocating never scans past them:
+    allocate drops a batch once it has used it up, and a batch that a
+    deallocation restocks goes back in with update. A sku stays in the index
+    when all of its batches are used up, so it is out of stock rather than
+    unknown. Callers answer replays themselves, since the batch holding a
+    line may be used up and left out. An index pays off for as long as its
+    batches live: the partition engine keeps one per worker, while
+    services.allocate builds one per request and so only saves scanning
+    the used-up batches.
+    """
+
+    def __init__(self, batches: Iterable[Batch] = ()) -> None:
+        self._by_sku: dict[str, list[Batch]] = {}
+        for batch in batches:
+            in_stock = self._by_sku.setdefault(batch.sku, [])
+            if batch.available_quantity > 0:
+                in_stock.append(batch)
+        for in_stock in self._by_sku.values():
+            in_stock.sort(key=_priority)
+
+    def update(self, batch: Batch) -> None:
+        """Index a new batch, or put a batch whose stock changed in or out."""
+        in_stock = self._by_sku.setdefault(batch.sku, [])
+        indexed = batch in in_stock
+        if batch.available_quantity > 0 and not indexed:
+            insort(in_stock, batch, key=_priority)
+        elif batch.available_quantity <= 0 and indexed:
+            in_stock.remove(batch)
+
+    def batches(self, sku: str) -> list[Batch]:
+        return self._by_sku.get(sku, [])
+
+    def __contains__(self, sku: object) -> bool:
+        return sku in self._by_sku
+
+
 class OutOfStock(Exception):
     pass
 
 
-def allocate(line: OrderLine, batches: list[Batch]) -> str:  # example of service object
-    for batch in sorted(batches):
+def allocate(
+    line: OrderLine, batches: Iterable[Batch] | BatchIndex
+) -> str:  # example of service object
+    if isinstance(batches, BatchIndex):
+        candidates = batches.batches(line.sku)
+    else:
+        candidates = sorted(batches)
+    for batch in candidates:
         if batch.can_allocate(line):
             batch.allocate(line)
+            if isinstance(batches, BatchIndex) and batch.available_quantity <= 0:
+                batches.update(batch)
             return batch.reference
     raise OutOfStock(f"Out of stock for sku {line.sku}")
+
+
+def allocate_record(line: OrderLine, records: Iterable[BatchRecord]) -> BatchRecord:
+    """Like allocate, over records that are already in priority order."""
+    for record in records:
+        if record.can_allocate(line):
+            record.allocated_quantity += line.qty
+            return record
+    raise OutOfStock(f"Out of stock for sku {line.sku}")
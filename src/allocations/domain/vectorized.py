@@ -0,0 +1,129 @@
+"""Columnar allocation engine for large offline runs.
+
+Gives the same answers as calling model.allocate once per line, in order,
+against batches sorted the same way, but works on NumPy arrays: lines are
+grouped per sku, and each run of consecutive lines that fits in the first
+batch with room left is placed with a cumulative sum and a binary search
+instead of one Python call per line. Needs the ``vectorized`` extra (numpy).
+
+Lines are expected to be new orders: unlike Batch.allocate, the engine does
+not treat a line that is already allocated as a no-op.
+"""
+
+from collections.abc import Iterable
+from dataclasses import dataclass
+from itertools import chain
+
+import numpy as np
+import numpy.typing as npt
+
+from allocations.domain.model import Batch, BatchRecord, OrderLine, OrderLineRecord
+
+UNALLOCATED = -1
+
+
+@dataclass(frozen=True)
+class LineColumns:
+    orderids: npt.NDArray[np.object_]
+    skus: npt.NDArray[np.object_]
+    qtys: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[OrderLine | OrderLineRecord]) -> "LineColumns":
+        lines = list(lines)
+        return cls(
+            np.array([line.orderid for line in lines], dtype=object),
+            np.array([line.sku for line in lines], dtype=object),
+            np.array([line.qty for line in lines], dtype=np.int64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.qtys)
+
+
+@dataclass(frozen=True)
+class BatchColumns:
+    references: npt.NDArray[np.object_]
+    skus: npt.NDArray[np.object_]
+    etas: npt.NDArray[np.datetime64]  # NaT for batches already in stock
+    available: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_batches(cls, batches: Iterable[Batch | BatchRecord]) -> "BatchColumns":
+        batches = list(batches)
+        return cls(
+            np.array([batch.reference for batch in batches], dtype=object),
+            np.array([batch.sku for batch in batches], dtype=object),
+            np.array([batch.eta or "NaT" for batch in batches], dtype="datetime64[D]"),
+            np.array([batch.available_quantity for batch in batches], dtype=np.int64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.available)
+
+
+def allocate(lines: LineColumns, batches: BatchColumns) -> npt.NDArray[np.int64]:
+    """Allocate every line, in order, and return the chosen batch per line.
+
+    The result holds an index into ``batches`` for each line, or UNALLOCATED
+    where model.allocate would have raised OutOfStock. ``batches.available``
+    is updated in place.
+    """
+    result = np.full(len(lines), UNALLOCATED, dtype=np.int64)
+    if not len(lines) or not len(batches):
+        return result
+    skus: dict[str, int] = {}  # sku -> small int, cheaper to sort than str
+    codes = np.fromiter(
+        (skus.setdefault(sku, len(skus)) for sku in chain(lines.skus, batches.skus)),
+        dtype=np.int64,
+        count=len(lines) + len(batches),
+    )
+    line_codes, batch_codes = codes[: len(lines)], codes[len(lines) :]
+    # NaT is the smallest datetime64 once viewed as int64, so in-stock batches
+    # come first, then by eta; lexsort is stable, like sorted(batches)
+    batch_order = np.lexsort((batches.etas.view(np.int64), batch_codes))
+    batch_bounds = np.searchsorted(batch_codes[batch_order], np.arange(len(skus) + 1))
+    line_order = np.argsort(line_codes, kind="stable")
+    line_bounds = np.searchsorted(line_codes[line_order], np.arange(len(skus) + 1))
+    for code in range(len(skus)):
+        line_idx = line_order[line_bounds[code] : line_bounds[code + 1]]
+        batch_idx = batch_order[batch_bounds[code] : batch_bounds[code + 1]]
+        if not len(line_idx) or not len(batch_idx):
+            continue
+        available = batches.available[batch_idx]
+        chosen = _allocate_sku(lines.qtys[line_idx], available)
+        batches.available[batch_idx] = available
+        allocated = chosen != UNALLOCATED
+        result[line_idx[allocated]] = batch_idx[chosen[allocated]]
+    return result
+
+
+def _allocate_sku(
+    qtys: npt.NDArray[np.int64], available: npt.NDArray[np.int64]
+) -> npt.NDArray[np.int64]:
+    # First fit over batches already in priority order. ``first`` is the
+    # leading batch that can still take some remaining line; every line in a
+    # run whose running total fits in it goes there. The line ending the run
+    # is placed on its own, then the next run starts.
+    chosen = np.full(len(qtys), UNALLOCATED, dtype=np.int64)
+    totals = np.concatenate([[0], np.cumsum(qtys)])
+    smallest_left = np.minimum.accumulate(qtys[::-1])[::-1]
+    first, i = 0, 0
+    while i < len(qtys):
+        while first < len(available) and available[first] < smallest_left[i]:
+            first += 1
+        if first == len(available):
+            break
+        end = np.searchsorted(totals, totals[i] + available[first], side="right") - 1
+        if end > i:
+            chosen[i:end] = first
+            available[first] -= totals[end] - totals[i]
+            i = end
+            continue
+        fits = available[first:] >= qtys[i]
+        if fits.any():
+            batch = first + int(fits.argmax())
+            chosen[i] = batch
+            available[batch] -= qtys[i]
+        i += 1
+    return chosen
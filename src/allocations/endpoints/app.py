@@ -1,24 +1,244 @@
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
+import csv
+from dataclasses import dataclass
 from datetime import date
+from importlib.util import find_spec
 import logging
+import threading
+import time
+from typing import Annotated, Any, TypeVar
 
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, PositiveInt
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from fastapi import APIRouter, Depends, FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import (
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+)
+from pydantic import BaseModel, PositiveInt, ValidationError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import Session, clear_mappers
 
 from allocations import config
-from allocations.adapters import orm, repository
+from allocations.adapters import cache, metrics, orm, pool, repository, sqlite
 from allocations.domain import model
-from allocations.service_layer import services
+from allocations.service_layer import group_commit, partitioned, services, views
 
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+router = APIRouter()
+# the hot endpoints again, without FastAPI's body and response_model handling
+fast_router = APIRouter()
+
+
+@dataclass
+class Resources:
+    """The engine, caches and service choices one worker process builds when
+    the app starts, shared by the requests that worker serves."""
+
+    engine: AsyncEngine
+    get_session: async_sessionmaker[AsyncSession]
+    # the engine the availability views read from: engine itself, except on
+    # an SQLite file (see adapters.sqlite)
+    read_engine: AsyncEngine
+    get_read_session: async_sessionmaker[AsyncSession]
+    batch_cache: cache.BatchCache
+    recent_allocations: cache.AllocationCache
+    repository_settings: dict[str, Any]
+    allocate_service: Callable[..., str]
+    group_commit: group_commit.GroupCommit | None
+    allocator: partitioned.PartitionedAllocator | None
+
+    @classmethod
+    def from_settings(cls, settings: config.Settings) -> "Resources":
+        pool_settings = dict(settings.pool)
+        if sqlite.is_sqlite(settings.database_uri):
+            pool_settings.update(sqlite.POOL)
+        engine = create_async_engine(
+            settings.database_uri,
+            poolclass=pool.InstrumentedAsyncQueuePool,
+            **pool_settings,
+        )
+        read_engine = engine
+        if sqlite.is_sqlite(settings.database_uri):
+            sqlite.tune(engine.sync_engine, settings.sqlite)
+            if not sqlite.is_memory(settings.database_uri):
+                read_engine = create_async_engine(
+                    settings.database_uri,
+                    poolclass=pool.InstrumentedAsyncQueuePool,
+                    **settings.pool,
+                )
+                sqlite.tune(
+                    read_engine.sync_engine,
+                    {**settings.sqlite, **sqlite.READ_ONLY},
+                    immediate=False,
+                )
+        resources = cls(
+            engine=engine,
+            # expire_on_commit=False keeps committed batches loaded so they
+            # can be cached
+            get_session=async_sessionmaker(bind=engine, expire_on_commit=False),
+            read_engine=read_engine,
+            get_read_session=async_sessionmaker(bind=read_engine),
+            batch_cache=cache.BatchCache(**settings.batch_cache),
+            recent_allocations=cache.AllocationCache(**settings.allocation_cache),
+            repository_settings=settings.repository,
+            allocate_service=(
+                services.allocate_in_sql
+                if settings.allocation["in_sql"]
+                else services.allocate
+            ),
+            group_commit=None,
+            allocator=None,
+        )
+        partition_settings = dict(settings.partitioned)
+        if partition_settings.pop("enabled"):
+            resources.allocator = partitioned.PartitionedAllocator(
+                settings.database_uri,
+                pragmas=(
+                    settings.sqlite if sqlite.is_sqlite(settings.database_uri) else None
+                ),
+                **partition_settings,
+            )
+        group_settings = dict(settings.group_commit)
+        if group_settings.pop("enabled"):
+            resources.group_commit = group_commit.GroupCommit(
+                resources.get_session,
+                repo_factory=resources.caching_repository,
+                **group_settings,
+            )
+        return resources
+
+    def caching_repository(self, session: Session) -> repository.AbstractRepository:
+        return repository.CachingRepository(
+            session,
+            self.batch_cache,
+            recent=self.recent_allocations,
+            **self.repository_settings,
+        )
+
+
+# apps started in this process and not yet stopped; see create_app
+_running = 0
+_running_lock = threading.Lock()
+
+
+def _start_process_state(settings: config.Settings) -> None:
+    global _running
+    with _running_lock:
+        if not _running:
+            orm.start_mappers()
+            metrics.registry.enabled = settings.metrics["enabled"]
+            if metrics.registry.enabled:
+                metrics.instrument_orm()
+        _running += 1
+
+
+def _stop_process_state() -> None:
+    global _running
+    with _running_lock:
+        _running -= 1
+        if not _running:
+            metrics.uninstrument_orm()
+            clear_mappers()
+
+
+def create_app(settings: config.Settings | None = None) -> FastAPI:
+    """Build the API without touching the database or global state.
+
+    Logging, the ORM mappers, metrics instrumentation and the engine are set
+    up when the app starts (once per worker process) and torn down when it
+    stops, so importing this module stays cheap and workers forked from a
+    parent that imported it share no connections or caches. ``settings`` are
+    read from the environment at startup when not given, except the
+    serialization mode: it decides the routes, so it is read here.
+
+    Each app has an engine and caches of its own, but the mappers and the
+    metrics registry belong to the process: when apps run side by side the
+    first to start sets them up, with its metrics setting, and the last to
+    stop tears them down.
+    """
+    serialization = (
+        settings.serialization
+        if settings is not None
+        else config.get_serialization_settings()
+    )
+    if serialization["fast"] and find_spec("orjson") is None:
+        raise RuntimeError("Fast serialization needs the fast-json extra (orjson)")
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        started = settings or config.Settings()
+        logging.basicConfig(level=started.log_level)
+        _start_process_state(started)
+        try:
+            resources = Resources.from_settings(started)
+        except Exception:
+            _stop_process_state()
+            raise
+        if resources.group_commit is not None:
+            resources.group_commit.start()
+        if resources.allocator is not None:
+            resources.allocator.start()
+        app.state.resources = resources
+        try:
+            yield
+        finally:
+            if resources.group_commit is not None:
+                await resources.group_commit.close()
+            if resources.allocator is not None:
+                resources.allocator.close()
+            await resources.engine.dispose()
+            if resources.read_engine is not resources.engine:
+                await resources.read_engine.dispose()
+            _stop_process_state()
+
+    app = FastAPI(lifespan=lifespan)
+    if serialization["fast"]:
+        # routes match in order, so these shadow their counterparts in router
+        app.include_router(fast_router)
+    app.include_router(router)
+    return app
+
+
+# async, or FastAPI would run it on the thread pool for every request
+async def get_resources(request: Request) -> Resources:
+    resources: Resources = request.app.state.resources
+    return resources
+
+
+Worker = Annotated[Resources, Depends(get_resources)]
 
-orm.start_mappers()
-get_session = sessionmaker(bind=create_engine(config.get_postgres_uri()))
-app = FastAPI()
+
+async def db_session(resources: Worker) -> AsyncIterator[AsyncSession]:
+    session = resources.get_session()
+    try:
+        yield session
+    finally:
+        # close() rolls back whatever the request left uncommitted and hands
+        # the connection back to the pool straight away
+        await session.close()
+
+
+DbSession = Annotated[AsyncSession, Depends(db_session)]
+
+
+async def read_session(resources: Worker) -> AsyncIterator[AsyncSession]:
+    session = resources.get_read_session()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+
+ReadSession = Annotated[AsyncSession, Depends(read_session)]
 
 
 class AllocationRequest(BaseModel):
@@ -27,6 +247,15 @@ class AllocationRequest(BaseModel):
     qty: PositiveInt
 
 
+class DeallocationRequest(BaseModel):
+    orderid: str
+    sku: str
+
+
+class BulkAllocationRequest(BaseModel):
+    lines: list[AllocationRequest]
+
+
 class BatchRequest(BaseModel):
     ref: str
     sku: str
@@ -34,40 +263,357 @@ class BatchRequest(BaseModel):
     eta: date | None
 
 
-@app.post(
+class SkuAvailability(BaseModel):
+    sku: str
+    batches: int
+    purchased_quantity: int
+    allocated_quantity: int
+    available_quantity: int
+
+
+class BatchAvailability(BaseModel):
+    reference: str
+    sku: str
+    eta: date | None
+    purchased_quantity: int
+    allocated_quantity: int
+    available_quantity: int
+
+
+@router.post(
     "/allocate", status_code=201, response_model=dict[str, str]
 )
 async def allocate_endpoint(
-    request: Request, allocation: AllocationRequest
+    request: Request,
+    allocation: AllocationRequest,
+    session: DbSession,
+    resources: Worker,
 ) -> dict[str, str] | JSONResponse:
-    session = get_session()
-    repo = repository.SqlAlchemyRepository(session)
-
     try:
-        batchref = services.allocate(
-            allocation.orderid, allocation.sku, allocation.qty, repo=repo, session=session
-        )
+        if resources.allocator is not None:
+            batchref = await resources.allocator.allocate(
+                allocation.orderid, allocation.sku, allocation.qty
+            )
+        elif resources.group_commit is not None:
+            batchref = await resources.group_commit.allocate(
+                allocation.orderid, allocation.sku, allocation.qty
+            )
+        else:
+            batchref = await services.run_async(
+                session,
+                resources.allocate_service,
+                allocation.orderid,
+                allocation.sku,
+                allocation.qty,
+                repo_factory=resources.caching_repository,
+            )
     except (model.OutOfStock, services.InvalidSku) as e:
         return JSONResponse(
             status_code=400,
             content={"message": str(e)},
         )
+    except repository.ConcurrentUpdate as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
+    except repository.UnversionedSku as e:
+        return JSONResponse(status_code=503, content={"message": str(e)})
+
+    return {"batchref": batchref}
+
 
+@router.post(
+    "/allocate/bulk", status_code=201, response_model=dict[str, list[dict[str, str]]]
+)
+async def allocate_bulk_endpoint(
+    allocations: BulkAllocationRequest, session: DbSession, resources: Worker
+) -> dict[str, list[dict[str, str]]] | JSONResponse:
+    lines = [(line.orderid, line.sku, line.qty) for line in allocations.lines]
+    try:
+        if resources.allocator is not None:
+            results = await resources.allocator.allocate_many(lines)
+        else:
+            results = await services.run_async(
+                session,
+                services.allocate_many,
+                lines,
+                repo_factory=resources.caching_repository,
+            )
+    except repository.ConcurrentUpdate as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
+    except repository.UnversionedSku as e:
+        return JSONResponse(status_code=503, content={"message": str(e)})
+    return {
+        "results": [
+            {"message": str(result)}
+            if isinstance(result, Exception)
+            else {"batchref": result}
+            for result in results
+        ]
+    }
+
+
+@router.post("/deallocate", response_model=dict[str, str])
+async def deallocate_endpoint(
+    deallocation: DeallocationRequest, session: DbSession, resources: Worker
+) -> dict[str, str] | JSONResponse:
+    try:
+        if resources.allocator is not None:
+            batchref = await resources.allocator.deallocate(
+                deallocation.orderid, deallocation.sku
+            )
+        else:
+            batchref = await services.run_async(
+                session,
+                services.deallocate,
+                deallocation.orderid,
+                deallocation.sku,
+                repo_factory=resources.caching_repository,
+            )
+    except services.NotAllocated as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    except repository.ConcurrentUpdate as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
+    except repository.UnversionedSku as e:
+        return JSONResponse(status_code=503, content={"message": str(e)})
     return {"batchref": batchref}
 
 
-@app.post("/add_batch", status_code=201)
+@router.post("/add_batch", status_code=201, response_model=dict[str, str])
 async def add_batch_endpoint(
-    request: Request, batch: BatchRequest
-) -> dict[str, str]:
-    session = get_session()
-    repo = repository.SqlAlchemyRepository(session)
-    services.add_batch(
-        batch.ref, batch.sku, batch.qty, batch.eta, repo=repo, session=session
-    )
+    request: Request,
+    batch: BatchRequest,
+    session: DbSession,
+    resources: Worker,
+) -> dict[str, str] | JSONResponse:
+    try:
+        if resources.allocator is not None:
+            await resources.allocator.add_batches(
+                [(batch.ref, batch.sku, batch.qty, batch.eta)]
+            )
+        else:
+            await services.run_async(
+                session,
+                services.add_batch,
+                batch.ref,
+                batch.sku,
+                batch.qty,
+                batch.eta,
+                repo_factory=resources.caching_repository,
+            )
+    except repository.DuplicateBatch as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    except repository.ConcurrentUpdate as e:
+        return JSONResponse(status_code=409, content={"message": str(e)})
+    except repository.UnversionedSku as e:
+        return JSONResponse(status_code=503, content={"message": str(e)})
     return {"message": "Ok"}
 
 
-@app.get("/")
+async def upload_lines(request: Request) -> AsyncIterator[str]:
+    pending = b""
+    async for chunk in request.stream():
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            yield line.decode()
+    yield pending.decode()
+
+
+async def upload_batches(request: Request) -> AsyncIterator[BatchRequest]:
+    """Parse an NDJSON or CSV (with a header row) upload one batch at a time."""
+    lines = (line async for line in upload_lines(request) if line.strip())
+    if not request.headers.get("content-type", "").startswith("text/csv"):
+        async for line in lines:
+            yield BatchRequest.model_validate_json(line)
+        return
+    header: list[str] | None = None
+    async for line in lines:
+        [values] = csv.reader([line])
+        if header is None:
+            header = values
+            continue
+        record = dict(zip(header, values, strict=False))
+        yield BatchRequest.model_validate({**record, "eta": record.get("eta") or None})
+
+
+@router.post(
+    "/add_batches", status_code=201, response_model=dict[str, int | float]
+)
+async def add_batches_endpoint(
+    request: Request, session: DbSession, resources: Worker
+) -> dict[str, int | float] | JSONResponse:
+    async def ingest(chunk: list[tuple[str, str, int, date | None]]) -> int:
+        if resources.allocator is not None:
+            return await resources.allocator.add_batches(chunk)
+        return await services.run_async(
+            session,
+            services.add_batches,
+            chunk,
+            repo_factory=resources.caching_repository,
+        )
+
+    started = time.perf_counter()
+    added = 0
+    chunk: list[tuple[str, str, int, date | None]] = []
+    try:
+        async for batch in upload_batches(request):
+            chunk.append((batch.ref, batch.sku, batch.qty, batch.eta))
+            if len(chunk) < services.INGEST_CHUNK_SIZE:
+                continue
+            added += await ingest(chunk)
+            chunk = []
+        if chunk:
+            added += await ingest(chunk)
+    except ValidationError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "message": f"Invalid batch on row {added + len(chunk) + 1}:"
+                f" {e.errors()[0]['msg']}",
+                "rows": added,
+            },
+        )
+    except repository.DuplicateBatch as e:
+        return JSONResponse(status_code=400, content={"message": str(e), "rows": added})
+    except repository.ConcurrentUpdate as e:
+        return JSONResponse(status_code=409, content={"message": str(e), "rows": added})
+    except repository.UnversionedSku as e:
+        return JSONResponse(status_code=503, content={"message": str(e), "rows": added})
+    seconds = time.perf_counter() - started
+    logger.info("Ingested %d batches in %.2fs", added, seconds)
+    return {
+        "rows": added,
+        "seconds": seconds,
+        "rows_per_second": added / seconds if seconds else 0.0,
+    }
+
+
+@router.get("/skus/{sku}/availability", response_model=SkuAvailability)
+async def sku_availability_endpoint(
+    sku: str, session: ReadSession
+) -> dict[str, Any] | JSONResponse:
+    found = await session.run_sync(views.sku_availability, sku)
+    if found is None:
+        return JSONResponse(status_code=404, content={"message": f"Unknown sku {sku}"})
+    return found
+
+
+@router.get("/batches/{reference}", response_model=BatchAvailability)
+async def batch_availability_endpoint(
+    reference: str, session: ReadSession
+) -> dict[str, Any] | JSONResponse:
+    found = await session.run_sync(views.batch_availability, reference)
+    if found is None:
+        return JSONResponse(
+            status_code=404, content={"message": f"Unknown batch {reference}"}
+        )
+    return found
+
+
+BodyT = TypeVar("BodyT", bound=BaseModel)
+
+
+def parse_body(model: type[BodyT], body: bytes) -> BodyT:
+    """Validate a JSON body against ``model`` in one pass, failing the way
+    FastAPI does for a body parameter of that type."""
+    try:
+        return model.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", *error["loc"])}
+                for error in e.errors(include_url=False)
+            ],
+            body=body,
+        ) from None
+
+
+def fast_response(
+    result: dict[str, Any] | Response, status_code: int = 200
+) -> Response:
+    # errors come back as responses already; they are not the hot path
+    if isinstance(result, Response):
+        return result
+    return ORJSONResponse(result, status_code=status_code)
+
+
+@fast_router.post("/allocate", include_in_schema=False)
+async def fast_allocate_endpoint(
+    request: Request, session: DbSession, resources: Worker
+) -> Response:
+    allocation = parse_body(AllocationRequest, await request.body())
+    result = await allocate_endpoint(request, allocation, session, resources)
+    return fast_response(result, status_code=201)
+
+
+@fast_router.post("/allocate/bulk", include_in_schema=False)
+async def fast_allocate_bulk_endpoint(
+    request: Request, session: DbSession, resources: Worker
+) -> Response:
+    allocations = parse_body(BulkAllocationRequest, await request.body())
+    result = await allocate_bulk_endpoint(allocations, session, resources)
+    return fast_response(result, status_code=201)
+
+
+@fast_router.post("/deallocate", include_in_schema=False)
+async def fast_deallocate_endpoint(
+    request: Request, session: DbSession, resources: Worker
+) -> Response:
+    deallocation = parse_body(DeallocationRequest, await request.body())
+    return fast_response(await deallocate_endpoint(deallocation, session, resources))
+
+
+@fast_router.get("/skus/{sku}/availability", include_in_schema=False)
+async def fast_sku_availability_endpoint(sku: str, session: ReadSession) -> Response:
+    return fast_response(await sku_availability_endpoint(sku, session))
+
+
+@fast_router.get("/batches/{reference}", include_in_schema=False)
+async def fast_batch_availability_endpoint(
+    reference: str, session: ReadSession
+) -> Response:
+    return fast_response(await batch_availability_endpoint(reference, session))
+
+
+@router.get("/pool")
+def pool_endpoint(resources: Worker) -> dict[str, int | float]:
+    engine_pool = resources.engine.pool
+    assert isinstance(engine_pool, pool.InstrumentedAsyncQueuePool)
+    return engine_pool.snapshot()
+
+
+@router.get("/cache")
+def cache_endpoint(resources: Worker) -> dict[str, int | bool]:
+    batch_cache = resources.batch_cache
+    return {
+        "enabled": batch_cache.enabled,
+        "size": len(batch_cache),
+        "hits": batch_cache.stats.hits,
+        "misses": batch_cache.stats.misses,
+        "evictions": batch_cache.stats.evictions,
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint(resources: Worker) -> str:
+    batch_cache = resources.batch_cache
+    recent_allocations = resources.recent_allocations
+    engine_pool = resources.engine.pool
+    assert isinstance(engine_pool, pool.InstrumentedAsyncQueuePool)
+    gauges = {f"pool_{name}": value for name, value in engine_pool.snapshot().items()}
+    gauges.update(
+        cache_size=len(batch_cache),
+        cache_hits=batch_cache.stats.hits,
+        cache_misses=batch_cache.stats.misses,
+        cache_evictions=batch_cache.stats.evictions,
+        recent_allocations_size=len(recent_allocations),
+        recent_allocations_hits=recent_allocations.stats.hits,
+        recent_allocations_misses=recent_allocations.stats.misses,
+    )
+    return metrics.registry.render(gauges=gauges)
+
+
+@router.get("/")
 def root() -> dict[str, str]:
     return {"message": "Hello World"}
+
+
+app = create_app()
@@ -0,0 +1,115 @@
+import asyncio
+import contextlib
+from collections.abc import Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from allocations.adapters import metrics, repository
+from allocations.service_layer import services
+
+Pending = tuple[tuple[str, str, int], asyncio.Future[str]]
+
+
+class GroupCommit:
+    """Coalesce concurrent allocations into one allocate_many transaction.
+
+    Each allocate() call is queued; a single committer task takes the first
+    waiting line, gives others up to ``max_delay`` seconds (or until
+    ``max_size`` are queued) to join it, then allocates the whole group
+    against one loaded state per sku and commits once. While that commit is
+    in flight the next group builds up, so commits per second stay roughly
+    constant while allocations per commit grow with load.
+
+    Every caller gets its own batchref, or its own OutOfStock/InvalidSku; an
+    error that fails the whole transaction is raised to every caller in it.
+    """
+
+    def __init__(
+        self,
+        get_session: async_sessionmaker[AsyncSession],
+        repo_factory: Callable[
+            [Session], repository.AbstractRepository
+        ] = repository.SqlAlchemyRepository,
+        max_delay: float = 0.002,
+        max_size: int = 100,
+    ) -> None:
+        self.get_session = get_session
+        self.repo_factory = repo_factory
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self._queue: asyncio.Queue[Pending] = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._committer: asyncio.Task[None] | None = None
+        self._in_flight: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._committer is None:
+            self._committer = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Commit whatever is queued, then stop the committer."""
+        if self._committer is None:
+            return
+        self._committer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._committer
+        self._committer = None
+        if self._in_flight is not None:
+            await self._in_flight
+        while not self._queue.empty():
+            await self._commit(self._take(self.max_size))
+
+    async def allocate(self, orderid: str, sku: str, qty: int) -> str:
+        if self._committer is None:
+            raise RuntimeError("GroupCommit has not been started")
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((orderid, sku, qty), future))
+        if self._queue.qsize() >= self.max_size:
+            self._full.set()
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            group = [await self._queue.get()]
+            try:
+                if self._queue.qsize() < self.max_size - 1:
+                    with contextlib.suppress(TimeoutError):
+                        await asyncio.wait_for(self._full.wait(), self.max_delay)
+            finally:
+                # a group taken off the queue is always committed, and
+                # shielded, even when the committer is cancelled by close()
+                group += self._take(self.max_size - 1)
+                self._in_flight = asyncio.create_task(self._commit(group))
+            await asyncio.shield(self._in_flight)
+
+    def _take(self, limit: int) -> list[Pending]:
+        group: list[Pending] = []
+        while len(group) < limit and not self._queue.empty():
+            group.append(self._queue.get_nowait())
+        self._full.clear()
+        return group
+
+    async def _commit(self, group: list[Pending]) -> None:
+        metrics.registry.inc("group_commits_total")
+        metrics.registry.inc("group_commit_lines_total", len(group))
+        try:
+            async with self.get_session() as session:
+                results = await services.run_async(
+                    session,
+                    services.allocate_many,
+                    [line for line, _ in group],
+                    repo_factory=self.repo_factory,
+                )
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(group, results, strict=True):
+            if future.done():  # the caller gave up waiting
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
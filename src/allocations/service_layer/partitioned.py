@@ -0,0 +1,417 @@
+"""SKU-partitioned allocation across worker processes.
+
+Every sku is owned by exactly one worker process, picked by a stable hash.
+A worker loads a sku's batches the first time it is asked about it and from
+then on keeps them in memory as the source of truth: allocations are decided
+against the in-memory batches and the resulting changes are written through
+the repository, without re-reading the batches or locking the sku row. No
+two workers ever touch the same sku, so they never contend, and allocation
+throughput grows with the number of cores rather than being bound by the GIL.
+
+A worker can start warm from a snapshot (adapters.snapshot): the skus it
+owns whose version has not moved since the snapshot are restored from it
+without touching the database, and only the rest are read. Every write
+bumps the sku's version, as lock_skus does for the other write paths.
+
+The API talks to the workers through one single-process executor each, so
+requests for a sku are applied in the order they arrive, and replaces a
+worker that dies. Each worker remembers the version of the skus it loaded:
+if a commit moves a sku's version on by more than its own write, something
+else (another API process's workers, or anything writing around them)
+wrote to it in the meantime, so the worker rolls back, drops what it holds
+and redoes the request from the database. Writes are therefore never
+decided on stale state, but replays and refusals (OutOfStock, InvalidSku)
+write nothing and are answered from memory: run the allocator in a single
+API process to keep them exact.
+"""
+
+import asyncio
+import gc
+import logging
+import multiprocessing
+import os
+import zlib
+from collections.abc import Callable, Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from functools import partial
+from pathlib import Path
+from typing import Any, TypeVar
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+from allocations.adapters import orm, repository, snapshot, sqlite
+from allocations.domain import model
+from allocations.service_layer import services
+
+logger = logging.getLogger(__name__)
+
+BatchRow = tuple[str, str, int, date | None]
+T = TypeVar("T")
+
+
+def owner(sku: str, partitions: int) -> int:
+    # crc32 rather than hash(): it must agree across processes and restarts
+    return zlib.crc32(sku.encode()) % partitions
+
+
+class Partition:
+    """The skus one worker process owns, held in memory."""
+
+    def __init__(
+        self, database_uri: str, pragmas: Mapping[str, Any] | None = None
+    ) -> None:
+        engine = create_engine(database_uri)
+        if pragmas is not None:
+            sqlite.tune(engine, pragmas)
+        # expire_on_commit=False: committing must not throw the state away
+        self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self.repo = repository.SqlAlchemyRepository(self.session)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.batches = model.BatchIndex()
+        self.by_reference: dict[str, model.Batch] = {}
+        self.loaded: set[str] = set()
+        self.allocated: dict[tuple[str, str], model.Batch] = {}
+        self.touched: set[str] = set()
+        self.moved: list[tuple[str, str, int]] = []
+        # the version of each loaded sku as of its load or our last write
+        self.versions: dict[str, int] = {}
+
+    def _track(self, batch: model.Batch) -> None:
+        self.batches.update(batch)
+        self.by_reference[batch.reference] = batch
+        for line in batch.allocations:
+            self.allocated[line.orderid, line.sku] = batch
+
+    def _load(self, sku: str) -> None:
+        if sku not in self.loaded:
+            # the version before the batches: if they are newer than it,
+            # the next commit sees a conflict and reloads, never the reverse
+            self.versions.update(self.repo.get_versions([sku]))
+            for batch in self.repo.list_by_sku(sku):
+                self._track(batch)
+            self.loaded.add(sku)
+
+    def warm(
+        self, saved: snapshot.Snapshot, owns: Callable[[str], bool]
+    ) -> tuple[int, int]:
+        """Load the owned skus up front: from the snapshot where their version
+        still matches, from the database where it has moved on or the sku is
+        newer than the snapshot. Returns how many skus came from each."""
+        current = {
+            sku: version
+            for sku, version in self.repo.get_versions().items()
+            if owns(sku)
+        }
+        saved_versions = saved.versions
+        fresh = {
+            sku
+            for sku, version in current.items()
+            if saved_versions.get(sku) == version
+        }
+        stale = current.keys() - fresh
+        # warming up only creates long-lived objects: keep the cycle collector
+        # from scanning them over and over while it runs, and out of its
+        # way for good afterwards
+        gc.disable()
+        try:
+            restored = self.repo.restore(saved.batches(fresh))
+            for batch in [*restored, *self.repo.list_by_skus(stale)]:
+                self._track(batch)
+        finally:
+            gc.freeze()
+            gc.enable()
+        self.loaded.update(current)
+        self.versions.update(current)
+        self.session.commit()  # end the read transaction
+        return len(fresh), len(stale)
+
+    def _commit(self) -> None:
+        try:
+            self.repo.update_availability(self.moved)
+            self.repo.lock_skus(self.touched)
+            written = {sku: self.repo.versions[sku] for sku in self.touched}
+            moved_on = sorted(
+                sku
+                for sku, version in written.items()
+                if version != self.versions.get(sku, 0) + 1
+            )
+            if moved_on:
+                raise repository.ConcurrentUpdate(
+                    f"Skus {', '.join(moved_on)} were written to elsewhere"
+                )
+            self.session.commit()
+        except Exception:
+            self._abandon()
+            raise
+        self.versions.update(written)
+        self.touched.clear()
+        self.moved.clear()
+
+    def _abandon(self) -> None:
+        # whatever the database refused is still in memory; start over from
+        # what was committed
+        self.session.rollback()
+        self._reset()
+
+    def _retry(self, operation: Callable[[], T]) -> T:
+        # after a conflict _commit has dropped everything, so the retry
+        # reloads what it needs from the database
+        try:
+            for _ in range(services.MAX_ATTEMPTS - 1):
+                try:
+                    return operation()
+                except repository.ConcurrentUpdate:
+                    pass
+            return operation()
+        finally:
+            if not self.touched:
+                # a replay or refusal writes nothing but may have read: end
+                # its transaction rather than hold the connection in it
+                # until the next write
+                self.session.commit()
+
+    def _allocate_line(self, line: model.OrderLine) -> str:
+        key = (line.orderid, line.sku)
+        if key in self.allocated:
+            return self.allocated[key].reference
+        self._load(line.sku)
+        if line.sku not in self.batches:
+            raise services.InvalidSku(f"Invalid sku {line.sku}")
+        batchref = model.allocate(line, self.batches)
+        self.touched.add(line.sku)
+        self.moved.append((batchref, line.sku, line.qty))
+        self.allocated[key] = self.by_reference[batchref]
+        return batchref
+
+    def allocate(self, orderid: str, sku: str, qty: int) -> str:
+        return self._retry(partial(self._allocate, orderid, sku, qty))
+
+    def _allocate(self, orderid: str, sku: str, qty: int) -> str:
+        batchref = self._allocate_line(model.OrderLine(orderid, sku, qty))
+        self._commit()
+        return batchref
+
+    def allocate_many(
+        self, lines: list[tuple[str, str, int]]
+    ) -> list[services.AllocationResult]:
+        return self._retry(partial(self._allocate_many, lines))
+
+    def _allocate_many(
+        self, lines: list[tuple[str, str, int]]
+    ) -> list[services.AllocationResult]:
+        results: list[services.AllocationResult] = []
+        for orderid, sku, qty in lines:
+            try:
+                results.append(self._allocate_line(model.OrderLine(orderid, sku, qty)))
+            except (model.OutOfStock, services.InvalidSku) as e:
+                results.append(e)
+        self._commit()
+        return results
+
+    def deallocate(self, orderid: str, sku: str) -> str:
+        return self._retry(partial(self._deallocate, orderid, sku))
+
+    def _deallocate(self, orderid: str, sku: str) -> str:
+        batch = self.allocated.get((orderid, sku))
+        if batch is None and sku not in self.loaded:
+            self._load(sku)
+            batch = self.allocated.get((orderid, sku))
+        line = batch.allocation_for(orderid) if batch is not None else None
+        if batch is None or line is None:
+            raise services.NotAllocated(
+                f"Order {orderid} has no allocation for sku {sku}"
+            )
+        batch.deallocate(line)
+        self.batches.update(batch)
+        del self.allocated[orderid, sku]
+        self.touched.add(sku)
+        self.moved.append((batch.reference, sku, -line.qty))
+        self._commit()
+        return batch.reference
+
+    def add_batches(self, rows: list[BatchRow]) -> int:
+        return self._retry(partial(self._add_batches, rows))
+
+    def _add_batches(self, rows: list[BatchRow]) -> int:
+        skus = {sku for _, sku, _, _ in rows}
+        for sku in skus:
+            self._load(sku)
+        try:
+            for ref, sku, qty, eta in rows:
+                batch = model.Batch(ref, sku, qty, eta)
+                self.repo.add(batch)
+                self._track(batch)
+        except Exception:
+            # e.g. DuplicateBatch: none of the rows may stay behind
+            self._abandon()
+            raise
+        self.touched.update(skus)
+        self._commit()
+        return len(rows)
+
+
+_partition: Partition | None = None
+
+
+def _start_partition(
+    database_uri: str,
+    index: int,
+    partitions: int,
+    saved: Path | None,
+    pragmas: Mapping[str, Any] | None,
+) -> None:
+    global _partition
+    orm.start_mappers()
+    _partition = Partition(database_uri, pragmas)
+    if saved is None or not saved.exists():
+        return
+    try:
+        with snapshot.open_snapshot(saved) as opened:
+            restored, caught_up = _partition.warm(
+                opened, lambda sku: owner(sku, partitions) == index
+            )
+    except (snapshot.InvalidSnapshot, OSError, ValueError):
+        # a damaged snapshot only costs the warm start: load from the
+        # database as needed, starting from a clean session
+        logger.exception("Partition %d could not warm up from %s", index, saved)
+        _partition.session.close()
+        _partition = Partition(database_uri, pragmas)
+    else:
+        logger.info(
+            "Partition %d warm: %d skus from %s, %d from the database",
+            index,
+            restored,
+            saved,
+            caught_up,
+        )
+
+
+def _call(method: str, *args: Any) -> Any:
+    assert _partition is not None, "worker started without _start_partition"
+    return getattr(_partition, method)(*args)
+
+
+def _started() -> None:
+    """A no-op; submitting it makes the executor start its worker now."""
+
+
+def sync_uri(database_uri: str) -> str:
+    """The URI with its default, blocking driver (workers do not need async)."""
+    url = make_url(database_uri)
+    return url.set(drivername=url.get_backend_name()).render_as_string(
+        hide_password=False
+    )
+
+
+class PartitionedAllocator:
+    """Route allocation requests to the worker process that owns the sku."""
+
+    def __init__(
+        self,
+        database_uri: str,
+        partitions: int | None = None,
+        snapshot: Path | None = None,
+        pragmas: Mapping[str, Any] | None = None,
+    ) -> None:
+        if sqlite.is_sqlite(database_uri) and sqlite.is_memory(database_uri):
+            # each worker would open a database of its own, and an empty one
+            raise ValueError(
+                "Partitioned allocation needs a database its workers can share,"
+                " not an in-memory SQLite one"
+            )
+        self.database_uri = sync_uri(database_uri)
+        self.partitions = partitions or os.cpu_count() or 1
+        self.snapshot = snapshot
+        # for sqlite.tune, when the database is SQLite
+        self.pragmas = pragmas
+        self._workers: list[ProcessPoolExecutor] = []
+
+    def _spawn(self, index: int) -> ProcessPoolExecutor:
+        worker = ProcessPoolExecutor(
+            max_workers=1,
+            # spawned, not forked: workers inherit nothing from the API process
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_start_partition,
+            initargs=(
+                self.database_uri,
+                index,
+                self.partitions,
+                self.snapshot,
+                self.pragmas,
+            ),
+        )
+        worker.submit(_started)
+        return worker
+
+    def start(self) -> None:
+        self._workers = [self._spawn(index) for index in range(self.partitions)]
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.shutdown()
+        self._workers = []
+
+    def owner(self, sku: str) -> int:
+        return owner(sku, self.partitions)
+
+    async def _call(self, partition: int, method: str, *args: Any) -> Any:
+        if not self._workers:
+            raise RuntimeError("PartitionedAllocator has not been started")
+        worker = self._workers[partition]
+        try:
+            return await asyncio.wrap_future(worker.submit(_call, method, *args))
+        except BrokenProcessPool:
+            # the worker died: fail the calls it had, but serve the next ones
+            # from a fresh worker (only once, however many calls failed)
+            if self._workers[partition] is worker:
+                logger.error("Partition %d worker died, starting another", partition)
+                worker.shutdown(wait=False)
+                self._workers[partition] = self._spawn(partition)
+            raise
+
+    async def allocate(self, orderid: str, sku: str, qty: int) -> str:
+        batchref: str = await self._call(self.owner(sku), "allocate", orderid, sku, qty)
+        return batchref
+
+    async def allocate_many(
+        self, lines: Iterable[tuple[str, str, int]]
+    ) -> list[services.AllocationResult]:
+        """Allocate each worker's share of ``lines`` in parallel, one commit
+        per worker, and return the results in the order of ``lines``."""
+        lines = list(lines)
+        by_owner: dict[int, list[int]] = {}
+        for i, (_, sku, _) in enumerate(lines):
+            by_owner.setdefault(self.owner(sku), []).append(i)
+        shares = await asyncio.gather(
+            *(
+                self._call(owner, "allocate_many", [lines[i] for i in indices])
+                for owner, indices in by_owner.items()
+            )
+        )
+        results: list[services.AllocationResult] = [""] * len(lines)
+        for indices, share in zip(by_owner.values(), shares, strict=True):
+            for i, result in zip(indices, share, strict=True):
+                results[i] = result
+        return results
+
+    async def deallocate(self, orderid: str, sku: str) -> str:
+        batchref: str = await self._call(self.owner(sku), "deallocate", orderid, sku)
+        return batchref
+
+    async def add_batches(self, rows: Iterable[BatchRow]) -> int:
+        by_owner: dict[int, list[BatchRow]] = {}
+        for row in rows:
+            by_owner.setdefault(self.owner(row[1]), []).append(row)
+        added = await asyncio.gather(
+            *(
+                self._call(owner, "add_batches", owner_rows)
+                for owner, owner_rows in by_owner.items()
+            )
+        )
+        return sum(added)
@@ -1,6 +1,14 @@
+from collections.abc import Callable, Iterable
 from datetime import date
+from functools import partial
+from itertools import islice
+from typing import Any, TypeVar
 
-from allocations.adapters import repository
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from allocations.adapters import metrics, repository
 from allocations.domain import model
 
 
@@ -8,27 +16,280 @@ class InvalidSku(Exception):
     pass
 
 
+class NotAllocated(Exception):
+    pass
+
+
+AllocationResult = str | InvalidSku | model.OutOfStock
+T = TypeVar("T")
+
+MAX_ATTEMPTS = 5
+INGEST_CHUNK_SIZE = 5_000
+
+
 def is_valid_sku(sku: str, batches: list[model.Batch]) -> bool:
     return sku in {b.sku for b in batches}
 
 
+def retry_on_conflict(
+    session: repository.AbstractSession, attempt: Callable[[], T]
+) -> T:
+    for _ in range(MAX_ATTEMPTS - 1):
+        try:
+            return attempt()
+        except repository.ConcurrentUpdate:
+            session.rollback()
+    return attempt()
+
+
+def replay(line: model.OrderLine, repo: repository.AbstractRepository) -> str | None:
+    """The batchref an earlier request for the same order and sku was given."""
+    key = (line.orderid, line.sku)
+    batchref = repo.get_allocations([key]).get(key)
+    if batchref is not None:
+        metrics.registry.inc("replays_total")
+    return batchref
+
+
+def allocated_while_locking(
+    line: model.OrderLine, batches: Iterable[model.Batch]
+) -> str | None:
+    """The batch an identical request committed ``line`` to after replay looked
+    for it, while this request waited for the sku lock."""
+    for batch in batches:
+        if line in batch.allocations:
+            metrics.registry.inc("replays_total")
+            return batch.reference
+    return None
+
+
+def commit_allocations(session: repository.AbstractSession) -> None:
+    try:
+        session.commit()
+    except IntegrityError:
+        # an identical request got its line in first; retrying replays it
+        raise repository.ConcurrentUpdate(
+            "Order line was allocated concurrently"
+        ) from None
+
+
 def allocate(
     orderid: str, sku: str, qty: int,
     repo: repository.AbstractRepository,
     session: repository.AbstractSession,
 ) -> str:
-    batches = repo.list()
-    if not is_valid_sku(sku, batches):
-        raise InvalidSku(f"Invalid sku {sku}")
-    batchref = model.allocate(model.OrderLine(orderid, sku, qty), batches)
-    session.commit()
+    metrics.registry.inc("requests_total", service="allocate")
+    line = model.OrderLine(orderid, sku, qty)
+    return retry_on_conflict(session, partial(_allocate, line, repo, session))
+
+
+def _allocate(
+    line: model.OrderLine,
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> str:
+    if (batchref := replay(line, repo)) is not None:
+        return batchref
+    with metrics.registry.stage("load"):
+        repo.lock_skus([line.sku])
+        batches = repo.list_by_sku(line.sku)
+    if (batchref := allocated_while_locking(line, batches)) is not None:
+        return batchref
+    if not is_valid_sku(line.sku, batches):
+        metrics.registry.inc("invalid_sku_total")
+        raise InvalidSku(f"Invalid sku {line.sku}")
+    with metrics.registry.stage("allocate"):
+        try:
+            batchref = model.allocate(line, model.BatchIndex(batches))
+        except model.OutOfStock:
+            metrics.registry.inc("out_of_stock_total")
+            raise
+        repo.update_availability([(batchref, line.sku, line.qty)])
+    with metrics.registry.stage("commit"):
+        commit_allocations(session)
     return batchref
 
 
+def allocate_in_sql(
+    orderid: str, sku: str, qty: int,
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> str:
+    """allocate, but with availability summed by the database.
+
+    Neither the batches nor their allocated lines are loaded, and only the new
+    allocation is written, so the cost does not grow with allocation history.
+    """
+    metrics.registry.inc("requests_total", service="allocate_in_sql")
+    line = model.OrderLine(orderid, sku, qty)
+    return retry_on_conflict(session, partial(_allocate_in_sql, line, repo, session))
+
+
+def _allocate_in_sql(
+    line: model.OrderLine,
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> str:
+    if (batchref := replay(line, repo)) is not None:
+        return batchref
+    with metrics.registry.stage("load"):
+        repo.lock_skus([line.sku])
+        records = repo.list_availability(line.sku)
+    if not records:
+        metrics.registry.inc("invalid_sku_total")
+        raise InvalidSku(f"Invalid sku {line.sku}")
+    with metrics.registry.stage("allocate"):
+        try:
+            record = model.allocate_record(line, records)
+        except model.OutOfStock:
+            metrics.registry.inc("out_of_stock_total")
+            raise
+        repo.add_allocation(record.reference, line)
+    with metrics.registry.stage("commit"):
+        commit_allocations(session)
+    return record.reference
+
+
+def allocate_many(
+    lines: Iterable[tuple[str, str, int]],
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> list[AllocationResult]:
+    metrics.registry.inc("requests_total", service="allocate_many")
+    order_lines = [model.OrderLine(orderid, sku, qty) for orderid, sku, qty in lines]
+    return retry_on_conflict(
+        session, partial(_allocate_many, order_lines, repo, session)
+    )
+
+
+def _allocate_many(
+    order_lines: list[model.OrderLine],
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> list[AllocationResult]:
+    # lines allocated by an earlier request, or earlier in this one, replay
+    allocated = repo.get_allocations({(line.orderid, line.sku) for line in order_lines})
+    skus = {
+        line.sku for line in order_lines if (line.orderid, line.sku) not in allocated
+    }
+    with metrics.registry.stage("load"):
+        repo.lock_skus(skus)
+        loaded: dict[str, list[model.Batch]] = {}
+        for batch in repo.list_by_skus(skus):
+            loaded.setdefault(batch.sku, []).append(batch)
+        batches = model.BatchIndex(
+            batch for sku_batches in loaded.values() for batch in sku_batches
+        )
+    results: list[AllocationResult] = []
+    moved: list[tuple[str, str, int]] = []
+    with metrics.registry.stage("allocate"):
+        for line in order_lines:
+            key = (line.orderid, line.sku)
+            if key in allocated:
+                metrics.registry.inc("replays_total")
+                results.append(allocated[key])
+                continue
+            if line.sku not in batches:
+                metrics.registry.inc("invalid_sku_total")
+                results.append(InvalidSku(f"Invalid sku {line.sku}"))
+                continue
+            locked = allocated_while_locking(line, loaded[line.sku])
+            if locked is not None:
+                allocated[key] = locked
+                results.append(locked)
+                continue
+            try:
+                allocated[key] = model.allocate(line, batches)
+            except model.OutOfStock as e:
+                metrics.registry.inc("out_of_stock_total")
+                results.append(e)
+            else:
+                results.append(allocated[key])
+                moved.append((allocated[key], line.sku, line.qty))
+        repo.update_availability(moved)
+    with metrics.registry.stage("commit"):
+        commit_allocations(session)
+    return results
+
+
+def deallocate(
+    orderid: str, sku: str,
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> str:
+    metrics.registry.inc("requests_total", service="deallocate")
+    repo.lock_skus([sku])
+    batch = repo.get_by_orderline(orderid, sku)
+    line = batch.allocation_for(orderid) if batch is not None else None
+    if batch is None or line is None:
+        raise NotAllocated(f"Order {orderid} has no allocation for sku {sku}")
+    batch.deallocate(line)
+    repo.update_availability([(batch.reference, sku, -line.qty)])
+    session.commit()
+    return batch.reference
+
+
 def add_batch(
     ref: str, sku: str, qty: int, eta: date | None,
     repo: repository.AbstractRepository,
     session: repository.AbstractSession,
 ) -> None:
-    repo.add(model.Batch(ref, sku, qty, eta))
+    def attempt() -> None:
+        repo.add(model.Batch(ref, sku, qty, eta))
+        repo.lock_skus([sku])
+        session.commit()
+
+    retry_on_conflict(session, attempt)
+
+
+def add_batches(
+    batches: Iterable[tuple[str, str, int, date | None]],
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+) -> int:
+    """Insert batches from any iterable in chunks, committing after each one.
+
+    Only one chunk is held in memory, so the iterable can be a lazily parsed
+    upload. Returns the number of batches added.
+    """
+    rows = iter(batches)
+    added = 0
+    while chunk := list(islice(rows, chunk_size)):
+        new_batches = [model.Batch(ref, sku, qty, eta) for ref, sku, qty, eta in chunk]
+        retry_on_conflict(session, partial(_add_chunk, new_batches, repo, session))
+        added += len(chunk)
+    return added
+
+
+def _add_chunk(
+    batches: list[model.Batch],
+    repo: repository.AbstractRepository,
+    session: repository.AbstractSession,
+) -> None:
+    repo.add_many(batches)
+    repo.lock_skus({batch.sku for batch in batches})
     session.commit()
+
+
+async def run_async(
+    session: AsyncSession,
+    service: Callable[..., T],
+    *args: Any,
+    repo_factory: Callable[
+        [Session], repository.AbstractRepository
+    ] = repository.SqlAlchemyRepository,
+    **kwargs: Any,
+) -> T:
+    """Await ``service`` against an async session without blocking the event loop.
+
+    The service runs on the session's sync facade inside SQLAlchemy's greenlet
+    bridge, so the repository, lazy loads and commit all go through the async
+    driver while the domain and service code stay synchronous.
+    """
+
+    def call(sync_session: Session) -> T:
+        repo = repo_factory(sync_session)
+        return service(*args, repo=repo, session=sync_session, **kwargs)
+
+    return await session.run_sync(call)
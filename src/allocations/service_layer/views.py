@@ -0,0 +1,34 @@
+"""Reads served from the availability read model (orm.batch_availability and
+orm.sku_availability), one primary-key lookup each, without loading batches
+or going through the repository."""
+
+from typing import Any
+
+from sqlalchemy import Table, select
+from sqlalchemy.orm import Session
+
+from allocations.adapters import orm
+
+
+def _availability(
+    table: Table, key: str, value: str, session: Session
+) -> dict[str, Any] | None:
+    available = table.c.purchased_quantity - table.c.allocated_quantity
+    row = session.execute(
+        select(table, available.label("available_quantity")).where(
+            table.c[key] == value
+        )
+    ).one_or_none()
+    return None if row is None else row._asdict()
+
+
+def sku_availability(session: Session, sku: str) -> dict[str, Any] | None:
+    """How many batches the sku has and how much of them is purchased,
+    allocated and still available, or None for an unknown sku."""
+    return _availability(orm.sku_availability, "sku", sku, session)
+
+
+def batch_availability(session: Session, reference: str) -> dict[str, Any] | None:
+    """The batch's sku, eta and purchased, allocated and available quantities,
+    or None for an unknown batch."""
+    return _availability(orm.batch_availability, "reference", reference, session)
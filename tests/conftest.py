@@ -8,6 +8,7 @@ from requests.exceptions import ConnectionError
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import Session, clear_mappers, sessionmaker
 
 from allocations import config
@@ -24,16 +25,27 @@ def restart_api() -> None:
 
 
 @pytest.fixture
-def in_memory_db() -> Engine:
+def in_memory_db() -> Generator[Engine, None, None]:
     engine = create_engine("sqlite:///:memory:")
     metadata.create_all(engine)
-    return engine
+    yield engine
+    # close the connection here rather than leave it to the garbage collector,
+    # which may run on another test's thread
+    engine.dispose()
+
+
+@pytest.fixture
+def sqlite_async_db(tmp_path: Path) -> AsyncEngine:
+    path = tmp_path / "allocations.db"
+    metadata.create_all(create_engine(f"sqlite:///{path}"))
+    return create_async_engine(f"sqlite+aiosqlite:///{path}")
 
 
 @pytest.fixture
 def session(in_memory_db: Engine) -> Generator[Session, None, None]:
     start_mappers()
-    yield sessionmaker(bind=in_memory_db)()
+    with sessionmaker(bind=in_memory_db)() as session:
+        yield session
     clear_mappers()
 
 
@@ -1,3 +1,4 @@
+import json
 from collections.abc import Callable
 
 import pytest
@@ -43,3 +44,75 @@ def test_400_message_for_invalid_sku() -> None:
     r = requests.post(f"{url}/allocate", json=data)
     assert r.status_code == 400
     assert r.json()["message"] == f"Invalid sku {unknown_sku}"
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocate_returns_a_result_per_line() -> None:
+    sku, unknown_sku = random_sku(), random_sku()
+    batch = random_batchref()
+    post_to_add_batch(batch, sku, 10, None)
+
+    data = {
+        "lines": [
+            {"orderid": random_orderid(), "sku": sku, "qty": 10},
+            {"orderid": random_orderid(), "sku": sku, "qty": 1},
+            {"orderid": random_orderid(), "sku": unknown_sku, "qty": 1},
+        ]
+    }
+    url = config.get_api_url()
+    r = requests.post(f"{url}/allocate/bulk", json=data)
+
+    assert r.status_code == 201
+    assert r.json()["results"] == [
+        {"batchref": batch},
+        {"message": f"Out of stock for sku {sku}"},
+        {"message": f"Invalid sku {unknown_sku}"},
+    ]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_add_batches_streams_an_ndjson_upload() -> None:
+    sku = random_sku()
+    refs = [random_batchref() for _ in range(3)]
+    body = "\n".join(
+        json.dumps({"ref": ref, "sku": sku, "qty": 10, "eta": None}) for ref in refs
+    )
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/add_batches",
+        data=body,
+        headers={"content-type": "application/x-ndjson"},
+    )
+
+    assert r.status_code == 201
+    assert r.json()["rows"] == 3
+    r = requests.post(
+        f"{url}/allocate", json={"orderid": random_orderid(), "sku": sku, "qty": 10}
+    )
+    assert r.json()["batchref"] in refs
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_deallocate_frees_stock_for_another_order() -> None:
+    sku, batch = random_sku(), random_batchref()
+    order1, order2 = random_orderid(), random_orderid()
+    post_to_add_batch(batch, sku, 10, None)
+    url = config.get_api_url()
+    data = {"orderid": order1, "sku": sku, "qty": 10}
+    r = requests.post(f"{url}/allocate", json=data)
+    assert r.status_code == 201
+
+    r = requests.post(f"{url}/deallocate", json={"orderid": order1, "sku": sku})
+    assert r.status_code == 200
+    assert r.json()["batchref"] == batch
+
+    data = {"orderid": order2, "sku": sku, "qty": 10}
+    r = requests.post(f"{url}/allocate", json=data)
+    assert r.status_code == 201
+    assert r.json()["batchref"] == batch
+
+    r = requests.post(f"{url}/deallocate", json={"orderid": order1, "sku": sku})
+    assert r.status_code == 400
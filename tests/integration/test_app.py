@@ -0,0 +1,285 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any
+
+import pytest
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+
+from allocations import config
+from allocations.adapters import metrics, orm, repository
+from allocations.endpoints.app import create_app
+from allocations.service_layer import services
+
+# what importing endpoints.app may cost on top of its dependencies
+IMPORT_BUDGET_SECONDS = 0.5
+
+IMPORT_PROBE = """
+import json, logging, sys, time
+import fastapi, pydantic, sqlalchemy.ext.asyncio, sqlalchemy.orm
+
+started = time.perf_counter()
+import allocations.endpoints.app
+seconds = time.perf_counter() - started
+
+from allocations.adapters import orm
+print(json.dumps({
+    "seconds": seconds,
+    "mapped": len(orm.mapper_reg.mappers),
+    "log_handlers": len(logging.getLogger().handlers),
+    "asyncpg_loaded": "asyncpg" in sys.modules,
+    "started": hasattr(allocations.endpoints.app.app.state, "resources"),
+}))
+"""
+
+
+def test_importing_the_app_is_cheap_and_has_no_side_effects() -> None:
+    # a database that cannot exist: importing must not need one
+    env = {**os.environ, "DB_HOST": "no-such-host.invalid", "PYTHONPATH": "src"}
+    probe = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE],
+        capture_output=True,
+        check=True,
+        cwd=Path(__file__).parents[2],
+        env=env,
+        text=True,
+    )
+    imported = json.loads(probe.stdout)
+
+    assert imported["mapped"] == 0
+    assert imported["log_handlers"] == 0
+    assert not imported["asyncpg_loaded"]
+    assert not imported["started"]
+    assert imported["seconds"] < IMPORT_BUDGET_SECONDS
+
+
+def sqlite_settings(tmp_path: Path, **overrides: Any) -> config.Settings:
+    path = tmp_path / "allocations.db"
+    orm.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    return config.Settings(database_uri=f"sqlite+aiosqlite:///{path}", **overrides)
+
+
+def test_app_sets_up_on_startup_and_tears_down_on_shutdown(tmp_path: Path) -> None:
+    app = create_app(sqlite_settings(tmp_path))
+
+    with TestClient(app) as client:
+        assert orm.mapper_reg.mappers
+        client.post(
+            "/add_batch", json={"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}
+        )
+        response = client.post(
+            "/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3}
+        )
+        assert response.json() == {"batchref": "b1"}
+
+    assert not orm.mapper_reg.mappers
+
+
+def test_each_app_gets_its_own_caches(tmp_path: Path) -> None:
+    settings = sqlite_settings(tmp_path)
+    first, second = create_app(settings), create_app(settings)
+
+    with TestClient(first) as client:
+        client.post(
+            "/add_batch", json={"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}
+        )
+        client.post("/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3})
+        assert client.get("/cache").json()["size"] == 1
+    with TestClient(second) as client:
+        assert client.get("/cache").json()["size"] == 0
+
+
+def test_apps_can_run_side_by_side(tmp_path: Path) -> None:
+    (tmp_path / "first").mkdir()
+    (tmp_path / "second").mkdir()
+    first = create_app(sqlite_settings(tmp_path / "first"))
+    second = create_app(sqlite_settings(tmp_path / "second"))
+    batch = {"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}
+
+    with TestClient(first) as first_client:
+        with TestClient(second) as second_client:
+            second_client.post("/add_batch", json=batch)
+            allocated = second_client.post(
+                "/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3}
+            )
+        # stopping the second app leaves the first one's mappers alone
+        first_client.post("/add_batch", json=batch)
+        still_allocated = first_client.post(
+            "/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3}
+        )
+
+    assert allocated.json() == still_allocated.json() == {"batchref": "b1"}
+    assert not orm.mapper_reg.mappers
+
+
+def test_writes_to_a_sku_without_a_skus_row_are_unavailable(tmp_path: Path) -> None:
+    settings = sqlite_settings(tmp_path)
+    with create_engine(settings.database_uri.replace("+aiosqlite", "")).begin() as c:
+        # a batch from before the skus table, not yet backfilled
+        c.execute(
+            orm.batches.insert().values(
+                reference="b1", sku="LAMP", _purchased_quantity=10, eta=None
+            )
+        )
+    line = {"orderid": "o1", "sku": "LAMP", "qty": 3}
+
+    with TestClient(create_app(settings)) as client:
+        responses = [
+            client.post("/allocate", json=line),
+            client.post("/allocate/bulk", json={"lines": [line]}),
+            client.post("/deallocate", json={"orderid": "o1", "sku": "LAMP"}),
+        ]
+
+    assert [r.status_code for r in responses] == [503] * 3
+    assert all("backfill" in r.json()["message"] for r in responses)
+
+
+def test_bulk_allocation_conflicts_are_reported(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def conflict(*_: Any, **__: Any) -> None:
+        raise repository.ConcurrentUpdate("Order line was allocated concurrently")
+
+    monkeypatch.setattr(services, "allocate_many", conflict)
+    line = {"orderid": "o1", "sku": "LAMP", "qty": 3}
+
+    with TestClient(create_app(sqlite_settings(tmp_path))) as client:
+        response = client.post("/allocate/bulk", json={"lines": [line]})
+
+    assert response.status_code == 409
+    assert response.json() == {"message": "Order line was allocated concurrently"}
+
+
+def test_settings_choose_the_allocation_service(tmp_path: Path) -> None:
+    app = create_app(sqlite_settings(tmp_path, allocation={"in_sql": True}))
+    metrics.registry.reset()
+
+    with TestClient(app) as client:
+        client.post(
+            "/add_batch", json={"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}
+        )
+        client.post("/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3})
+        rendered = client.get("/metrics").text
+
+    assert 'allocations_requests_total{service="allocate_in_sql"} 1' in rendered
+
+
+def test_group_commit_mode_allocates_through_the_committer(tmp_path: Path) -> None:
+    group_commit = {"enabled": True, "max_delay": 0.001, "max_size": 10}
+    app = create_app(sqlite_settings(tmp_path, group_commit=group_commit))
+    metrics.registry.reset()
+
+    with TestClient(app) as client:
+        client.post(
+            "/add_batch", json={"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}
+        )
+        ok = client.post("/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3})
+        invalid = client.post(
+            "/allocate", json={"orderid": "o2", "sku": "SOFA", "qty": 3}
+        )
+        rendered = client.get("/metrics").text
+
+    assert ok.status_code == 201
+    assert ok.json() == {"batchref": "b1"}
+    assert invalid.status_code == 400
+    assert "allocations_group_commits_total 2" in rendered
+
+
+def test_availability_is_read_from_the_read_model(tmp_path: Path) -> None:
+    app = create_app(sqlite_settings(tmp_path))
+
+    with TestClient(app) as client:
+        for ref, qty, eta in (("b1", 10, None), ("b2", 5, "2031-05-17")):
+            client.post(
+                "/add_batch", json={"ref": ref, "sku": "LAMP", "qty": qty, "eta": eta}
+            )
+        duplicate = client.post(
+            "/add_batch", json={"ref": "b1", "sku": "LAMP", "qty": 1, "eta": None}
+        )
+        client.post("/allocate", json={"orderid": "o1", "sku": "LAMP", "qty": 3})
+        client.post(
+            "/allocate/bulk",
+            json={
+                "lines": [
+                    {"orderid": "o2", "sku": "LAMP", "qty": 4},
+                    {"orderid": "o3", "sku": "LAMP", "qty": 5},
+                ]
+            },
+        )
+        client.post("/deallocate", json={"orderid": "o1", "sku": "LAMP"})
+        sku = client.get("/skus/LAMP/availability")
+        batch = client.get("/batches/b2")
+        unknown_sku = client.get("/skus/SOFA/availability")
+        unknown_batch = client.get("/batches/b3")
+
+    assert duplicate.status_code == 400
+    assert sku.json() == {
+        "sku": "LAMP",
+        "batches": 2,
+        "purchased_quantity": 15,
+        "allocated_quantity": 9,
+        "available_quantity": 6,
+    }
+    assert batch.json() == {
+        "reference": "b2",
+        "sku": "LAMP",
+        "eta": "2031-05-17",
+        "purchased_quantity": 5,
+        "allocated_quantity": 5,
+        "available_quantity": 0,
+    }
+    assert unknown_sku.status_code == unknown_batch.status_code == 404
+
+
+def test_fast_serialization_answers_like_the_models(tmp_path: Path) -> None:
+    pytest.importorskip("orjson")
+    requests: list[tuple[str, str, object]] = [
+        ("POST", "/add_batch", {"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}),
+        ("POST", "/allocate", {"orderid": "o1", "sku": "LAMP", "qty": 3}),
+        ("POST", "/allocate", {"orderid": "o2", "sku": "LAMP", "qty": 0}),
+        ("POST", "/allocate", {"orderid": "o2", "sku": "LAMP"}),
+        ("POST", "/allocate", {"orderid": "o2", "sku": "SOFA", "qty": 1}),
+        ("POST", "/allocate/bulk", {"lines": [{"orderid": "o2", "sku": "LAMP"}]}),
+        (
+            "POST",
+            "/allocate/bulk",
+            {"lines": [{"orderid": "o2", "sku": "LAMP", "qty": 8}]},
+        ),
+        ("POST", "/deallocate", {"orderid": "o1", "sku": "LAMP"}),
+        ("POST", "/deallocate", {"orderid": "o1", "sku": "LAMP"}),
+        ("GET", "/skus/LAMP/availability", None),
+        ("GET", "/batches/b1", None),
+        ("GET", "/batches/b2", None),
+    ]
+    answers = []
+    for fast in (False, True):
+        path = tmp_path / str(fast)
+        path.mkdir()
+        app = create_app(sqlite_settings(path, serialization={"fast": fast}))
+        with TestClient(app) as client:
+            answers.append(
+                [
+                    (response.status_code, response.json())
+                    for response in (
+                        client.request(method, url, json=body)
+                        for method, url, body in requests
+                    )
+                ]
+            )
+
+    models, fast_json = answers
+    assert fast_json == models
+    # the fast app routes /allocate to the fast endpoint first
+    assert [
+        route.name
+        for route in app.routes
+        if isinstance(route, APIRoute) and route.path == "/allocate"
+    ] == ["fast_allocate_endpoint", "allocate_endpoint"]
+    assert [status for status, _ in fast_json] == [
+        *(201, 201, 422, 422, 400, 422, 201),
+        *(200, 400, 200, 200, 404),
+    ]
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from collections.abc import Generator
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import clear_mappers
+
+from allocations.adapters.orm import start_mappers
+from allocations.service_layer import services
+
+
+@pytest.fixture
+def get_session(
+    sqlite_async_db: AsyncEngine,
+) -> Generator[async_sessionmaker, None, None]:  # type: ignore [type-arg]
+    start_mappers()
+    yield async_sessionmaker(bind=sqlite_async_db)
+    clear_mappers()
+
+
+def test_run_async_allocates_through_an_async_session(
+    get_session: async_sessionmaker,  # type: ignore [type-arg]
+) -> None:
+    async def scenario() -> str:
+        async with get_session() as session:
+            await services.run_async(
+                session, services.add_batch, "b1", "RED-CHAIR", 10, None
+            )
+        async with get_session() as session:
+            return await services.run_async(
+                session, services.allocate, "o1", "RED-CHAIR", 4
+            )
+
+    assert asyncio.run(scenario()) == "b1"
+
+
+def test_run_async_does_not_block_the_event_loop(
+    get_session: async_sessionmaker,  # type: ignore [type-arg]
+) -> None:
+    async def allocate(orderid: str) -> str:
+        async with get_session() as session:
+            return await services.run_async(
+                session, services.allocate, orderid, "RED-CHAIR", 1
+            )
+
+    async def heartbeat(stop: asyncio.Event) -> float:
+        worst_lag = 0.0
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0)
+            worst_lag = max(worst_lag, time.perf_counter() - started)
+        return worst_lag
+
+    async def scenario() -> tuple[list[str], float]:
+        async with get_session() as session:
+            await services.run_async(
+                session, services.add_batch, "b1", "RED-CHAIR", 100, None
+            )
+        stop = asyncio.Event()
+        beat = asyncio.create_task(heartbeat(stop))
+        results = await asyncio.gather(*(allocate(f"o{i}") for i in range(20)))
+        stop.set()
+        return results, await beat
+
+    results, worst_lag = asyncio.run(scenario())
+
+    assert results == ["b1"] * 20
+    assert worst_lag < 0.5
@@ -0,0 +1,195 @@
+from collections.abc import Generator
+from typing import Any
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, clear_mappers, sessionmaker
+
+from allocations.adapters.cache import AllocationCache, BatchCache
+from allocations.adapters.orm import start_mappers
+from allocations.adapters.repository import CachingRepository
+from allocations.domain import model
+from allocations.service_layer import services
+
+
+@pytest.fixture
+def get_session(in_memory_db: Engine) -> Generator[sessionmaker[Session], None, None]:
+    start_mappers()
+    yield sessionmaker(bind=in_memory_db, expire_on_commit=False)
+    clear_mappers()
+
+
+@pytest.fixture
+def selects(in_memory_db: Engine) -> list[str]:
+    statements: list[str] = []
+
+    def record(*args: Any) -> None:
+        if args[2].lstrip().upper().startswith("SELECT"):
+            statements.append(args[2])
+
+    event.listen(in_memory_db, "before_cursor_execute", record)
+    return statements
+
+
+def allocate(
+    get_session: sessionmaker[Session], cache: BatchCache, orderid: str, qty: int
+) -> str:
+    with get_session() as session:
+        repo = CachingRepository(session, cache)
+        return services.allocate(orderid, "chair", qty, repo=repo, session=session)
+
+
+def add_batch(get_session: sessionmaker[Session], cache: BatchCache, ref: str) -> None:
+    with get_session() as session:
+        repo = CachingRepository(session, cache)
+        services.add_batch(ref, "chair", 10, None, repo=repo, session=session)
+
+
+def test_hot_sku_is_served_without_reading_its_batches(
+    get_session: sessionmaker[Session], selects: list[str]
+) -> None:
+    cache = BatchCache()
+    add_batch(get_session, cache, "b1")
+    allocate(get_session, cache, "o1", 2)
+    selects.clear()
+
+    assert allocate(get_session, cache, "o2", 3) == "b1"
+    assert allocate(get_session, cache, "o3", 5) == "b1"
+
+    # only the indexed idempotency probes on order_lines
+    assert len(selects) == 2
+    assert all(s.split("FROM")[1].split()[0] == "order_lines" for s in selects)
+    assert cache.stats.hits == 2
+    [cached] = (cache.get("chair") or (0, []))[1]
+    assert cached.available_quantity == 0
+
+
+def test_cached_state_matches_the_database(
+    get_session: sessionmaker[Session],
+) -> None:
+    cache = BatchCache()
+    add_batch(get_session, cache, "b1")
+    allocate(get_session, cache, "o1", 6)
+    allocate(get_session, cache, "o2", 4)
+
+    cache.clear()
+
+    with pytest.raises(model.OutOfStock):
+        allocate(get_session, cache, "o3", 1)
+
+
+def test_add_batch_invalidates_the_sku(get_session: sessionmaker[Session]) -> None:
+    cache = BatchCache()
+    add_batch(get_session, cache, "b1")
+    allocate(get_session, cache, "o1", 10)
+
+    add_batch(get_session, cache, "b2")
+
+    assert cache.get("chair") is None
+    assert allocate(get_session, cache, "o2", 10) == "b2"
+
+
+def test_deallocate_invalidates_the_sku(get_session: sessionmaker[Session]) -> None:
+    cache = BatchCache()
+    add_batch(get_session, cache, "b1")
+    allocate(get_session, cache, "o1", 10)
+
+    with get_session() as session:
+        repo = CachingRepository(session, cache)
+        services.deallocate("o1", "chair", repo=repo, session=session)
+
+    assert cache.get("chair") is None
+    assert allocate(get_session, cache, "o2", 10) == "b1"
+
+
+def test_retried_allocation_is_answered_from_recent_results(
+    get_session: sessionmaker[Session], selects: list[str]
+) -> None:
+    cache, recent = BatchCache(), AllocationCache()
+    add_batch(get_session, cache, "b1")
+    with get_session() as session:
+        repo = CachingRepository(session, cache, recent=recent)
+        assert services.allocate("o1", "chair", 2, repo=repo, session=session) == "b1"
+    selects.clear()
+
+    with get_session() as session:
+        repo = CachingRepository(session, cache, recent=recent)
+        assert services.allocate("o1", "chair", 2, repo=repo, session=session) == "b1"
+
+    # only the sku's version, to check the entry against
+    assert len(selects) == 1
+    assert selects[0].split("FROM")[1].split()[0] == "skus"
+    assert recent.stats.hits == 1
+
+
+def test_recent_results_see_deallocations_by_other_processes(
+    get_session: sessionmaker[Session],
+) -> None:
+    recent, elsewhere = AllocationCache(), AllocationCache()
+    add_batch(get_session, BatchCache(), "b1")
+
+    def allocate_o1(recent: AllocationCache) -> str:
+        with get_session() as session:
+            repo = CachingRepository(session, BatchCache(), recent=recent)
+            return services.allocate("o1", "chair", 2, repo=repo, session=session)
+
+    assert allocate_o1(recent) == "b1"
+    assert allocate_o1(recent) == "b1"
+    with get_session() as session:
+        repo = CachingRepository(session, BatchCache(), recent=elsewhere)
+        services.deallocate("o1", "chair", repo=repo, session=session)
+
+    assert allocate_o1(recent) == "b1"
+    with get_session() as session:
+        [[allocated]] = session.execute(text("SELECT count(*) FROM allocations"))
+    assert allocated == 1
+    assert (recent.stats.hits, recent.stats.misses) == (1, 2)
+
+
+def test_failed_allocation_leaves_the_cache_untouched(
+    get_session: sessionmaker[Session],
+) -> None:
+    cache = BatchCache()
+    add_batch(get_session, cache, "b1")
+    allocate(get_session, cache, "o1", 4)
+
+    with pytest.raises(model.OutOfStock):
+        allocate(get_session, cache, "o2", 20)
+
+    [cached] = (cache.get("chair") or (0, []))[1]
+    assert cached.available_quantity == 6
+
+
+def test_disabled_cache_always_reads_the_database(
+    get_session: sessionmaker[Session], selects: list[str]
+) -> None:
+    cache = BatchCache(enabled=False)
+    add_batch(get_session, cache, "b1")
+    selects.clear()
+
+    allocate(get_session, cache, "o1", 1)
+
+    assert selects != []
+    assert len(cache) == 0
+
+
+def test_requires_expire_on_commit_to_be_disabled(in_memory_db: Engine) -> None:
+    with pytest.raises(ValueError, match="expire_on_commit"):
+        CachingRepository(sessionmaker(bind=in_memory_db)(), BatchCache())
+
+
+def test_sku_changed_by_another_process_is_read_fresh(
+    get_session: sessionmaker[Session], selects: list[str]
+) -> None:
+    cache = BatchCache()
+    add_batch(get_session, cache, "b1")
+    allocate(get_session, cache, "o1", 2)
+    with get_session() as session:
+        session.execute(text("UPDATE skus SET version_number = version_number + 1"))
+        session.commit()
+    selects.clear()
+
+    allocate(get_session, cache, "o2", 2)
+
+    assert any("FROM batches" in statement for statement in selects)
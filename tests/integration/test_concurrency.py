@@ -0,0 +1,156 @@
+import threading
+from collections.abc import Generator
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, clear_mappers, sessionmaker
+
+from allocations.adapters.orm import metadata, start_mappers
+from allocations.adapters.repository import SqlAlchemyRepository
+from allocations.domain import model
+from allocations.service_layer import services
+
+
+@pytest.fixture
+def get_session(tmp_path: Path) -> Generator[sessionmaker[Session], None, None]:
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocations.db'}",
+        connect_args={"timeout": 30, "check_same_thread": False},
+    )
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+def allocate_concurrently(
+    get_session: sessionmaker[Session], lines: list[tuple[str, str, int]]
+) -> list[str | Exception]:
+    results: list[str | Exception] = []
+    barrier = threading.Barrier(len(lines))
+
+    def allocate(orderid: str, sku: str, qty: int) -> None:
+        barrier.wait()
+        with get_session() as session:
+            repo = SqlAlchemyRepository(session)
+            try:
+                results.append(
+                    services.allocate(orderid, sku, qty, repo=repo, session=session)
+                )
+            except model.OutOfStock as e:
+                results.append(e)
+
+    threads = [threading.Thread(target=allocate, args=line) for line in lines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def allocated_quantity(session: Session, sku: str) -> int:
+    return session.execute(  # type: ignore [no-any-return]
+        text(
+            "SELECT coalesce(sum(order_lines.qty), 0) FROM allocations"
+            " JOIN order_lines ON order_lines.id = allocations.orderline_id"
+            " WHERE order_lines.sku = :sku"
+        ),
+        {"sku": sku},
+    ).scalar_one()
+
+
+def test_concurrent_allocations_for_one_sku_never_over_allocate(
+    get_session: sessionmaker[Session],
+) -> None:
+    with get_session() as session:
+        repo = SqlAlchemyRepository(session)
+        services.add_batch("b1", "RED-CHAIR", 10, None, repo=repo, session=session)
+
+    results = allocate_concurrently(
+        get_session, [(f"o{i}", "RED-CHAIR", 1) for i in range(30)]
+    )
+
+    assert results.count("b1") == 10
+    assert sum(isinstance(r, model.OutOfStock) for r in results) == 20
+    with get_session() as session:
+        assert allocated_quantity(session, "RED-CHAIR") == 10
+
+
+def test_concurrent_allocations_across_skus_all_succeed(
+    get_session: sessionmaker[Session],
+) -> None:
+    skus = [f"SKU-{i}" for i in range(5)]
+    with get_session() as session:
+        repo = SqlAlchemyRepository(session)
+        for sku in skus:
+            services.add_batch(f"b-{sku}", sku, 6, None, repo=repo, session=session)
+
+    results = allocate_concurrently(
+        get_session, [(f"o{i}", skus[i % 5], 1) for i in range(30)]
+    )
+
+    batchrefs = [r for r in results if isinstance(r, str)]
+    assert len(batchrefs) == len(results)
+    assert sorted(batchrefs) == sorted(f"b-{sku}" for sku in skus for _ in range(6))
+    with get_session() as session:
+        for sku in skus:
+            assert allocated_quantity(session, sku) == 6
+
+
+def read_model(session: Session, sku: str) -> tuple[int, int]:
+    batches = session.execute(
+        text(
+            "SELECT coalesce(sum(allocated_quantity), 0) FROM batch_availability"
+            " WHERE sku = :sku"
+        ),
+        {"sku": sku},
+    ).scalar_one()
+    total = session.execute(
+        text("SELECT allocated_quantity FROM sku_availability WHERE sku = :sku"),
+        {"sku": sku},
+    ).scalar_one()
+    return batches, total
+
+
+def test_identical_concurrent_allocations_count_the_line_once(
+    get_session: sessionmaker[Session],
+) -> None:
+    with get_session() as session:
+        repo = SqlAlchemyRepository(session)
+        services.add_batch("b1", "LAMP", 10, None, repo=repo, session=session)
+
+    results = allocate_concurrently(get_session, [("o1", "LAMP", 3)] * 4)
+
+    assert results == ["b1"] * 4
+    with get_session() as session:
+        assert allocated_quantity(session, "LAMP") == 3
+        assert read_model(session, "LAMP") == (3, 3)
+
+
+def test_identical_concurrent_bulk_allocations_count_each_line_once(
+    get_session: sessionmaker[Session],
+) -> None:
+    with get_session() as session:
+        repo = SqlAlchemyRepository(session)
+        services.add_batch("b1", "LAMP", 10, None, repo=repo, session=session)
+    lines = [("o1", "LAMP", 3), ("o2", "LAMP", 2)]
+    results: list[list[services.AllocationResult]] = []
+    barrier = threading.Barrier(4)
+
+    def allocate_many() -> None:
+        barrier.wait()
+        with get_session() as session:
+            repo = SqlAlchemyRepository(session)
+            results.append(services.allocate_many(lines, repo=repo, session=session))
+
+    threads = [threading.Thread(target=allocate_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [["b1", "b1"]] * 4
+    with get_session() as session:
+        assert allocated_quantity(session, "LAMP") == 5
+        assert read_model(session, "LAMP") == (5, 5)
@@ -0,0 +1,159 @@
+import asyncio
+from collections.abc import Generator
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.orm import clear_mappers
+
+from allocations.adapters import repository
+from allocations.adapters.orm import start_mappers
+from allocations.domain import model
+from allocations.service_layer import services
+from allocations.service_layer.group_commit import GroupCommit
+
+
+@pytest.fixture
+def get_session(
+    sqlite_async_db: AsyncEngine,
+) -> Generator[async_sessionmaker[AsyncSession], None, None]:
+    start_mappers()
+    yield async_sessionmaker(bind=sqlite_async_db, expire_on_commit=False)
+    clear_mappers()
+
+
+def count_commits(engine: AsyncEngine) -> list[object]:
+    commits: list[object] = []
+    event.listen(engine.sync_engine, "commit", commits.append)
+    return commits
+
+
+async def add_batch(
+    get_session: async_sessionmaker[AsyncSession],
+    ref: str,
+    sku: str,
+    qty: int,
+) -> None:
+    async with get_session() as session:
+        await services.run_async(session, services.add_batch, ref, sku, qty, None)
+
+
+def test_concurrent_allocations_share_one_commit(
+    get_session: async_sessionmaker[AsyncSession],
+    sqlite_async_db: AsyncEngine,
+) -> None:
+    async def scenario() -> list[str]:
+        await add_batch(get_session, "b1", "LAMP", 100)
+        commits = count_commits(sqlite_async_db)
+        group = GroupCommit(get_session, max_delay=0.05)
+        group.start()
+        try:
+            refs = await asyncio.gather(
+                *(group.allocate(f"o{i}", "LAMP", 1) for i in range(20))
+            )
+        finally:
+            await group.close()
+        assert len(commits) == 1
+        return refs
+
+    assert asyncio.run(scenario()) == ["b1"] * 20
+
+
+def test_each_caller_gets_its_own_error(
+    get_session: async_sessionmaker[AsyncSession],
+) -> None:
+    async def scenario() -> list[str | BaseException]:
+        await add_batch(get_session, "b1", "LAMP", 10)
+        group = GroupCommit(get_session, max_delay=0.05)
+        group.start()
+        try:
+            return list(
+                await asyncio.gather(
+                    group.allocate("o1", "LAMP", 8),
+                    group.allocate("o2", "LAMP", 8),
+                    group.allocate("o3", "SOFA", 1),
+                    group.allocate("o4", "LAMP", 2),
+                    return_exceptions=True,
+                )
+            )
+        finally:
+            await group.close()
+
+    ok, out_of_stock, invalid, also_ok = asyncio.run(scenario())
+
+    assert ok == also_ok == "b1"
+    assert isinstance(out_of_stock, model.OutOfStock)
+    assert isinstance(invalid, services.InvalidSku)
+
+
+def test_a_full_group_commits_without_waiting_for_the_window(
+    get_session: async_sessionmaker[AsyncSession],
+    sqlite_async_db: AsyncEngine,
+) -> None:
+    async def scenario() -> int:
+        await add_batch(get_session, "b1", "LAMP", 100)
+        commits = count_commits(sqlite_async_db)
+        group = GroupCommit(get_session, max_delay=60, max_size=5)
+        group.start()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(group.allocate(f"o{i}", "LAMP", 1) for i in range(5))),
+                timeout=5,
+            )
+        finally:
+            await group.close()
+        return len(commits)
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_close_commits_what_is_still_queued(
+    get_session: async_sessionmaker[AsyncSession],
+) -> None:
+    async def scenario() -> list[str]:
+        await add_batch(get_session, "b1", "LAMP", 100)
+        group = GroupCommit(get_session, max_delay=60)
+        group.start()
+        waiting = [
+            asyncio.ensure_future(group.allocate(f"o{i}", "LAMP", 1)) for i in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        await group.close()
+        return await asyncio.gather(*waiting)
+
+    assert asyncio.run(scenario()) == ["b1"] * 3
+
+
+def test_a_failed_transaction_fails_every_caller_in_the_group(
+    get_session: async_sessionmaker[AsyncSession],
+) -> None:
+    class Broken(Exception):
+        pass
+
+    def broken_repository(_session: object) -> repository.AbstractRepository:
+        raise Broken()
+
+    async def scenario() -> list[str | BaseException]:
+        group = GroupCommit(get_session, repo_factory=broken_repository)
+        group.start()
+        try:
+            return list(
+                await asyncio.gather(
+                    group.allocate("o1", "LAMP", 1),
+                    group.allocate("o2", "LAMP", 1),
+                    return_exceptions=True,
+                )
+            )
+        finally:
+            await group.close()
+
+    assert all(isinstance(result, Broken) for result in asyncio.run(scenario()))
+
+
+def test_allocate_requires_a_started_group(
+    get_session: async_sessionmaker[AsyncSession],
+) -> None:
+    group = GroupCommit(get_session)
+
+    with pytest.raises(RuntimeError, match="not been started"):
+        asyncio.run(group.allocate("o1", "LAMP", 1))
@@ -0,0 +1,87 @@
+from collections.abc import Callable
+from typing import Any
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from allocations.adapters.repository import SqlAlchemyRepository
+from allocations.domain import model
+from allocations.service_layer import services
+
+
+@pytest.fixture
+def count_statements(in_memory_db: Engine) -> Callable[[], int]:
+    statements: list[str] = []
+
+    def record(*args: Any) -> None:
+        statements.append(args[2])
+
+    event.listen(in_memory_db, "before_cursor_execute", record)
+
+    def count() -> int:
+        counted = len(statements)
+        statements.clear()
+        return counted
+
+    return count
+
+
+def statements_per_allocate(
+    session: Session,
+    count_statements: Callable[[], int],
+    batches: int,
+    allocations_loading: str,
+) -> int:
+    repo = SqlAlchemyRepository(session, allocations_loading)
+    for i in range(batches):
+        batch = model.Batch(f"b{batches}-{i}", f"sku{batches}", 10)
+        batch.allocate(model.OrderLine(f"old{batches}-{i}", batch.sku, 10))  # full
+        repo.add(batch)
+    repo.add(model.Batch(f"last{batches}", f"sku{batches}", 10))
+    session.commit()
+    session.expunge_all()
+
+    count_statements()
+    services.allocate("new", f"sku{batches}", 1, repo=repo, session=session)
+    return count_statements()
+
+
+@pytest.mark.parametrize("allocations_loading", ["selectin", "joined"])
+def test_allocate_issues_the_same_statements_for_any_number_of_batches(
+    session: Session, count_statements: Callable[[], int], allocations_loading: str
+) -> None:
+    counts = {
+        batches: statements_per_allocate(
+            session, count_statements, batches, allocations_loading
+        )
+        for batches in (1, 10, 50)
+    }
+
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_lazy_loading_issues_a_select_per_batch(
+    session: Session, count_statements: Callable[[], int]
+) -> None:
+    few = statements_per_allocate(session, count_statements, 1, "lazy")
+    many = statements_per_allocate(session, count_statements, 10, "lazy")
+
+    assert many - few == 9
+
+
+def test_allocate_in_sql_cost_does_not_grow_with_allocation_history(
+    session: Session, count_statements: Callable[[], int]
+) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add(model.Batch("b1", "LAMP", 1_000))
+    session.commit()
+
+    counts = []
+    for i in range(50):
+        services.allocate_in_sql(f"o{i}", "LAMP", 1, repo=repo, session=session)
+        counts.append(count_statements())
+
+    assert len(set(counts[1:])) == 1, counts
+    assert repo.list_availability("LAMP")[0].available_quantity == 950
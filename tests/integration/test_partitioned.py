@@ -0,0 +1,360 @@
+import asyncio
+from collections.abc import Generator
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from functools import partial
+from pathlib import Path
+
+import pytest
+from sqlalchemy import Engine, create_engine, event, text
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from allocations.adapters import orm, repository, snapshot
+from allocations.domain import model
+from allocations.service_layer import services, views
+from allocations.service_layer.partitioned import (
+    Partition,
+    PartitionedAllocator,
+    sync_uri,
+)
+
+
+@pytest.fixture
+def database_uri(tmp_path: Path) -> str:
+    uri = f"sqlite:///{tmp_path / 'allocations.db'}"
+    orm.metadata.create_all(create_engine(uri))
+    return uri
+
+
+@pytest.fixture
+def partition(database_uri: str) -> Generator[Partition, None, None]:
+    orm.start_mappers()
+    yield Partition(database_uri)
+    clear_mappers()
+
+
+def allocated_lines(database_uri: str) -> set[tuple[str, str, str]]:
+    with create_engine(database_uri).connect() as connection:
+        rows = connection.execute(
+            text(
+                "SELECT orderid, order_lines.sku, reference FROM allocations"
+                " JOIN order_lines ON order_lines.id = orderline_id"
+                " JOIN batches ON batches.id = batch_id"
+            )
+        )
+        return {tuple(row) for row in rows}
+
+
+def test_partition_allocates_from_memory_after_the_first_load(
+    partition: Partition, database_uri: str
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+    statements: list[str] = []
+    event.listen(
+        partition.session.get_bind(),
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+
+    assert partition.allocate("o1", "LAMP", 3) == "b1"
+    assert partition.allocate("o2", "LAMP", 3) == "b1"
+
+    assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+    assert allocated_lines(database_uri) == {("o1", "LAMP", "b1"), ("o2", "LAMP", "b1")}
+
+
+def test_partition_loads_existing_state_and_replays(
+    partition: Partition, database_uri: str
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+    partition.allocate("o1", "LAMP", 3)
+    clear_mappers()
+    orm.start_mappers()
+    restarted = Partition(database_uri)
+
+    assert restarted.allocate("o1", "LAMP", 3) == "b1"
+    with pytest.raises(model.OutOfStock):
+        restarted.allocate("o2", "LAMP", 8)
+
+
+def test_partition_errors(partition: Partition) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+
+    with pytest.raises(services.InvalidSku):
+        partition.allocate("o1", "SOFA", 1)
+    with pytest.raises(services.NotAllocated):
+        partition.deallocate("o1", "LAMP")
+    results = partition.allocate_many([("o1", "LAMP", 8), ("o2", "LAMP", 8)])
+    assert results[0] == "b1"
+    assert isinstance(results[1], model.OutOfStock)
+
+
+def test_partition_ends_its_transaction_when_it_writes_nothing(
+    partition: Partition,
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+    partition.allocate("o1", "LAMP", 4)
+    engine = partition.session.get_bind()
+    assert isinstance(engine, Engine) and isinstance(engine.pool, QueuePool)
+    refusals = [
+        (services.InvalidSku, partial(partition.allocate, "o2", "SOFA", 1)),
+        (model.OutOfStock, partial(partition.allocate, "o3", "LAMP", 8)),
+        (services.NotAllocated, partial(partition.deallocate, "o4", "TABLE")),
+    ]
+
+    for error, refused in refusals:
+        with pytest.raises(error):
+            refused()
+        assert not partition.session.in_transaction()
+        assert engine.pool.checkedout() == 0
+
+
+def test_partition_deallocates(partition: Partition, database_uri: str) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+    partition.allocate("o1", "LAMP", 10)
+
+    assert partition.deallocate("o1", "LAMP") == "b1"
+    assert partition.allocate("o2", "LAMP", 10) == "b1"
+    assert allocated_lines(database_uri) == {("o2", "LAMP", "b1")}
+
+
+def test_partition_reloads_after_a_failed_commit(
+    partition: Partition, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+
+    def broken_commit() -> None:
+        raise RuntimeError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(partition.session, "commit", broken_commit)
+        with pytest.raises(RuntimeError, match="disk full"):
+            partition.allocate("o1", "LAMP", 10)
+
+    # the refused allocation is gone from memory as well as from the database
+    assert partition.allocate("o2", "LAMP", 10) == "b1"
+
+
+def test_partitions_in_two_processes_never_over_allocate(
+    partition: Partition, database_uri: str
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+    elsewhere = Partition(database_uri)  # the same sku's owner in another process
+
+    assert partition.allocate("o1", "LAMP", 4) == "b1"
+    assert elsewhere.allocate("o2", "LAMP", 4) == "b1"
+    # decided on memory that misses o2, then redone from the database
+    with pytest.raises(model.OutOfStock):
+        partition.allocate("o3", "LAMP", 4)
+    assert partition.allocate("o4", "LAMP", 2) == "b1"
+
+    b1 = views.batch_availability(partition.session, "b1")
+    assert b1 is not None and b1["allocated_quantity"] == 10
+    assert {line[0] for line in allocated_lines(database_uri)} == {"o1", "o2", "o4"}
+
+
+def test_partition_adds_none_of_the_batches_if_one_is_refused(
+    partition: Partition, database_uri: str
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+
+    with pytest.raises(repository.DuplicateBatch):
+        partition.add_batches(
+            [("b2", "LAMP", 10, date(2000, 1, 1)), ("b1", "LAMP", 5, None)]
+        )
+
+    assert partition.allocate("o1", "LAMP", 1) == "b1"
+    assert allocated_lines(database_uri) == {("o1", "LAMP", "b1")}
+    assert views.batch_availability(partition.session, "b2") is None
+
+
+def take_snapshot(database_uri: str, path: Path) -> None:
+    with sessionmaker(bind=create_engine(database_uri))() as session:
+        snapshot.dump(repository.SqlAlchemyRepository(session), path)
+
+
+@pytest.fixture
+def mappers() -> Generator[None, None, None]:
+    orm.start_mappers()
+    yield
+    clear_mappers()
+
+
+def test_partition_warms_from_a_snapshot_and_catches_up(
+    partition: Partition, database_uri: str, tmp_path: Path
+) -> None:
+    saved = tmp_path / "allocations.snapshot"
+    partition.add_batches([("b1", "LAMP", 10, None), ("b2", "SOFA", 10, None)])
+    partition.allocate("o1", "LAMP", 3)
+    partition.allocate("o1", "SOFA", 3)
+    take_snapshot(database_uri, saved)
+    # committed after the snapshot: SOFA and TABLE need catching up
+    partition.allocate("o2", "SOFA", 5)
+    partition.add_batches([("b3", "TABLE", 10, None)])
+    clear_mappers()
+    orm.start_mappers()
+    restarted = Partition(database_uri)
+
+    with snapshot.open_snapshot(saved) as opened:
+        assert restarted.warm(opened, lambda sku: sku != "CHAIR") == (1, 2)
+    statements: list[str] = []
+    event.listen(
+        restarted.session.get_bind(),
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+
+    assert restarted.allocate("o1", "LAMP", 3) == "b1"  # replayed from memory
+    assert restarted.allocate("o3", "LAMP", 7) == "b1"
+    with pytest.raises(model.OutOfStock):
+        restarted.allocate("o4", "LAMP", 1)
+    with pytest.raises(model.OutOfStock):
+        restarted.allocate("o3", "SOFA", 3)
+    assert restarted.allocate("o3", "TABLE", 3) == "b3"
+    assert restarted.deallocate("o1", "LAMP") == "b1"
+    assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+    assert {line[:2] for line in allocated_lines(database_uri)} == {
+        ("o1", "SOFA"),
+        ("o2", "SOFA"),
+        ("o3", "LAMP"),
+        ("o3", "TABLE"),
+    }
+
+
+def test_partition_writes_move_sku_versions_on(partition: Partition) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None)])
+    before = partition.repo.get_versions()["LAMP"]
+
+    partition.allocate("o1", "LAMP", 3)
+    partition.allocate("o1", "LAMP", 3)  # a replay writes nothing
+    partition.deallocate("o1", "LAMP")
+
+    assert partition.repo.get_versions()["LAMP"] == before + 2
+
+
+def test_partition_writes_keep_the_availability_read_model(
+    partition: Partition,
+) -> None:
+    partition.add_batches([("b1", "LAMP", 10, None), ("b2", "LAMP", 10, None)])
+    partition.allocate_many([("o1", "LAMP", 4), ("o2", "LAMP", 6), ("o3", "LAMP", 3)])
+    partition.deallocate("o1", "LAMP")
+
+    lamp = views.sku_availability(partition.session, "LAMP")
+    b1 = views.batch_availability(partition.session, "b1")
+    assert lamp is not None and b1 is not None
+    assert (lamp["allocated_quantity"], b1["allocated_quantity"]) == (9, 6)
+
+
+def test_owner_is_stable_and_spreads_skus() -> None:
+    allocator = PartitionedAllocator("sqlite:///allocations.db", partitions=4)
+
+    owners = [allocator.owner(f"sku-{i}") for i in range(100)]
+
+    assert owners == [allocator.owner(f"sku-{i}") for i in range(100)]
+    assert set(owners) == {0, 1, 2, 3}
+
+
+def test_sync_uri_swaps_async_drivers_for_blocking_ones() -> None:
+    assert sync_uri("sqlite+aiosqlite:///x.db") == "sqlite:///x.db"
+    assert sync_uri("postgresql+asyncpg://u:p@h:5432/db") == (
+        "postgresql://u:p@h:5432/db"
+    )
+
+
+def test_allocator_refuses_an_in_memory_database() -> None:
+    with pytest.raises(ValueError, match="in-memory"):
+        PartitionedAllocator("sqlite+aiosqlite://")
+    with pytest.raises(ValueError, match="in-memory"):
+        PartitionedAllocator("sqlite:///:memory:")
+
+
+def test_allocator_routes_skus_to_worker_processes(database_uri: str) -> None:
+    allocator = PartitionedAllocator(database_uri, partitions=2)
+
+    async def scenario() -> list[services.AllocationResult]:
+        skus = ["LAMP", "SOFA", "TABLE", "CHAIR"]
+        await allocator.add_batches([(f"b-{sku}", sku, 10, None) for sku in skus])
+        results = await allocator.allocate_many(
+            [(f"o-{sku}", sku, 4) for sku in skus] + [("o-x", "STOOL", 1)]
+        )
+        results.append(await allocator.allocate("o-LAMP", "LAMP", 4))
+        results.append(await allocator.deallocate("o-SOFA", "SOFA"))
+        return results
+
+    allocator.start()
+    try:
+        results = asyncio.run(scenario())
+    finally:
+        allocator.close()
+
+    *refs, invalid, replayed, deallocated = results
+    assert refs == ["b-LAMP", "b-SOFA", "b-TABLE", "b-CHAIR"]
+    assert isinstance(invalid, services.InvalidSku)
+    assert replayed == "b-LAMP"
+    assert deallocated == "b-SOFA"
+    assert {line[0] for line in allocated_lines(database_uri)} == {
+        "o-LAMP",
+        "o-TABLE",
+        "o-CHAIR",
+    }
+
+
+def test_allocator_workers_start_cold_from_a_damaged_snapshot(
+    database_uri: str, tmp_path: Path
+) -> None:
+    saved = tmp_path / "allocations.snapshot"
+    saved.write_bytes(b"ALLOC")
+    allocator = PartitionedAllocator(database_uri, partitions=1, snapshot=saved)
+
+    async def scenario() -> str:
+        await allocator.add_batches([("b1", "LAMP", 10, None)])
+        return await allocator.allocate("o1", "LAMP", 1)
+
+    allocator.start()
+    try:
+        assert asyncio.run(scenario()) == "b1"
+    finally:
+        allocator.close()
+
+
+def test_allocator_replaces_a_worker_that_died(database_uri: str) -> None:
+    allocator = PartitionedAllocator(database_uri, partitions=1)
+
+    async def scenario() -> str:
+        await allocator.add_batches([("b1", "LAMP", 10, None)])
+        [process] = allocator._workers[0]._processes.values()
+        process.kill()
+        with pytest.raises(BrokenProcessPool):
+            await allocator.allocate("o1", "LAMP", 1)
+        return await allocator.allocate("o1", "LAMP", 1)
+
+    allocator.start()
+    try:
+        assert asyncio.run(scenario()) == "b1"
+    finally:
+        allocator.close()
+
+
+@pytest.mark.usefixtures("mappers")
+def test_allocator_workers_warm_up_from_a_snapshot(
+    database_uri: str, tmp_path: Path
+) -> None:
+    saved = tmp_path / "allocations.snapshot"
+    skus = ["LAMP", "SOFA", "TABLE", "CHAIR"]
+    seed = PartitionedAllocator(database_uri, partitions=2)
+    seed.start()
+    try:
+        asyncio.run(seed.add_batches([(f"b-{sku}", sku, 10, None) for sku in skus]))
+    finally:
+        seed.close()
+    take_snapshot(database_uri, saved)
+    allocator = PartitionedAllocator(database_uri, partitions=2, snapshot=saved)
+
+    allocator.start()
+    try:
+        refs = asyncio.run(allocator.allocate_many([(f"o-{s}", s, 10) for s in skus]))
+    finally:
+        allocator.close()
+
+    assert refs == [f"b-{sku}" for sku in skus]
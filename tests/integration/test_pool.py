@@ -0,0 +1,80 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from allocations import config
+from allocations.adapters.orm import metadata
+from allocations.adapters.pool import InstrumentedAsyncQueuePool
+
+
+def test_pool_settings_are_read_from_the_environment(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    monkeypatch.setenv("DB_POOL_RECYCLE", "1800")
+
+    settings = config.get_pool_settings()
+
+    assert settings["pool_size"] == 20
+    assert settings["max_overflow"] == 10
+    assert settings["pool_recycle"] == 1800
+
+
+def test_pool_records_checkout_waits_and_in_use_counts(tmp_path: Path) -> None:
+    path = tmp_path / "allocations.db"
+    metadata.create_all(create_engine(f"sqlite:///{path}"))
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{path}",
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=5,
+    )
+    engine_pool = engine.pool
+    assert isinstance(engine_pool, InstrumentedAsyncQueuePool)
+
+    async def query(in_use: list[int]) -> None:
+        async with engine.connect() as connection:
+            in_use.append(engine_pool.checkedout())
+            await connection.execute(text("SELECT count(*) FROM batches"))
+            await asyncio.sleep(0.01)
+
+    async def scenario() -> list[int]:
+        in_use: list[int] = []
+        await asyncio.gather(*(query(in_use) for _ in range(3)))
+        await engine.dispose()
+        return in_use
+
+    in_use = asyncio.run(scenario())
+    stats = engine_pool.snapshot()
+
+    assert in_use == [1, 1, 1]
+    assert stats["checkouts"] == 3
+    assert stats["checked_out"] == 0
+    assert stats["wait_seconds_max"] >= 0.01
+
+
+def test_pool_counts_checkout_timeouts(tmp_path: Path) -> None:
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'allocations.db'}",
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.01,
+    )
+    engine_pool = engine.pool
+    assert isinstance(engine_pool, InstrumentedAsyncQueuePool)
+
+    async def scenario() -> None:
+        async with engine.connect():
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass  # pragma: no cover
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+    assert engine_pool.stats.timeouts == 1
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from pathlib import Path
+
+import httpx
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+from allocations import config
+from allocations.adapters import orm, sqlite
+from allocations.endpoints.app import create_app
+
+
+def test_sqlite_backend_is_selected_from_the_environment(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.delenv("DB_BACKEND", raising=False)
+    assert config.Settings().database_uri.startswith("postgresql+asyncpg://")
+
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.setenv("SQLITE_PATH", "/var/lib/allocations.db")
+    monkeypatch.setenv("SQLITE_SYNCHRONOUS", "FULL")
+
+    settings = config.Settings()
+    assert settings.database_uri == "sqlite+aiosqlite:////var/lib/allocations.db"
+    assert settings.sqlite["synchronous"] == "FULL"
+    assert config.get_database_uri() == "sqlite:////var/lib/allocations.db"
+    assert sqlite.is_sqlite(settings.database_uri)
+    assert not sqlite.is_sqlite(config.get_async_postgres_uri())
+
+
+def test_tuned_connections_use_wal_and_the_pragmas(tmp_path: Path) -> None:
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocations.db'}")
+    sqlite.tune(engine, {**config.get_sqlite_settings(), "busy_timeout": 1234})
+
+    with engine.connect() as connection:
+        pragmas = {
+            name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size")
+        }
+    engine.dispose()
+
+    # synchronous 1 is NORMAL
+    assert pragmas == {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "busy_timeout": 1234,
+        "cache_size": -64 * 1024,
+    }
+
+
+def test_transactions_take_the_write_lock_when_they_begin(tmp_path: Path) -> None:
+    path = tmp_path / "allocations.db"
+    first, second = (create_engine(f"sqlite:///{path}") for _ in range(2))
+    for engine in (first, second):
+        sqlite.tune(engine, {"journal_mode": "WAL", "busy_timeout": 0})
+
+    with first.begin() as writing:
+        writing.execute(text("SELECT 1"))  # reads only, yet holds the lock
+        with pytest.raises(exc.OperationalError, match="database is locked"):
+            with second.begin():
+                pass  # pragma: no cover
+    with second.begin():
+        pass
+    first.dispose()
+    second.dispose()
+
+
+def test_concurrent_allocations_on_sqlite_all_succeed(tmp_path: Path) -> None:
+    path = tmp_path / "allocations.db"
+    orm.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    settings = config.Settings(
+        database_uri=f"sqlite+aiosqlite:///{path}", log_level=logging.WARNING
+    )
+    app = create_app(settings)
+
+    async def scenario() -> list[httpx.Response]:
+        transport = httpx.ASGITransport(app=app)
+        async with (
+            app.router.lifespan_context(app),
+            httpx.AsyncClient(transport=transport, base_url="http://test") as client,
+        ):
+            for n in range(4):
+                await client.post(
+                    "/add_batch",
+                    json={"ref": f"b{n}", "sku": f"sku-{n}", "qty": 1000, "eta": None},
+                )
+            return await asyncio.gather(
+                *(
+                    client.post(
+                        "/allocate",
+                        json={"orderid": f"o{n}", "sku": f"sku-{n % 4}", "qty": 1},
+                    )
+                    for n in range(100)
+                )
+            )
+
+    responses = asyncio.run(scenario())
+
+    assert [r.status_code for r in responses] == [201] * 100
+    with create_engine(f"sqlite:///{path}").connect() as connection:
+        allocated = connection.execute(
+            text("SELECT sum(allocated_quantity) FROM sku_availability")
+        ).scalar()
+    assert allocated == 100
+
+
+def test_availability_is_read_while_another_connection_writes(tmp_path: Path) -> None:
+    path = tmp_path / "allocations.db"
+    orm.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    settings = config.Settings(
+        database_uri=f"sqlite+aiosqlite:///{path}", log_level=logging.WARNING
+    )
+    settings.sqlite["busy_timeout"] = 0
+    app = create_app(settings)
+    writer = create_engine(f"sqlite:///{path}")
+    sqlite.tune(writer, settings.sqlite)
+
+    async def scenario() -> list[httpx.Response]:
+        transport = httpx.ASGITransport(app=app)
+        async with (
+            app.router.lifespan_context(app),
+            httpx.AsyncClient(transport=transport, base_url="http://test") as client,
+        ):
+            await client.post(
+                "/add_batch", json={"ref": "b1", "sku": "LAMP", "qty": 10, "eta": None}
+            )
+            with writer.begin():
+                # holds the write lock until the reads are answered
+                return [
+                    await client.get("/skus/LAMP/availability"),
+                    await client.get("/batches/b1"),
+                ]
+
+    responses = asyncio.run(scenario())
+    writer.dispose()
+
+    assert [r.status_code for r in responses] == [200, 200]
+    assert responses[0].json()["available_quantity"] == 10
@@ -3,7 +3,7 @@ from datetime import date, timedelta
 import pytest
 from pydantic import PositiveInt
 
-from allocations.domain.model import Batch, OrderLine, OutOfStock, allocate
+from allocations.domain.model import Batch, BatchIndex, OrderLine, OutOfStock, allocate
 
 today = date.today()
 tommorow = today + timedelta(days=1)
@@ -126,3 +126,52 @@ def test_raises_out_of_stock_if_cannot_allocate() -> None:
 
     with pytest.raises(OutOfStock, match="chair"):
         allocate(OrderLine("order-id-2", "chair", 20), [in_stock_batch])
+
+
+def test_batch_index_keeps_in_stock_then_earliest_eta_order() -> None:
+    latest_batch = Batch("latest-batch", sku="chair", qty=20, eta=later)
+    in_stock_batch = Batch("in-stock-batch", sku="chair", qty=20)
+    earliest_batch = Batch("earliest-batch", sku="chair", qty=20, eta=today)
+    other_sku_batch = Batch("other-batch", sku="table", qty=20)
+
+    index = BatchIndex([latest_batch, other_sku_batch, earliest_batch])
+    index.update(in_stock_batch)
+
+    assert index.batches("chair") == [in_stock_batch, earliest_batch, latest_batch]
+    assert index.batches("table") == [other_sku_batch]
+    assert "lamp" not in index
+
+
+def test_allocate_with_index_skips_depleted_batches() -> None:
+    depleted_batch = Batch("depleted-batch", sku="chair", qty=2)
+    later_batch = Batch("later-batch", sku="chair", qty=20, eta=later)
+    index = BatchIndex([later_batch, depleted_batch])
+    allocate(OrderLine("order-1", "chair", 2), index)
+
+    allocation_ref = allocate(OrderLine("order-2", "chair", 2), index)
+
+    assert allocation_ref == later_batch.reference
+    assert depleted_batch.available_quantity == 0
+
+
+def test_batch_index_leaves_out_used_up_batches_until_restocked() -> None:
+    used_up_batch = Batch("used-up-batch", sku="chair", qty=2)
+    used_up_batch.allocate(OrderLine("order-1", "chair", 2))
+    later_batch = Batch("later-batch", sku="chair", qty=2, eta=later)
+    index = BatchIndex([later_batch, used_up_batch])
+    assert index.batches("chair") == [later_batch]
+
+    allocate(OrderLine("order-2", "chair", 2), index)
+    assert index.batches("chair") == []
+    assert "chair" in index  # out of stock, not unknown
+
+    used_up_batch.deallocate(OrderLine("order-1", "chair", 2))
+    index.update(used_up_batch)
+    assert index.batches("chair") == [used_up_batch]
+
+
+def test_allocate_with_index_raises_out_of_stock_for_unknown_sku() -> None:
+    index = BatchIndex([Batch("batch", sku="chair", qty=20)])
+
+    with pytest.raises(OutOfStock, match="lamp"):
+        allocate(OrderLine("order-id", "lamp", 1), index)
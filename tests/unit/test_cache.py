@@ -0,0 +1,54 @@
+import time
+
+from allocations.adapters.cache import BatchCache
+from allocations.domain import model
+
+
+def test_cache_counts_hits_and_misses() -> None:
+    cache = BatchCache()
+    batches = [model.Batch("b1", "chair", 10)]
+
+    assert cache.get("chair") is None
+    cache.put("chair", batches)
+
+    assert cache.get("chair") == (0, batches)
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+
+
+def test_cache_evicts_least_recently_used_sku() -> None:
+    cache = BatchCache(maxsize=2)
+    cache.put("chair", [])
+    cache.put("table", [])
+    cache.get("chair")
+
+    cache.put("lamp", [])
+
+    assert cache.get("table") is None
+    assert cache.get("chair") == (0, [])
+    assert cache.stats.evictions == 1
+
+
+def test_cache_entries_expire_after_ttl() -> None:
+    cache = BatchCache(ttl=0.01)
+    cache.put("chair", [])
+
+    time.sleep(0.02)
+
+    assert cache.get("chair") is None
+
+
+def test_invalidate_drops_the_sku() -> None:
+    cache = BatchCache()
+    cache.put("chair", [])
+
+    cache.invalidate("chair")
+
+    assert cache.get("chair") is None
+
+
+def test_disabled_cache_never_stores_anything() -> None:
+    cache = BatchCache(enabled=False)
+    cache.put("chair", [])
+
+    assert cache.get("chair") is None
+    assert len(cache) == 0
@@ -0,0 +1,72 @@
+from collections.abc import Iterator
+
+import pytest
+from sqlalchemy.orm import Session
+
+from allocations.adapters import metrics
+from allocations.adapters.repository import SqlAlchemyRepository
+from allocations.domain import model
+from allocations.service_layer import services
+
+
+@pytest.fixture
+def registry() -> Iterator[metrics.Metrics]:
+    metrics.registry.reset()
+    metrics.instrument_orm()
+    yield metrics.registry
+    metrics.uninstrument_orm()
+    metrics.registry.reset()
+
+
+def test_renders_counters_and_histograms_in_prometheus_text() -> None:
+    registry = metrics.Metrics(buckets=(0.1, 1.0))
+    registry.inc("requests_total", service="allocate")
+    registry.inc("requests_total", service="allocate")
+    registry.observe("stage_seconds", 0.5, stage="commit")
+
+    assert registry.render(gauges={"cache_size": 3}).splitlines() == [
+        "# TYPE allocations_requests_total counter",
+        'allocations_requests_total{service="allocate"} 2',
+        "# TYPE allocations_stage_seconds histogram",
+        'allocations_stage_seconds_bucket{stage="commit",le="0.1"} 0',
+        'allocations_stage_seconds_bucket{stage="commit",le="1"} 1',
+        'allocations_stage_seconds_bucket{stage="commit",le="+Inf"} 1',
+        'allocations_stage_seconds_sum{stage="commit"} 0.5',
+        'allocations_stage_seconds_count{stage="commit"} 1',
+        "# TYPE allocations_cache_size gauge",
+        "allocations_cache_size 3",
+    ]
+
+
+def test_disabled_registry_records_nothing() -> None:
+    registry = metrics.Metrics(enabled=False)
+    registry.inc("requests_total")
+    with registry.stage("load"):
+        pass
+
+    assert registry.render() == "\n"
+
+
+def test_allocate_times_each_stage(session: Session, registry: metrics.Metrics) -> None:
+    repo = SqlAlchemyRepository(session)
+    batch = model.Batch("b1", "LAMP", 100)
+    batch.allocate(model.OrderLine("o1", "LAMP", 10))
+    repo.add(batch)
+    session.commit()
+    session.expunge_all()
+
+    services.allocate("o2", "LAMP", 10, repo, session)
+    with pytest.raises(model.OutOfStock):
+        services.allocate("o3", "LAMP", 1_000, repo, session)
+    with pytest.raises(services.InvalidSku):
+        services.allocate("o4", "NOPE", 1, repo, session)
+
+    text = registry.render()
+    assert 'allocations_requests_total{service="allocate"} 3' in text
+    assert "allocations_out_of_stock_total 1" in text
+    assert "allocations_invalid_sku_total 1" in text
+    assert 'allocations_rows_loaded_total{entity="batch"} 2' in text
+    assert 'allocations_rows_loaded_total{entity="relationship"}' in text
+    assert 'allocations_stage_seconds_count{stage="hydrate"}' in text
+    for stage, count in [("load", 3), ("allocate", 2), ("commit", 1)]:
+        assert f'allocations_stage_seconds_count{{stage="{stage}"}} {count}' in text
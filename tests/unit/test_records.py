@@ -0,0 +1,61 @@
+import time
+import tracemalloc
+from collections.abc import Callable
+from datetime import date
+
+import pytest
+
+from allocations.domain.model import Batch, BatchRecord, OrderLine, OrderLineRecord
+
+N = 10_000
+
+
+def measure(factory: Callable[[int], object]) -> tuple[float, float]:
+    """Bytes and seconds per object for building N objects with factory."""
+    tracemalloc.start()
+    objects = [factory(i) for i in range(N)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    start = time.perf_counter()
+    for i in range(N):
+        factory(i)
+    return allocated / N, (time.perf_counter() - start) / N
+
+
+@pytest.mark.usefixtures("session")  # measure the classes as mapped
+def test_records_are_leaner_than_mapped_objects() -> None:
+    refs = [f"ref-{i}" for i in range(N)]
+    line_bytes, line_secs = measure(lambda i: OrderLine(refs[i], "LAMP", 1))
+    record_bytes, record_secs = measure(lambda i: OrderLineRecord(refs[i], "LAMP", 1))
+    assert record_bytes * 4 < line_bytes
+    assert record_secs < line_secs
+
+    batch_bytes, batch_secs = measure(lambda i: Batch(refs[i], "LAMP", 1))
+    record_bytes, record_secs = measure(lambda i: BatchRecord(refs[i], "LAMP", None, 1))
+    assert record_bytes * 4 < batch_bytes
+    assert record_secs < batch_secs
+
+
+def test_records_have_no_instance_dict() -> None:
+    assert not hasattr(OrderLineRecord("o1", "LAMP", 1), "__dict__")
+    assert not hasattr(BatchRecord("b1", "LAMP", None, 1), "__dict__")
+
+
+def test_batch_record_mirrors_batch() -> None:
+    batch = Batch("b1", "LAMP", 20, eta=date.today())
+    batch.allocate(OrderLine("o1", "LAMP", 2))
+    record = BatchRecord.from_batch(batch)
+    assert record == BatchRecord("b1", "SOFA", None, 1)  # same reference
+    assert record != batch and batch != record
+    assert hash(record) == hash(batch)
+    assert record.eta == batch.eta
+    assert record.available_quantity == batch.available_quantity == 18
+
+
+def test_order_line_record_has_value_semantics() -> None:
+    line = OrderLine("o1", "LAMP", 2)
+    assert OrderLineRecord.from_line(line) == OrderLineRecord("o1", "LAMP", 2)
+    assert (
+        len({OrderLineRecord("o1", "LAMP", 2), OrderLineRecord("o1", "LAMP", 2)}) == 1
+    )
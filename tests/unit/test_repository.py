@@ -1,7 +1,17 @@
+from datetime import date
+from typing import Any
+
+import pytest
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
-from allocations.adapters.repository import SqlAlchemyRepository
+from allocations.adapters.backfill import backfill
+from allocations.adapters.repository import (
+    ConcurrentUpdate,
+    DuplicateBatch,
+    SqlAlchemyRepository,
+    UnversionedSku,
+)
 from allocations.domain import model
 
 
@@ -73,6 +83,23 @@ def test_repository_can_retrieve_a_batch_with_allocations(session: Session) -> N
     assert retrieved.sku == expected.sku
     assert retrieved._purchased_quantity == expected._purchased_quantity
     assert retrieved._allocations == {model.OrderLine("order1", "chair", 12)}
+    assert retrieved.available_quantity == 88
+
+
+def test_retrieved_batch_keeps_allocated_quantity_up_to_date(
+    session: Session,
+) -> None:
+    orderline_id = insert_order_line(session=session)
+    batch_id = insert_batch(session=session, batch_reference="batch1")
+    insert_allocation(session=session, orderline_id=orderline_id, batch_id=batch_id)
+
+    retrieved = SqlAlchemyRepository(session=session).get("batch1")
+    retrieved.allocate(model.OrderLine("order2", "chair", 8))
+    session.commit()
+
+    assert retrieved.allocated_quantity == 20
+    retrieved.deallocate(model.OrderLine("order1", "chair", 12))
+    assert retrieved.available_quantity == 92
 
 
 def test_repository_list_returns_all_batches(session: Session) -> None:
@@ -84,3 +111,258 @@ def test_repository_list_returns_all_batches(session: Session) -> None:
     repo.add(batch2)
 
     assert repo.list() == [batch1, batch2]
+
+
+def test_repository_list_by_sku_returns_only_batches_for_that_sku(
+    session: Session,
+) -> None:
+    batch1 = model.Batch("batch1", sku="chair", qty=10)
+    batch2 = model.Batch("batch2", sku="table", qty=10)
+    batch3 = model.Batch("batch3", sku="chair", qty=10)
+
+    repo = SqlAlchemyRepository(session)
+    for batch in (batch1, batch2, batch3):
+        repo.add(batch)
+
+    assert repo.list_by_sku("chair") == [batch1, batch3]
+    assert repo.list_by_sku("unknown") == []
+
+
+def test_repository_list_by_skus_returns_batches_for_all_given_skus(
+    session: Session,
+) -> None:
+    batch1 = model.Batch("batch1", sku="chair", qty=10)
+    batch2 = model.Batch("batch2", sku="table", qty=10)
+    batch3 = model.Batch("batch3", sku="lamp", qty=10)
+
+    repo = SqlAlchemyRepository(session)
+    for batch in (batch1, batch2, batch3):
+        repo.add(batch)
+
+    assert repo.list_by_skus({"chair", "lamp"}) == [batch1, batch3]
+
+
+def test_lock_skus_bumps_the_sku_version(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add(model.Batch("batch1", sku="chair", qty=10))
+    session.commit()
+
+    repo.lock_skus(["chair", "unknown"])
+    repo.lock_skus(["chair"])
+
+    assert repo.versions == {"chair": 2}
+    [[version]] = session.execute(
+        text("SELECT version_number FROM skus WHERE sku='chair'")
+    )
+    assert version == 2
+
+
+def test_lock_skus_refuses_batches_from_before_the_skus_table(
+    session: Session,
+) -> None:
+    session.execute(
+        text(
+            "INSERT INTO batches (reference, sku, _purchased_quantity)"
+            " VALUES ('old1', 'chair', 10), ('old2', 'chair', 5)"
+        )
+    )
+    repo = SqlAlchemyRepository(session)
+
+    with pytest.raises(UnversionedSku, match="chair"):
+        repo.lock_skus(["chair"])
+
+    assert backfill(session.connection())["skus"] == 1
+    assert backfill(session.connection())["skus"] == 0
+    repo.lock_skus(["chair"])
+    assert repo.versions == {"chair": 1}
+
+
+def test_repository_add_many_inserts_rows_directly(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add_many(
+        [
+            model.Batch("batch1", sku="chair", qty=10),
+            model.Batch("batch2", sku="table", qty=20, eta=date(2011, 1, 1)),
+        ]
+    )
+    session.commit()
+
+    assert list(
+        session.execute(
+            text("SELECT reference, sku, _purchased_quantity, eta FROM batches")
+        )
+    ) == [("batch1", "chair", 10, None), ("batch2", "table", 20, "2011-01-01")]
+    assert repo.list_by_sku("table")[0].eta == date(2011, 1, 1)
+    assert sorted(session.execute(text("SELECT sku FROM skus"))) == [
+        ("chair",),
+        ("table",),
+    ]
+
+
+def test_get_by_orderline_returns_the_batch_holding_the_line(session: Session) -> None:
+    batch1 = model.Batch("batch1", sku="chair", qty=10)
+    batch2 = model.Batch("batch2", sku="chair", qty=10)
+    batch2.allocate(model.OrderLine("order1", "chair", 2))
+    repo = SqlAlchemyRepository(session)
+    repo.add(batch1)
+    repo.add(batch2)
+    session.commit()
+
+    assert repo.get_by_orderline("order1", "chair") == batch2
+    assert repo.get_by_orderline("order1", "table") is None
+    assert repo.get_by_orderline("order2", "chair") is None
+
+
+def test_list_availability_sums_allocations_in_allocation_order(
+    session: Session,
+) -> None:
+    later = model.Batch("later", sku="chair", qty=10, eta=date(2011, 1, 2))
+    sooner = model.Batch("sooner", sku="chair", qty=10, eta=date(2011, 1, 1))
+    in_stock = model.Batch("in-stock", sku="chair", qty=10)
+    sooner.allocate(model.OrderLine("order1", "chair", 2))
+    sooner.allocate(model.OrderLine("order2", "chair", 3))
+    repo = SqlAlchemyRepository(session)
+    for batch in (later, sooner, in_stock, model.Batch("other", "table", 1)):
+        repo.add(batch)
+    session.commit()
+
+    assert [
+        (r.reference, r.available_quantity) for r in repo.list_availability("chair")
+    ] == [("in-stock", 10), ("sooner", 5), ("later", 10)]
+
+
+def test_add_allocation_inserts_only_the_new_line(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add(model.Batch("batch1", sku="chair", qty=10))
+    session.commit()
+
+    repo.add_allocation("batch1", model.OrderLine("order1", "chair", 4))
+    session.commit()
+
+    [record] = repo.list_availability("chair")
+    assert record.available_quantity == 6
+    assert repo.get_by_orderline("order1", "chair") == model.Batch("batch1", "", 0)
+
+
+def test_get_allocations_finds_each_orders_batch(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    batch = model.Batch("batch1", sku="chair", qty=10)
+    batch.allocate(model.OrderLine("order1", "chair", 2))
+    repo.add(batch)
+    session.commit()
+
+    assert repo.get_allocations(
+        [("order1", "chair"), ("order1", "table"), ("order2", "chair")]
+    ) == {("order1", "chair"): "batch1"}
+
+
+def test_an_order_gets_one_line_per_sku(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add(model.Batch("batch1", sku="chair", qty=10))
+    repo.add_allocation("batch1", model.OrderLine("order1", "chair", 2))
+
+    with pytest.raises(ConcurrentUpdate):
+        repo.add_allocation("batch1", model.OrderLine("order1", "chair", 3))
+
+
+def test_deallocating_deletes_the_line(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    batch = model.Batch("batch1", sku="chair", qty=10)
+    batch.allocate(model.OrderLine("order1", "chair", 2))
+    repo.add(batch)
+    session.commit()
+
+    batch.deallocate(model.OrderLine("order1", "chair", 2))
+    session.commit()
+
+    assert list(session.execute(text("SELECT * FROM order_lines"))) == []
+
+
+def availability(session: Session) -> tuple[list[Any], list[Any]]:
+    batches = session.execute(
+        text(
+            "SELECT reference, sku, purchased_quantity, allocated_quantity"
+            " FROM batch_availability ORDER BY reference"
+        )
+    )
+    skus = session.execute(
+        text(
+            "SELECT sku, batches, purchased_quantity, allocated_quantity"
+            " FROM sku_availability ORDER BY sku"
+        )
+    )
+    return [tuple(row) for row in batches], [tuple(row) for row in skus]
+
+
+def test_adding_batches_fills_the_availability_read_model(session: Session) -> None:
+    allocated = model.Batch("batch1", sku="chair", qty=10)
+    allocated.allocate(model.OrderLine("order1", "chair", 2))
+    repo = SqlAlchemyRepository(session)
+    repo.add(allocated)
+    repo.add_many(
+        [model.Batch("batch2", sku="chair", qty=5), model.Batch("batch3", "table", 1)]
+    )
+    session.commit()
+
+    assert availability(session) == (
+        [
+            ("batch1", "chair", 10, 2),
+            ("batch2", "chair", 5, 0),
+            ("batch3", "table", 1, 0),
+        ],
+        [("chair", 2, 15, 2), ("table", 1, 1, 0)],
+    )
+    with pytest.raises(DuplicateBatch, match="Batch batch1 already exists"):
+        repo.add(model.Batch("batch1", sku="chair", qty=1))
+
+
+def test_allocations_move_the_availability_read_model(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add_many(
+        [model.Batch("batch1", sku="chair", qty=10), model.Batch("batch2", "chair", 5)]
+    )
+    session.commit()
+
+    repo.add_allocation("batch1", model.OrderLine("order1", "chair", 4))
+    repo.update_availability(
+        [("batch1", "chair", 3), ("batch2", "chair", 5), ("batch1", "chair", -4)]
+    )
+    session.commit()
+
+    assert availability(session) == (
+        [("batch1", "chair", 10, 3), ("batch2", "chair", 5, 5)],
+        [("chair", 2, 15, 8)],
+    )
+
+
+def test_backfill_rebuilds_the_read_model_for_older_batches(session: Session) -> None:
+    repo = SqlAlchemyRepository(session)
+    repo.add(model.Batch("new", sku="lamp", qty=5))
+    session.execute(
+        text(
+            "INSERT INTO batches (reference, sku, _purchased_quantity)"
+            " VALUES ('old1', 'chair', 10), ('old2', 'chair', 5), ('old3', 'lamp', 7)"
+        )
+    )
+    orderline_id = insert_order_line(session)
+    session.execute(
+        text(
+            "INSERT INTO allocations (orderline_id, batch_id)"
+            " SELECT :orderline_id, id FROM batches WHERE reference = 'old1'"
+        ),
+        {"orderline_id": orderline_id},
+    )
+
+    added = backfill(session.connection())
+
+    assert added == {"skus": 1, "batch_availability": 3, "sku_availability": 2}
+    assert availability(session) == (
+        [
+            ("new", "lamp", 5, 0),
+            ("old1", "chair", 10, 12),
+            ("old2", "chair", 5, 0),
+            ("old3", "lamp", 7, 0),
+        ],
+        [("chair", 2, 15, 12), ("lamp", 2, 12, 0)],
+    )
+    assert backfill(session.connection()) == dict.fromkeys(added, 0)
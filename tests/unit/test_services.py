@@ -1,4 +1,8 @@
+from collections.abc import Collection, Iterable, Iterator, Sequence
+from datetime import date
+
 import pytest
+from sqlalchemy.exc import IntegrityError
 
 from allocations.adapters import repository
 from allocations.domain import model
@@ -8,22 +12,74 @@ from allocations.service_layer import services
 class FakeRepository(repository.AbstractRepository):
     def __init__(self, batches: list[model.Batch]):
         self._batches = set(batches)
+        self.moved: dict[str, int] = {}
 
     def add(self, batch: model.Batch) -> None:
         self._batches.add(batch)
 
+    def add_many(self, batches: Sequence[model.Batch]) -> None:
+        self._batches.update(batches)
+
     def get(self, reference: str) -> model.Batch:
         return next(b for b in self._batches if b.reference == reference)
 
+    def list_by_sku(self, sku: str) -> list[model.Batch]:
+        return [b for b in self._batches if b.sku == sku]
+
+    def list_by_skus(self, skus: Collection[str]) -> list[model.Batch]:
+        return [b for b in self._batches if b.sku in skus]
+
+    def list_availability(self, sku: str) -> list[model.BatchRecord]:
+        batches = model.BatchIndex(self._batches).batches(sku)
+        return [model.BatchRecord.from_batch(b) for b in batches]
+
+    def add_allocation(self, reference: str, line: model.OrderLine) -> None:
+        self.get(reference).allocate(line)
+
+    def update_availability(self, allocated: Iterable[tuple[str, str, int]]) -> None:
+        for reference, _, qty in allocated:
+            self.moved[reference] = self.moved.get(reference, 0) + qty
+
+    def get_allocations(
+        self, keys: Collection[tuple[str, str]]
+    ) -> dict[tuple[str, str], str]:
+        found = {}
+        for orderid, sku in keys:
+            batch = self.get_by_orderline(orderid, sku)
+            if batch is not None:
+                found[orderid, sku] = batch.reference
+        return found
+
+    def get_by_orderline(self, orderid: str, sku: str) -> model.Batch | None:
+        return next(
+            (
+                b
+                for b in self._batches
+                if b.sku == sku and b.allocation_for(orderid) is not None
+            ),
+            None,
+        )
+
+    def get_versions(self, skus: Collection[str] | None = None) -> dict[str, int]:
+        return {}
+
+    def lock_skus(self, skus: Collection[str]) -> None:
+        pass
+
     def list(self) -> list[model.Batch]:
         return list(self._batches)
 
 
 class FakeSession:
     committed = False
+    commits = 0
 
     def commit(self) -> None:
         self.committed = True
+        self.commits += 1
+
+    def rollback(self) -> None:
+        pass
 
 
 def test_returns_allocation() -> None:
@@ -56,3 +112,172 @@ def test_add_batch() -> None:
     assert repo.get("b1") is not None
     assert session.committed is True
 
+
+def test_allocate_in_sql_prefers_in_stock_batches() -> None:
+    in_stock = model.Batch("in-stock", "RETRO-CLOCK", 10)
+    shipment = model.Batch("shipment", "RETRO-CLOCK", 100, eta=date(2011, 1, 1))
+    repo, session = FakeRepository([shipment, in_stock]), FakeSession()
+
+    first = services.allocate_in_sql("o1", "RETRO-CLOCK", 10, repo, session)
+    second = services.allocate_in_sql("o2", "RETRO-CLOCK", 10, repo, session)
+
+    assert (first, second) == ("in-stock", "shipment")
+    assert in_stock.available_quantity == 0
+    assert session.commits == 2
+
+
+def test_allocate_in_sql_errors() -> None:
+    repo, session = FakeRepository([model.Batch("b1", "LAMP", 5)]), FakeSession()
+
+    with pytest.raises(services.InvalidSku):
+        services.allocate_in_sql("o1", "NOPE", 1, repo, session)
+    with pytest.raises(model.OutOfStock):
+        services.allocate_in_sql("o1", "LAMP", 6, repo, session)
+    assert session.commits == 0
+
+
+def test_deallocate_frees_the_line_for_another_order() -> None:
+    repo, session = FakeRepository([]), FakeSession()
+    services.add_batch("b1", "BLUE-PLINTH", 10, eta=None, repo=repo, session=session)
+    services.allocate("o1", "BLUE-PLINTH", 10, repo=repo, session=session)
+
+    assert services.deallocate("o1", "BLUE-PLINTH", repo=repo, session=session) == "b1"
+    assert repo.get("b1").available_quantity == 10
+    assert session.commits == 3
+
+
+def test_deallocate_unknown_line_is_an_error() -> None:
+    repo, session = FakeRepository([]), FakeSession()
+    services.add_batch("b1", "BLUE-PLINTH", 10, eta=None, repo=repo, session=session)
+
+    with pytest.raises(services.NotAllocated, match="Order o1 has no allocation"):
+        services.deallocate("o1", "BLUE-PLINTH", repo=repo, session=session)
+
+
+def test_allocate_many_returns_a_result_per_line() -> None:
+    repo, session = FakeRepository([]), FakeSession()
+    services.add_batch("b1", "RED-CHAIR", 10, eta=None, repo=repo, session=session)
+    services.add_batch("b2", "BLUE-TABLE", 10, eta=None, repo=repo, session=session)
+
+    results = services.allocate_many(
+        [
+            ("o1", "RED-CHAIR", 10),
+            ("o2", "BLUE-TABLE", 5),
+            ("o3", "RED-CHAIR", 1),
+            ("o4", "NONEXISTENTSKU", 1),
+        ],
+        repo=repo,
+        session=session,
+    )
+
+    assert results[:2] == ["b1", "b2"]
+    assert isinstance(results[2], model.OutOfStock)
+    assert isinstance(results[3], services.InvalidSku)
+    assert str(results[3]) == "Invalid sku NONEXISTENTSKU"
+    assert session.committed is True
+
+
+def test_add_batches_commits_in_chunks_while_consuming_lazily() -> None:
+    repo, session = FakeRepository([]), FakeSession()
+    consumed: list[int] = []
+
+    def rows() -> Iterator[tuple[str, str, int, None]]:
+        for i in range(5):
+            consumed.append(i)
+            yield f"b{i}", "RED-CHAIR", 10, None
+
+    added = services.add_batches(rows(), repo=repo, session=session, chunk_size=2)
+
+    assert added == 5
+    assert session.commits == 3
+    assert {b.reference for b in repo.list()} == {f"b{i}" for i in range(5)}
+
+
+class ConflictingRepository(FakeRepository):
+    def __init__(self, batches: list[model.Batch], conflicts: int):
+        super().__init__(batches)
+        self.conflicts = conflicts
+
+    def add(self, batch: model.Batch) -> None:
+        if self.conflicts:
+            self.conflicts -= 1
+            raise repository.ConcurrentUpdate()
+        super().add(batch)
+
+
+def test_add_batch_retries_after_a_concurrent_update() -> None:
+    repo, session = ConflictingRepository([], conflicts=2), FakeSession()
+
+    services.add_batch("b1", "RED-CHAIR", 10, eta=None, repo=repo, session=session)
+
+    assert repo.get("b1") is not None
+    assert session.committed is True
+
+
+def test_add_batch_gives_up_after_repeated_conflicts() -> None:
+    repo = ConflictingRepository([], conflicts=services.MAX_ATTEMPTS)
+    session = FakeSession()
+
+    with pytest.raises(repository.ConcurrentUpdate):
+        services.add_batch("b1", "RED-CHAIR", 10, eta=None, repo=repo, session=session)
+    assert session.committed is False
+
+
+def test_retried_allocation_replays_without_committing() -> None:
+    repo, session = FakeRepository([model.Batch("b1", "RED-CHAIR", 10)]), FakeSession()
+    services.allocate("o1", "RED-CHAIR", 4, repo=repo, session=session)
+
+    assert services.allocate("o1", "RED-CHAIR", 4, repo=repo, session=session) == "b1"
+    assert services.allocate_in_sql("o1", "RED-CHAIR", 4, repo, session) == "b1"
+    assert session.commits == 1
+    assert repo.get("b1").available_quantity == 6
+
+
+def test_allocate_many_replays_earlier_and_repeated_lines() -> None:
+    repo, session = FakeRepository([model.Batch("b1", "RED-CHAIR", 10)]), FakeSession()
+    services.allocate("o1", "RED-CHAIR", 4, repo=repo, session=session)
+
+    results = services.allocate_many(
+        [("o1", "RED-CHAIR", 4), ("o2", "RED-CHAIR", 6), ("o2", "RED-CHAIR", 6)],
+        repo=repo,
+        session=session,
+    )
+
+    assert results == ["b1", "b1", "b1"]
+    assert repo.get("b1").available_quantity == 0
+
+
+def test_allocations_move_the_availability_read_model() -> None:
+    chair, table = model.Batch("b1", "RED-CHAIR", 10), model.Batch("b2", "TABLE", 10)
+    repo, session = FakeRepository([chair, table]), FakeSession()
+
+    services.allocate("o1", "RED-CHAIR", 4, repo=repo, session=session)
+    services.allocate_many(
+        [("o1", "RED-CHAIR", 4), ("o2", "RED-CHAIR", 3), ("o2", "TABLE", 5)],
+        repo=repo,
+        session=session,
+    )
+    services.deallocate("o1", "RED-CHAIR", repo=repo, session=session)
+
+    # replays moved nothing
+    assert repo.moved == {"b1": 3, "b2": 5}
+
+
+class RacingSession(FakeSession):
+    """Fails the first commit as if an identical request had committed first."""
+
+    raced = False
+
+    def commit(self) -> None:
+        if not self.raced:
+            self.raced = True
+            raise IntegrityError("INSERT INTO order_lines", {}, Exception("unique"))
+        super().commit()
+
+
+def test_allocation_lost_to_an_identical_request_replays_its_result() -> None:
+    repo = FakeRepository([model.Batch("b1", "RED-CHAIR", 10)])
+    session = RacingSession()
+
+    assert services.allocate("o1", "RED-CHAIR", 4, repo=repo, session=session) == "b1"
+    assert session.commits == 0
@@ -0,0 +1,128 @@
+from datetime import date
+from pathlib import Path
+
+import pytest
+
+from allocations.adapters import snapshot
+from allocations.adapters.repository import SavedBatch, SavedLine
+from allocations.domain import model
+
+
+def make_batch(
+    id_: int, ref: str, sku: str, qty: int, eta: date | None = None
+) -> model.Batch:
+    batch = model.Batch(ref, sku, qty, eta)
+    batch.id = id_  # type: ignore [attr-defined]
+    return batch
+
+
+def make_line(id_: int, orderid: str, sku: str, qty: int) -> model.OrderLine:
+    line = model.OrderLine(orderid, sku, qty)
+    line.id = id_  # type: ignore [attr-defined]
+    return line
+
+
+@pytest.fixture
+def saved(tmp_path: Path) -> Path:
+    lamp = make_batch(1, "b1", "LAMP", 20)
+    lamp.allocate(make_line(10, "o1", "LAMP", 5))
+    lamp.allocate(make_line(11, "o2", "LAMP", 3))
+    sofa = make_batch(2, "b2", "SOFA-ÉTÉ", 7, eta=date(2031, 5, 17))
+    sofa.allocate(make_line(12, "o1", "SOFA-ÉTÉ", 7))
+    path = tmp_path / "allocations.snapshot"
+    snapshot.write(path, [lamp, sofa], {"LAMP": 4, "SOFA-ÉTÉ": 9, "EMPTY": 1})
+    return path
+
+
+def test_round_trips_batches_allocations_and_versions(saved: Path) -> None:
+    with snapshot.open_snapshot(saved) as opened:
+        versions = opened.versions
+        lamp, sofa = opened.batches()
+
+    assert versions == {"LAMP": 4, "SOFA-ÉTÉ": 9, "EMPTY": 1}
+    assert lamp._replace(lines=sorted(lamp.lines)) == SavedBatch(
+        1,
+        "b1",
+        "LAMP",
+        20,
+        None,
+        [SavedLine(10, "o1", "LAMP", 5), SavedLine(11, "o2", "LAMP", 3)],
+    )
+    assert sofa == SavedBatch(
+        2, "b2", "SOFA-ÉTÉ", 7, date(2031, 5, 17), [SavedLine(12, "o1", "SOFA-ÉTÉ", 7)]
+    )
+
+
+def test_restores_only_the_skus_asked_for(saved: Path) -> None:
+    with snapshot.open_snapshot(saved) as opened:
+        [sofa] = opened.batches({"SOFA-ÉTÉ", "NOT-IN-SNAPSHOT"})
+        assert opened.batches(set()) == []
+
+    assert sofa.reference == "b2"
+
+
+def test_rewriting_replaces_the_snapshot(saved: Path) -> None:
+    snapshot.write(saved, [], {})
+
+    with snapshot.open_snapshot(saved) as opened:
+        assert opened.batches() == []
+        assert opened.versions == {}
+    assert not saved.with_name(saved.name + ".partial").exists()
+
+
+@pytest.mark.parametrize(
+    "corrupt",
+    [
+        lambda data: b"",
+        lambda data: b"NOPE" + data[4:],
+        lambda data: data[:-1],
+        lambda data: data[:10],
+    ],
+)
+def test_rejects_files_that_are_not_whole_snapshots(saved: Path, corrupt) -> None:  # type: ignore [no-untyped-def]
+    saved.write_bytes(corrupt(saved.read_bytes()))
+
+    with pytest.raises(snapshot.InvalidSnapshot):
+        with snapshot.open_snapshot(saved):
+            pass
+
+
+def overwrite(data: bytes, at: int, value: bytes) -> bytes:
+    at %= len(data)
+    return data[:at] + value + data[at + len(value) :]
+
+
+# the saved fixture ends with 3 skus, 2 batches and 3 lines
+LINES_AT = -3 * snapshot.LINE.size
+BATCHES_AT = LINES_AT - 2 * snapshot.BATCH.size
+SKUS_AT = BATCHES_AT - 3 * snapshot.SKU.size
+
+
+@pytest.mark.parametrize(
+    "at, value",
+    [
+        (-4, (99).to_bytes(4, "little")),  # a line's batch
+        (LINES_AT + 8, (999).to_bytes(4, "little")),  # a line's orderid
+        (SKUS_AT, (999).to_bytes(4, "little")),  # a sku's name
+        (LINES_AT - 4, (2**31 - 1).to_bytes(4, "little")),  # a batch's eta
+    ],
+)
+def test_rejects_records_that_refer_to_nothing(
+    saved: Path, at: int, value: bytes
+) -> None:
+    saved.write_bytes(overwrite(saved.read_bytes(), at, value))
+
+    with snapshot.open_snapshot(saved) as opened:
+        with pytest.raises(snapshot.InvalidSnapshot, match="damaged"):
+            opened.batches()
+            assert opened.versions
+
+
+def test_rejects_strings_that_are_not_utf8(saved: Path) -> None:
+    data = saved.read_bytes()
+    at = data.index(b"LAMP")
+    saved.write_bytes(overwrite(data, at, b"\xff"))
+
+    with pytest.raises(snapshot.InvalidSnapshot, match="damaged"):
+        with snapshot.open_snapshot(saved):
+            pass
@@ -0,0 +1,106 @@
+import random
+import time
+from datetime import date, timedelta
+
+import pytest
+
+from allocations.domain import model
+
+np = pytest.importorskip("numpy")
+vectorized = pytest.importorskip("allocations.domain.vectorized")
+
+today = date.today()
+
+
+def random_backlog(
+    rng: random.Random,
+) -> tuple[list[model.Batch], list[model.OrderLine]]:
+    skus = [f"sku-{i}" for i in range(rng.randint(1, 6))]
+    batches = [
+        model.Batch(
+            f"batch-{i}",
+            rng.choice(skus),
+            rng.randint(1, 60),
+            eta=rng.choice([None, today + timedelta(days=rng.randint(0, 5))]),
+        )
+        for i in range(rng.randint(0, 12))
+    ]
+    for batch in batches:  # some history, so batches don't all start full
+        batch.allocate(
+            model.OrderLine(f"old-{batch.reference}", batch.sku, rng.randint(1, 20))
+        )
+    lines = [
+        model.OrderLine(
+            f"order-{i}", rng.choice(skus + ["unknown"]), rng.randint(1, 15)
+        )
+        for i in range(rng.randint(0, 200))
+    ]
+    return batches, lines
+
+
+def reference_allocate(
+    batches: list[model.Batch] | model.BatchIndex, lines: list[model.OrderLine]
+) -> list[str | None]:
+    results: list[str | None] = []
+    for line in lines:
+        try:
+            results.append(model.allocate(line, batches))
+        except model.OutOfStock:
+            results.append(None)
+    return results
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_reference_allocate(seed: int) -> None:
+    rng = random.Random(seed)
+    batches, lines = random_backlog(rng)
+    columns = vectorized.BatchColumns.from_batches(batches)
+
+    chosen = vectorized.allocate(vectorized.LineColumns.from_lines(lines), columns)
+
+    expected = reference_allocate(batches, lines)
+    assert [
+        columns.references[i] if i != vectorized.UNALLOCATED else None for i in chosen
+    ] == expected
+    assert columns.available.tolist() == [b.available_quantity for b in batches]
+
+
+def test_run_of_lines_spills_into_next_batch_and_back_fills() -> None:
+    batches = vectorized.BatchColumns.from_batches(
+        [
+            model.Batch("later", "LAMP", 10, eta=today + timedelta(days=1)),
+            model.Batch("in-stock", "LAMP", 5),
+        ]
+    )
+    lines = vectorized.LineColumns.from_lines(
+        model.OrderLine(f"o{i}", "LAMP", qty) for i, qty in enumerate([2, 2, 4, 1, 20])
+    )
+
+    chosen = vectorized.allocate(lines, batches)
+
+    assert chosen.tolist() == [1, 1, 0, 1, vectorized.UNALLOCATED]
+    assert batches.available.tolist() == [6, 0]
+
+
+def test_large_backlog_is_faster_than_reference() -> None:
+    rng = random.Random(0)
+    skus = [f"sku-{i}" for i in range(50)]
+    batches = [
+        model.Batch(f"b{i}", skus[i % 50], 1_000, eta=today + timedelta(days=i % 7))
+        for i in range(500)
+    ]
+    lines = [
+        model.OrderLine(f"o{i}", rng.choice(skus), rng.randint(1, 10))
+        for i in range(50_000)
+    ]
+    columns = vectorized.BatchColumns.from_batches(batches)
+    line_columns = vectorized.LineColumns.from_lines(lines)
+
+    start = time.perf_counter()
+    vectorized.allocate(line_columns, columns)
+    engine_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reference_allocate(model.BatchIndex(batches), lines)
+    reference_seconds = time.perf_counter() - start
+
+    assert engine_seconds < reference_seconds